@@ -0,0 +1,478 @@
+__author__ = 'Panagiotis Koukos'
+
+"""
+benchmark.py - Time the Python hot paths of the pipeline on synthetic data.
+
+This script generates reproducible synthetic inputs, whose size grows with
+the scale: reads with LTRs planted in them with 0 to 2 mismatches on both
+strands, the fuzznuc reports of those reads, a RepeatMasker table and BLAST
+output in outfmt 6. It then times the Python part of every stage on them and
+compares the times with those of a baseline, flagging the benchmarks which
+have become slower than the threshold allows.
+
+If fuzznuc is installed, it is run on the same reads as the native scan, and
+the two are compared. Otherwise that benchmark is skipped.
+
+:param -s, --scale: Size of the inputs. 1 is 20000 reads and 50000 BLAST hits.
+:type -s, --scale: float
+:param -r, --repeat: How many times to run every benchmark. The fastest run is kept.
+:type -r, --repeat: int
+:param -b, --baseline: The file the baseline is stored in.
+:type -b, --baseline: str or unicode
+:param -u, --update_baseline: Y to store the times of this run as the baseline.
+:type -u, --update_baseline: str or unicode
+:param -t, --threshold: Slow down, as a fraction of the baseline time, above which a benchmark is flagged.
+:type -t, --threshold: float
+:param -w, --work_dir: Where the inputs are generated. They are kept if given.
+:type -w, --work_dir: str or unicode
+:return None
+"""
+
+import os
+import sys
+import json
+import gzip
+import time
+import random
+
+import herv_lib
+
+BASES = 'ACGT'
+FASTA_NAME = 'synthetic'
+CHROMOSOMES = [str(number) for number in xrange(1, 23)] + ['X', 'Y']
+CHROMOSOME_LENGTH = 10 ** 7
+
+# Number of records of every input at scale 1.
+NOF_READS = 20000
+NOF_REGIONS = 20000
+NOF_BLAST_HITS = 50000
+# Fraction of the reads an LTR is planted in.
+LTR_FRACTION = 0.25
+READ_LENGTH = 150
+
+BENCHMARKS = ['parse_report', 'scan', 'fuzznuc', 'extract', 'bisection', 'repeat_index', 'filter_blast']
+
+
+def random_sequence(rng, length):
+    return ''.join([rng.choice(BASES) for _ in xrange(length)])
+
+
+def mutate(rng, sequence, nof_mismatches):
+    sequence = list(sequence)
+    for position in rng.sample(xrange(len(sequence)), nof_mismatches):
+        sequence[position] = rng.choice(BASES.replace(sequence[position], ''))
+    return ''.join(sequence)
+
+
+def generate_reads(path, nof_reads, rng, read_length=READ_LENGTH, ltr_fraction=LTR_FRACTION):
+    """
+    Write *nof_reads* random reads to the FASTA file *path*, in lines of 60
+    bases. An LTR of herv_lib.LTR_PATTERNS, with 0 to 2 mismatches, is planted
+    in about *ltr_fraction* of them, on either strand.
+
+    :return: A list of (read number, read length, LTR start, LTR end, strand,
+             prime, number of mismatches) tuples of the planted LTRs. The
+             coordinates are 1-indexed and on the forward strand, as fuzznuc
+             reports them.
+    """
+    import scan_ltr
+
+    planted = []
+    with open(path, 'w') as out_file:
+        for read_number in xrange(nof_reads):
+            sequence = random_sequence(rng, read_length)
+            if rng.random() < ltr_fraction:
+                pattern, prime = rng.choice(herv_lib.LTR_PATTERNS)
+                nof_mismatches = rng.randint(0, 2)
+                strand = rng.choice('+-')
+                ltr = mutate(rng, pattern, nof_mismatches)
+                if strand == '-':
+                    ltr = scan_ltr.reverse_complement(ltr)
+                start = rng.randint(0, read_length - len(ltr))
+                sequence = sequence[:start] + ltr + sequence[start + len(ltr):]
+                planted.append((read_number, read_length, start + 1, start + len(ltr), strand, prime,
+                                nof_mismatches))
+            out_file.write('>SRR_%d\n' % read_number)
+            for line_start in xrange(0, read_length, 60):
+                out_file.write(sequence[line_start:line_start + 60] + '\n')
+    return planted
+
+
+def generate_reports(work_dir, fasta_name, planted):
+    """
+    Write the fuzznuc reports, in the simple format, of the LTRs *planted*
+    in the reads of *fasta_name*, one for every prime.
+
+    :return: The list of the reports.
+    """
+    import scan_ltr
+    import run_fuzznuc
+
+    reports = []
+    for pattern, prime in herv_lib.LTR_PATTERNS:
+        report = os.path.join(work_dir, run_fuzznuc.report_name(fasta_name, pattern))
+        with open(report, 'w') as out_file:
+            out_file.write('########################################\n'
+                           '# Program: fuzznuc\n'
+                           '# Commandline: fuzznuc\n'
+                           '#    -sequence %s.FASTA\n'
+                           '#    -pattern %s\n'
+                           '#    -pmismatch 2\n'
+                           '########################################\n\n' % (fasta_name, pattern))
+            for read_number, read_length, start, end, strand, ltr_prime, nof_mismatches in planted:
+                if ltr_prime != prime:
+                    continue
+                out_file.write('#=======================================\n'
+                               '#\n'
+                               '# Sequence: SRR_%d     from: 1   to: %d\n'
+                               '# HitCount: 1\n'
+                               '#\n'
+                               '# Pattern_name Mismatch Pattern\n'
+                               '# pattern1  2 %s\n'
+                               '#\n'
+                               '#=======================================\n\n'
+                               'Feature: 1\n'
+                               'Start: %d\n'
+                               'End: %d\n'
+                               'Strand: %s\n'
+                               'Pattern: pattern1\n'
+                               'Mismatch: %s\n\n' % (read_number, read_length, pattern, start, end, strand,
+                                                     scan_ltr.format_mismatch(nof_mismatches)))
+        reports.append(report)
+    return reports
+
+
+def generate_repeats(path, nof_regions, rng):
+    """
+    Write *nof_regions* random repeating regions to *path*, a gzipped table
+    in the format of the RepeatMasker table of the UCSC browser, sorted by
+    chromosome and start as the download is.
+    """
+    from extract_repeating_regions import CHROMOSOME_COLUMN, START_COLUMN, END_COLUMN, CLASS_COLUMN, FAMILY_COLUMN
+
+    regions = []
+    for _ in xrange(nof_regions):
+        start = rng.randint(0, CHROMOSOME_LENGTH)
+        regions.append(('chr' + rng.choice(CHROMOSOMES), start, start + rng.randint(50, 6000)))
+    regions.sort()
+
+    classes = [('LTR', 'ERVK'), ('LTR', 'ERV1'), ('SINE', 'Alu'), ('LINE', 'L1')]
+    with gzip.open(path, 'wb') as out_file:
+        for chromosome, start, end in regions:
+            words = [str(column) for column in xrange(FAMILY_COLUMN + 5)]
+            words[CHROMOSOME_COLUMN], words[START_COLUMN], words[END_COLUMN] = chromosome, str(start), str(end)
+            words[CLASS_COLUMN], words[FAMILY_COLUMN] = rng.choice(classes)
+            out_file.write('\t'.join(words) + '\n')
+
+
+def generate_blast_output(path, nof_hits, fasta_name, planted, rng):
+    """
+    Write *nof_hits* BLAST hits, in outfmt 6, of the queries
+    create_fasta_from_json.py would make of the LTRs *planted*. About half of
+    them match the whole of the flanking sequence.
+    """
+    from create_fasta_from_json import STRAND_NAMES
+    from process_results import FLANK_LENGTH
+
+    with open(path, 'w') as out_file:
+        for _ in xrange(nof_hits):
+            read_number, _, _, _, strand, prime, _ = rng.choice(planted)
+            strand = STRAND_NAMES[strand]
+            if rng.random() < 0.5:
+                if (strand == 'forward') == (prime == '5_prime'):
+                    query_start = 1
+                else:
+                    query_start = 21
+            else:
+                query_start = rng.randint(1, 40)
+            query_end = query_start + FLANK_LENGTH - 1
+            subject_start = rng.randint(1, CHROMOSOME_LENGTH)
+            subject_end = subject_start + rng.choice([FLANK_LENGTH - 1, 1 - FLANK_LENGTH])
+            out_file.write('\t'.join([
+                '%s.%d.%s.%s' % (fasta_name, read_number, prime, strand),
+                rng.choice(CHROMOSOMES),
+                '%.2f' % rng.uniform(90, 100),
+                str(FLANK_LENGTH),
+                str(rng.randint(0, 3)),
+                '0',
+                str(query_start),
+                str(query_end),
+                str(subject_start),
+                str(subject_end),
+                '%.2e' % rng.uniform(1e-20, 1e-5),
+                '%.1f' % rng.uniform(50, 100)
+            ]) + '\n')
+
+
+def generate_inputs(work_dir, scale=1.0, seed=0):
+    """
+    Generate the synthetic inputs in *work_dir*. The same *scale* and *seed*
+    always give the same inputs.
+
+    :return: Dictionary of the paths of the inputs.
+    """
+    rng = random.Random(seed)
+    inputs = {
+        'fasta': os.path.join(work_dir, FASTA_NAME + '.FASTA'),
+        'repeats': os.path.join(work_dir, 'rmsk.txt.gz'),
+        'blast': os.path.join(work_dir, 'blast.out'),
+        'filtered': os.path.join(work_dir, 'blast_no_repeats.out')
+    }
+    planted = generate_reads(inputs['fasta'], int(NOF_READS * scale), rng)
+    inputs['reports'] = generate_reports(work_dir, FASTA_NAME, planted)
+    generate_repeats(inputs['repeats'], int(NOF_REGIONS * scale), rng)
+    generate_blast_output(inputs['blast'], int(NOF_BLAST_HITS * scale), FASTA_NAME, planted, rng)
+    return inputs
+
+
+def prepare(name, inputs):
+    """
+    Load what benchmark *name* needs from the *inputs*, so that only the hot
+    path itself is timed.
+
+    :return: (function to time, number of records it goes through) tuple,
+             or None if the benchmark cannot run here, eg: fuzznuc is not installed.
+    """
+    import csv
+    import scan_ltr
+    import run_fuzznuc
+    import process_results
+    import extract_sequences
+    import process_blast_output
+    from extract_repeating_regions import read_repeating_regions
+    from repeat_index import RepeatIndex
+
+    if name == 'parse_report':
+        nof_lines = sum(1 for report in inputs['reports'] for _ in open(report))
+        return lambda: [process_results.parse_report(report) for report in inputs['reports']], nof_lines
+
+    if name == 'scan':
+        nof_reads = sum(1 for line in open(inputs['fasta']) if line.startswith('>'))
+        return lambda: scan_ltr.scan_hits(inputs['fasta']), nof_reads
+
+    if name == 'fuzznuc':
+        fuzznuc = herv_lib.Executable('fuzznuc')
+        if not fuzznuc.path:
+            return None
+        nof_reads = sum(1 for line in open(inputs['fasta']) if line.startswith('>'))
+
+        def scan_with_fuzznuc():
+            # Both primes, with the mismatches and strands of the native scan, parsed as the pipeline does.
+            return [dict(process_results.iter_report(run_fuzznuc.stream_fuzznuc(fuzznuc.path, inputs['fasta'],
+                                                                                  pattern, '2')))
+                    for pattern, _ in herv_lib.LTR_PATTERNS]
+        return scan_with_fuzznuc, nof_reads
+
+    if name == 'extract':
+        fasta_index = herv_lib.FastaIndex(inputs['fasta'])
+        hits = []
+        for report in inputs['reports']:
+            hits.extend(process_results.iter_report(report))
+
+        def extract():
+            for hit_id, hit in hits:
+                extract_sequences.add_sequences(fasta_index, hit_id, hit)
+        return extract, len(hits)
+
+    regions = read_repeating_regions(inputs['repeats'])
+    with open(inputs['blast']) as in_file:
+        blast_hits = [process_blast_output.format_blast_output_in_dict(line)
+                      for line in csv.reader(in_file, delimiter='\t')]
+
+    if name == 'bisection':
+        def bisection():
+            for hit in blast_hits:
+                process_blast_output.non_recursive_binary_search_of_repeats(regions.get(hit['chromosome'], []), hit)
+        return bisection, len(blast_hits)
+
+    if name == 'repeat_index':
+        queries = []
+        for hit in blast_hits:
+            hit_start, hit_end = sorted([int(hit['subject_start']), int(hit['subject_end'])])
+            queries.append((hit['chromosome'], hit_start, hit_end))
+        # Building the index is part of what is timed, as in repeat_index.benchmark.
+        return lambda: RepeatIndex(regions).overlaps_hits(queries), len(queries)
+
+    if name == 'filter_blast':
+        repeats = RepeatIndex(regions)
+        return (lambda: process_blast_output.process_blast_output(inputs['blast'], repeats, inputs['filtered']),
+                len(blast_hits))
+
+    raise ValueError('Unknown benchmark ' + name + '.')
+
+
+def time_function(function, repeat=3):
+    """
+    :return: The seconds of the fastest of *repeat* calls of *function*.
+    """
+    best = None
+    for _ in xrange(repeat):
+        start_time = time.time()
+        function()
+        seconds = time.time() - start_time
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def run_benchmarks(inputs, names=None, repeat=3):
+    """
+    :return: Dictionary of the seconds, the number of records and the
+             records per second of every benchmark, keyed by its name.
+    """
+    results = {}
+    for name in names or BENCHMARKS:
+        prepared = prepare(name, inputs)
+        if prepared is None:
+            print 'Skipped', name + ', it cannot run here.'
+            continue
+        function, nof_records = prepared
+        seconds = time_function(function, repeat)
+        results[name] = {
+            'seconds': round(seconds, 4),
+            'records': nof_records,
+            'records_per_second': round(nof_records / seconds, 1) if seconds else 0.0
+        }
+    return results
+
+
+def load_baseline(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path) as in_file:
+        return json.load(in_file)
+
+
+def write_baseline(path, results, scale, seed):
+    import platform
+    with open(path, 'w') as out_file:
+        json.dump({
+            'scale': scale,
+            'seed': seed,
+            'python': platform.python_version(),
+            'recorded': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results
+        }, out_file, indent=2, sort_keys=True)
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    :param threshold: The fraction by which a benchmark may be slower than in
+                      the *baseline* before it is flagged, eg: 0.2 for 20%.
+    :return: A list of (name, baseline seconds, seconds) tuples of the
+             benchmarks which are slower than that.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline['results']:
+            continue
+        baseline_seconds = baseline['results'][name]['seconds']
+        if results[name]['seconds'] > baseline_seconds * (1 + threshold):
+            regressions.append((name, baseline_seconds, results[name]['seconds']))
+    return regressions
+
+
+def main():
+    import shutil
+    import argparse
+    import tempfile
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s',
+                        '--scale',
+                        default=1.0,
+                        type=float,
+                        required=False,
+                        help='Size of the synthetic inputs. 1 is %d reads, %d repeating regions and %d BLAST '
+                             'hits. Default is 1.' % (NOF_READS, NOF_REGIONS, NOF_BLAST_HITS))
+    parser.add_argument('-r',
+                        '--repeat',
+                        default=3,
+                        type=int,
+                        required=False,
+                        help='How many times to run every benchmark. The fastest run is kept. Default is 3.')
+    parser.add_argument('-n',
+                        '--benchmarks',
+                        nargs='*',
+                        choices=BENCHMARKS,
+                        required=False,
+                        help='The benchmarks to run. Default is all of them.')
+    parser.add_argument('-b',
+                        '--baseline',
+                        default='benchmark_baseline.json',
+                        type=str,
+                        required=False,
+                        help='The file the baseline is stored in. Default is benchmark_baseline.json.')
+    parser.add_argument('-u',
+                        '--update_baseline',
+                        default='N',
+                        choices=['Y', 'N'],
+                        type=str,
+                        required=False,
+                        help='Y stores the times of this run as the baseline. Default is N.')
+    parser.add_argument('-t',
+                        '--threshold',
+                        default=0.2,
+                        type=float,
+                        required=False,
+                        help='How much slower than the baseline, as a fraction of its time, a benchmark '
+                             'can be before it is flagged as a regression. Default is 0.2.')
+    parser.add_argument('-w',
+                        '--work_dir',
+                        type=str,
+                        required=False,
+                        help='Where the inputs are generated. They are kept if this is given, otherwise '
+                             'they are generated in a temporary directory which is removed.')
+    parser.add_argument('--seed',
+                        default=0,
+                        type=int,
+                        required=False,
+                        help='Seed of the random number generator. Default is 0.')
+
+    args = parser.parse_args()
+
+    baseline = load_baseline(args.baseline)
+    if baseline and args.update_baseline == 'N' and (baseline['scale'], baseline['seed']) != (args.scale, args.seed):
+        sys.exit('The baseline in %s was recorded at scale %s with seed %s. Aborting.' % (
+            args.baseline, baseline['scale'], baseline['seed']))
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='herv_benchmark_')
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+    try:
+        inputs = generate_inputs(work_dir, args.scale, args.seed)
+        results = run_benchmarks(inputs, args.benchmarks, args.repeat)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+    for name in BENCHMARKS:
+        if name not in results:
+            continue
+        line = '%-13s %8.3fs %9d records %12.1f records/s' % (
+            name, results[name]['seconds'], results[name]['records'], results[name]['records_per_second'])
+        if baseline and name in baseline['results'] and baseline['results'][name]['seconds']:
+            line += '  %+6.1f%%' % (100.0 * (results[name]['seconds'] / baseline['results'][name]['seconds'] - 1))
+        print line
+    if 'scan' in results and 'fuzznuc' in results and results['fuzznuc']['seconds']:
+        print 'The native scan took %.2f times as long as fuzznuc.' % (
+            results['scan']['seconds'] / results['fuzznuc']['seconds'])
+
+    if args.update_baseline == 'Y':
+        write_baseline(args.baseline, results, args.scale, args.seed)
+        print 'Baseline written to', args.baseline
+        return
+    if not baseline:
+        print 'No baseline in', args.baseline + '. Run with --update_baseline Y to store one.'
+        return
+
+    regressions = find_regressions(results, baseline, args.threshold)
+    if regressions:
+        for name, baseline_seconds, seconds in regressions:
+            print 'REGRESSION: %s took %.3fs, %.3fs in the baseline.' % (name, seconds, baseline_seconds)
+        sys.exit('%d benchmarks are more than %.0f%% slower than the baseline.' % (
+            len(regressions), 100 * args.threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+__author__ = 'Panagiotis Koukos'
+
+"""
+cluster_loci.py - Collapse the flank hits of the BLAST output in insertion loci.
+
+At high coverage every insertion is found by many reads, whose flanks hit the
+genome at almost the same place. The hits of the filtered BLAST output are
+reduced to their junctions, as match_reads.py does, sorted by chromosome and
+junction on the disk by the sort program, and merged in loci in a single pass:
+a hit joins the current locus if its junction is at most the tolerance past the
+last junction of the locus. Only the locus being built is kept in memory.
+
+:param -i, --input: The filtered BLAST output, eg: blast_no_repeats.out.
+:type -i, --input: str or unicode
+:param -o, --output: Where the loci are written. Default is loci.out.
+:type -o, --output: str or unicode
+:param -t, --tolerance: Largest distance in bases between consecutive junctions of a locus.
+:type -t, --tolerance: int
+:return None
+"""
+
+import match_reads
+
+DEFAULT_TOLERANCE = 50
+LOCI_HEADER = ['#chromosome', 'start', 'end', 'hits', 'reads', '5_prime', '3_prime', 'plus', 'minus',
+               'best_evalue', 'best_query']
+
+
+class Locus(object):
+    """
+    Models an insertion locus, made of the flank hits whose junctions are close.
+    Those properties are:
+        chromosome: string, The chromosome of the locus.
+        start: int, The first junction of the locus.
+        end: int, The last junction of the locus.
+        nof_hits: int, Number of hits of the locus.
+        reads: set, The reads the hits come from, <FASTA name>.<read id>.
+        primes: dict, Number of hits of the 5_prime and of the 3_prime flanks.
+        strands: dict, Number of hits with the provirus on either strand.
+        best_evalue: string, The lowest e-value of the hits, as BLAST wrote it.
+        best_query: string, The query of the hit with the lowest e-value.
+    """
+
+    def __init__(self, hit):
+        self.chromosome = hit[0]
+        self.start = self.end = hit[2]
+        self.nof_hits = 0
+        self.reads = set()
+        self.primes = {'5_prime': 0, '3_prime': 0}
+        self.strands = {'+': 0, '-': 0}
+        self.best_evalue = None
+        self.best_query = None
+        self.add(hit)
+
+    def add(self, hit):
+        """
+        :param hit: A match_reads.flank_hit tuple, with a junction no lower
+                    than those of the hits already added.
+        """
+        chromosome, strand, junction, prime, query_id, evalue = hit
+        self.end = junction
+        self.nof_hits += 1
+        self.reads.add(query_id.rsplit('.', 2)[0])
+        self.primes[prime] += 1
+        self.strands[strand] += 1
+        if self.best_evalue is None or float(evalue) < float(self.best_evalue):
+            self.best_evalue, self.best_query = evalue, query_id
+
+    def as_row(self):
+        return [self.chromosome, str(self.start), str(self.end), str(self.nof_hits), str(len(self.reads)),
+                str(self.primes['5_prime']), str(self.primes['3_prime']),
+                str(self.strands['+']), str(self.strands['-']), self.best_evalue, self.best_query]
+
+
+def cluster_hits(hits, tolerance=DEFAULT_TOLERANCE):
+    """
+    Merge the flank *hits*, sorted by chromosome and junction, in loci in a
+    single pass. A hit joins the current locus if it is on the same
+    chromosome and its junction is at most *tolerance* bases past the last
+    one of the locus, otherwise the locus is done and a new one starts.
+
+    :param hits: match_reads.flank_hit tuples, eg: as match_reads.sort_hits yields them.
+    :type hits: iterable
+    :return: Yields the Locus of every locus, in order.
+    """
+    locus = None
+    done_chromosomes = set()
+    for hit in hits:
+        chromosome, junction = hit[0], hit[2]
+        if locus and chromosome == locus.chromosome:
+            if junction < locus.end:
+                raise ValueError('The hits are not sorted by position, ' + str(junction) + ' after ' +
+                                 str(locus.end) + ' on ' + chromosome + '.')
+            if junction <= locus.end + tolerance:
+                locus.add(hit)
+                continue
+        if locus:
+            if chromosome != locus.chromosome:
+                done_chromosomes.add(locus.chromosome)
+            yield locus
+        if chromosome in done_chromosomes:
+            raise ValueError('The hits are not sorted by chromosome, ' + chromosome + ' appears twice.')
+        locus = Locus(hit)
+    if locus:
+        yield locus
+
+
+def cluster_file(blast_file, out_file_name='loci.out', tolerance=DEFAULT_TOLERANCE, stats=None):
+    """
+    Write the loci of the hits of *blast_file* to *out_file_name* in tsv
+    format, one per line.
+
+    :param stats: If given, the number of hits and of loci are added to its
+                  'hits' and 'loci' keys.
+    :return: The number of loci written.
+    """
+    nof_hits, nof_loci = 0, 0
+    with open(out_file_name, 'w') as out_file:
+        out_file.write('\t'.join(LOCI_HEADER) + '\n')
+        for locus in cluster_hits(match_reads.sort_hits(match_reads.read_flank_hits(blast_file)), tolerance):
+            out_file.write('\t'.join(locus.as_row()) + '\n')
+            nof_hits += locus.nof_hits
+            nof_loci += 1
+    if stats is not None:
+        stats['hits'] = stats.get('hits', 0) + nof_hits
+        stats['loci'] = stats.get('loci', 0) + nof_loci
+    return nof_loci
+
+
+def main():
+    import sys
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i',
+                        '--input',
+                        type=str,
+                        required=True,
+                        help='Input file. The filtered BLAST output in tsv format.')
+    parser.add_argument('-o',
+                        '--output',
+                        default='loci.out',
+                        type=str,
+                        required=False,
+                        help='Where the loci are written. Default is loci.out.')
+    parser.add_argument('-t',
+                        '--tolerance',
+                        default=DEFAULT_TOLERANCE,
+                        type=int,
+                        required=False,
+                        help='Largest distance in bases between the consecutive junctions of a locus. '
+                             'Default is %d.' % DEFAULT_TOLERANCE)
+
+    args = parser.parse_args()
+    stats = {}
+    try:
+        cluster_file(args.input, args.output, args.tolerance, stats)
+    except (ValueError, RuntimeError) as error:
+        sys.exit(str(error) + ' Aborting.')
+    print stats['hits'], 'hits in', stats['loci'], 'loci, written to', args.output
+
+
+if __name__ == '__main__':
+    main()
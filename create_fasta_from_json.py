@@ -3,68 +3,191 @@ __author__ = 'Panagiotis Koukos'
 """
 This script goes through the json files in a dir, processes them
 and creates the extracted_sequences.fa file to be fed into BLAST.
+
+Reads with the same LTR and flanking sequence are only written once. The ids
+of all of them are kept in extracted_sequences.dups, which
+process_blast_output.py uses to give the hits of the query to every one of
+them.
 """
 
+import json
+import hashlib
+from process_results import FLANK_LENGTH
 
-def concat_ltr_seq(strand, prime, ltr, seq):
+DUPLICATES_FILE = 'extracted_sequences.dups'
+
+
+def ltr_seq_parts(strand, prime, ltr, seq):
+    """
+    :return: The LTR and the flanking sequence in the order in which they
+             make up the BLAST query.
+    """
     if strand == '+':
         if prime == '5_prime':
-            concatenated = seq + ltr
+            return seq, ltr
         else:
-            concatenated = ltr + seq
+            return ltr, seq
     else:
         if prime == '5_prime':
-            concatenated = ltr + seq
+            return ltr, seq
         else:
-            concatenated = seq + ltr
-    return concatenated
+            return seq, ltr
+
+
+def concat_ltr_seq(strand, prime, ltr, seq):
+    return ''.join(ltr_seq_parts(strand, prime, ltr, seq))
+
+
+STRAND_NAMES = {
+    '+': 'forward',
+    '-': 'reverse'
+}
+
+
+def query_from_hit(fasta_file, read_id, hit):
+    """
+    :param fasta_file: The name of the FASTA file of the hit, as in the JSON files.
+    :param read_id: The id of the hit, <read id>.<prime>.
+    :param hit: The hit, with the sequences extract_sequences.py adds.
+    :return: The BLAST query of the hit as an {'id': ..., 'parts': ...}
+             dictionary, or None if the hit is not run through BLAST. The
+             parts are the sequences of the hit in the order ltr_seq_parts
+             puts them, and are only joined when the query is written.
+    """
+    strand = hit['strand']
+    prime = hit['prime']
+    ltr = hit.get('LTR_sequence')
+    seq = hit.get('extracted_sequence')
+    if ltr is None or seq is None:
+        # The read was not found in the FASTA file.
+        return None
+
+    # Include only the hits which have 50bp flanking them. This is
+    # done to reduce the number of hits that make it to the final
+    # stages of the analysis, and also because the 52-fold coverage
+    # will probably account for it.
+    seq_start = int(hit['seq_from'])
+    seq_to = int(hit['seq_to'])
+
+    # The len(seq) check is there because some parts of the fasta files
+    # have become corrupted/the sequence is not available.
+    if seq_to - seq_start == FLANK_LENGTH and len(seq):
+        my_id = '.'.join([fasta_file, read_id, STRAND_NAMES[strand]])
+        parts = ltr_seq_parts(strand, prime, ltr, seq)
+
+        return {
+            'id': my_id,
+            'parts': parts
+        }
+    return None
 
 
 def extract_from_json(json_dictionaries):
     processed_json = []
-    strand_dict = {
-        '+': 'forward',
-        '-': 'reverse'
-    }
-
     for json_file in json_dictionaries:
         fasta_file = json_file.keys()[0]
-        read_ids = json_file[fasta_file].keys()
-        for read_id in read_ids:
-            strand = json_file[fasta_file][read_id]['strand']
-            prime = json_file[fasta_file][read_id]['prime']
-            ltr = json_file[fasta_file][read_id]['LTR_sequence']
-            seq = json_file[fasta_file][read_id]['extracted_sequence']
-
-            # Include only the hits which have 50bp flanking them. This is
-            # done to reduce the number of hits that make it to the final
-            # stages of the analysis, and also because the 52-fold coverage
-            # will probably account for it.
-            seq_start = int(json_file[fasta_file][read_id]['seq_from'])
-            seq_to = int(json_file[fasta_file][read_id]['seq_to'])
-
-            # The len(seq) check is there because some parts of the fasta files
-            # have become corrupted/the sequence is not available.
-            if seq_to - seq_start == 50 and len(seq):
-                my_id = '.'.join([fasta_file, read_id, strand_dict[strand]])
-                final_seq = concat_ltr_seq(strand, prime, ltr, seq)
-
-                processed_json.append({
-                    'id': my_id,
-                    'seq': final_seq
-                })
+        for read_id in json_file[fasta_file].keys():
+            query = query_from_hit(fasta_file, read_id, json_file[fasta_file][read_id])
+            if query:
+                processed_json.append(query)
     return processed_json
 
 
-def write_to_file(json_files):
-    with open('extracted_sequences.fa', 'a') as out_file:
+def query_prime_strand(query_id):
+    # The ids are <fasta file>.<read id>.<prime>.<forward or reverse>
+    return tuple(query_id.split('.')[-2:])
+
+
+def deduplicate_queries(queries):
+    """
+    Keep only the first of the queries with the same sequence. Queries are
+    only considered the same if they are also of the same prime and strand,
+    since those decide how their BLAST hits are filtered. The sequences are
+    kept track of by their SHA-1 digest rather than in full.
+
+    :param queries: List of {'id': ..., 'parts': ...} dictionaries, as
+                    extract_from_json returns them.
+    :return: (unique queries, duplicates) tuple. duplicates has the ids of
+             all the queries with the same sequence, first one included, by
+             the id of the first one. Sequences which occur once are left out.
+    """
+    duplicates = {}
+    unique_queries = list(iter_unique_queries(queries, duplicates))
+    return unique_queries, duplicates
+
+
+def iter_unique_queries(queries, duplicates):
+    """
+    Same as deduplicate_queries, one query at a time. Only the digests of the
+    sequences and the ids of the first queries with them are kept, so the
+    queries can be written as they come.
+
+    :param queries: Iterable of {'id': ..., 'parts': ...} dictionaries.
+    :param duplicates: Dictionary to which the duplicates are added, as
+                       deduplicate_queries returns them.
+    :type duplicates: dict
+    :return: Yields the first of the queries with every sequence.
+    """
+    first_ids = {}
+    for query in queries:
+        digest = hashlib.sha1()
+        for part in query['parts']:
+            digest.update(part)
+        key = query_prime_strand(query['id']) + (digest.digest(),)
+        first_id = first_ids.get(key)
+        if first_id is None:
+            first_ids[key] = query['id']
+            yield query
+        else:
+            duplicates.setdefault(first_id, [first_id]).append(query['id'])
+
+
+def count_queries(nof_unique_queries, duplicates):
+    # Every duplicate query but the first one of its sequence was left out.
+    return nof_unique_queries + sum(len(query_ids) - 1 for query_ids in duplicates.values())
+
+
+def write_duplicates(duplicates, path=DUPLICATES_FILE):
+    with open(path, 'w') as out_file:
+        json.dump(duplicates, out_file, indent=2, separators=(',', ':'), sort_keys=True)
+
+
+def dedup_ratio(nof_queries, nof_unique_queries):
+    if not nof_unique_queries:
+        return 1.0
+    return float(nof_queries) / nof_unique_queries
+
+
+def write_query(out_file, query_id, parts):
+    """
+    Write a BLAST query made up of *parts*, eg: as returned by ltr_seq_parts.
+    The parts can be the buffers FastaIndex.view returns, in which case the
+    bases are copied straight from the FASTA file to the query file.
+    """
+    out_file.write('>' + query_id + '\n')
+    for part in parts:
+        out_file.write(part)
+    out_file.write('\n')
+
+
+def write_to_file(json_files, out_file_name='extracted_sequences.fa'):
+    """
+    :param json_files: Iterable of the queries, eg: as iter_unique_queries yields them.
+    :return: The number of queries written.
+    """
+    # The file is overwritten, so that running this again does not add the
+    # same queries to it a second time.
+    nof_queries = 0
+    with open(out_file_name, 'w') as out_file:
         for json_file in json_files:
-            out_file.write('>' + json_file['id'] + '\n')
-            out_file.write(json_file['seq'] + '\n')
+            write_query(out_file, json_file['id'], json_file['parts'])
+            nof_queries += 1
+    return nof_queries
 
 
 def main():
     import herv_lib
+    import hit_store
     from extract_sequences import load_json
     import argparse
 
@@ -72,22 +195,37 @@ def main():
     parser.add_argument('-d',
                         '--input_dir',
                         type=str,
-                        required=True,
+                        required=False,
                         help='Input directory. This is the directory where the json'
-                             ' files are located.')
+                             ' files, or the hit stores, are located.')
+    parser.add_argument('-m',
+                        '--manifest',
+                        type=str,
+                        required=False,
+                        help='Run manifest of pipeline.py. If specified the JSON files it records'
+                             ' are used instead of those in the input directory.')
 
     args = parser.parse_args()
-    in_dir = args.input_dir
-    in_dir = herv_lib.Directory(in_dir)
-
-    json_files = in_dir.get_files_with_suffix('json')
+    if args.manifest:
+        json_files = herv_lib.RunManifest(args.manifest).files('hits') or []
+    elif args.input_dir:
+        in_dir = herv_lib.Directory(args.input_dir)
+        json_files = ((in_dir.get_files_with_suffix('json') or []) +
+                      (in_dir.get_files_with_suffix(hit_store.SUFFIX) or []))
+    else:
+        from sys import exit
+        exit('Either the input directory or the run manifest has to be specified. Aborting.')
     if len(json_files) < 1:
         from sys import exit
         exit('No json files found in the specified directory. Aborting.')
 
     json_files = load_json(json_files)
     processed_json = extract_from_json(json_files)
-    write_to_file(processed_json)
+    unique_json, duplicates = deduplicate_queries(processed_json)
+    write_to_file(unique_json)
+    write_duplicates(duplicates)
+    print len(processed_json), 'queries,', len(unique_json), 'unique.', \
+        'Deduplication ratio %.2f.' % dedup_ratio(len(processed_json), len(unique_json))
 
 if __name__ == '__main__':
     main()
@@ -2,46 +2,100 @@ __author__ = 'Panagiotis Koukos'
 
 """
 This script process the table output from the UCSC browser in order
-to dump the repeated regions in JSON format.
+to dump the repeated regions in JSON format, or to compile them in the
+binary index process_blast_output.py loads.
 """
 
+# Columns of the RepeatMasker table of the UCSC browser.
+CHROMOSOME_COLUMN, START_COLUMN, END_COLUMN = 5, 6, 7
+CLASS_COLUMN, FAMILY_COLUMN = 11, 12
 
-def main():
+
+def read_repeating_regions(input_file, classes=None, families=None):
+    """
+    Read the regions of the RepeatMasker table *input_file*, which can be
+    gzipped, as the UCSC download is.
+
+    :param classes: If given, only keep the regions of these repeat classes.
+    :param families: If given, only keep the regions of these repeat families.
+    :return: Dictionary of (start, end) lists by chromosome, with the
+             coordinates as integers.
+    """
     import csv
+    import gzip
+
+    results = {}
+    opener = gzip.open if input_file.endswith('.gz') else open
+    with opener(input_file) as in_file:
+        lines = csv.reader(in_file, delimiter='\t')
+        for words in lines:
+            # The table browser output starts with a header, the download
+            # from the UCSC database does not.
+            if not words or words[0].startswith('#'):
+                continue
+            if classes and words[CLASS_COLUMN] not in classes:
+                continue
+            if families and words[FAMILY_COLUMN] not in families:
+                continue
+            chromosome = words[CHROMOSOME_COLUMN]
+            if chromosome not in results:
+                results[chromosome] = []
+            results[chromosome].append((int(words[START_COLUMN]), int(words[END_COLUMN])))
+    return results
+
+
+def main():
     import json
     import argparse
+    import repeat_index
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-i',
                         '--input',
                         type=str,
                         required=True,
-                        help='Input file. Must be in tsv format.')
+                        help='Input file. Must be in tsv format, optionally gzipped.')
     parser.add_argument('-o',
                         '--output',
                         type=str,
                         required=False,
-                        help='Output file. If not present same as the input '
-                             'but with a different suffix.')
+                        help='Output file. If not present repeating_regions.idx for the index and '
+                             'repeating_regions.out for the JSON format.')
+    parser.add_argument('-f',
+                        '--format',
+                        default='index',
+                        choices=['index', 'json'],
+                        type=str,
+                        required=False,
+                        help='index compiles the regions in a binary index, with the overlapping '
+                             'regions merged. json dumps them as they are. Default is index.')
+    parser.add_argument('-c',
+                        '--classes',
+                        nargs='+',
+                        type=str,
+                        required=False,
+                        help='Only keep the regions of these repeat classes, eg: LTR SINE.')
+    parser.add_argument('-fam',
+                        '--families',
+                        nargs='+',
+                        type=str,
+                        required=False,
+                        help='Only keep the regions of these repeat families, eg: ERVK.')
 
     args = parser.parse_args()
     input_file, output_file = args.input, args.output
 
-    results = {}
+    results = read_repeating_regions(input_file, args.classes, args.families)
 
-    with open(input_file) as in_file:
-        in_file.next()  # The first line is the header.
-        lines = csv.reader(in_file, delimiter='\t')
-        for words in lines:
-            chromosome, genome_start, genome_end = words[5], words[6], words[7]
-            if chromosome not in results:
-                results[chromosome] = []
-            results[chromosome].append([genome_start, genome_end])
+    if args.format == 'index':
+        repeat_index.write_index(output_file or 'repeating_regions.idx', results)
+        return
 
     # Sort the list under every chromosome based on the start region
     # of the hit. This allows for binary lookup of the results.
     for result in results:
-        results[result].sort(key=lambda x: int(x[0]))
+        results[result].sort(key=lambda x: x[0])
+        results[result] = [[str(start), str(end)] for start, end in results[result]]
 
     if not output_file:
         output_file = 'repeating_regions.out'
@@ -4,19 +4,37 @@ __author__ = 'Panagiotis Koukos'
 This module extracts the sequences from the original input files based
 on the findings of the previous two scripts in the pipeline.
 """
+import os
 import json
 import copy
 import herv_lib
+import hit_store
 
 
 def load_json(json_files):
+    # Hit stores are loaded in the same structure as the JSON files.
     json_dicts = []
     for json_file in json_files:
-        with open(json_file) as in_file:
-            json_dicts.append(json.load(in_file))
+        if hit_store.is_store(json_file):
+            json_dicts.append(hit_store.load_store(json_file))
+        else:
+            with open(json_file) as in_file:
+                json_dicts.append(json.load(in_file))
     return json_dicts
 
 
+def fasta_paths_by_name(fasta_files):
+    """
+    :return: The paths of *fasta_files* by the FASTA name their hits are
+             stored under, eg: x for x.FASTA, x.FASTQ or x.FASTA.gz.
+    """
+    fasta_paths = dict((os.path.basename(path).split('.')[0], path) for path in fasta_files)
+    if len(fasta_paths) != len(fasta_files):
+        # The hits of either of them could be extracted from the other one.
+        raise ValueError('Some of the input files have the same name, eg: x.FASTA and x.FASTQ.')
+    return fasta_paths
+
+
 def sort_read_ids(read_ids_and_primes):
     primes = {}
     read_ids = []
@@ -31,22 +49,66 @@ def sort_read_ids(read_ids_and_primes):
     return sorted_read_ids
 
 
-def extract_sequence(sequence, strand, prime, seq_from, seq_to):
+def flank_range(strand, prime, seq_from, seq_to):
+    """
+    :return: The (start, end) slice of the read sequence which extract_sequence
+             returns for a hit.
+    """
     if strand == '+':
         if prime == '5_prime':
-            extracted_sequence = sequence[seq_from - 1:seq_to - 1]
+            return seq_from - 1, seq_to - 1
         else:
-            extracted_sequence = sequence[seq_from:seq_to]
+            return seq_from, seq_to
     else:
         if prime == '3_prime':
-            extracted_sequence = sequence[seq_from - 1:seq_to - 1]
+            return seq_from - 1, seq_to - 1
         else:
-            extracted_sequence = sequence[seq_from:seq_to]
-    return extracted_sequence
+            return seq_from, seq_to
+
+
+def extract_sequence(sequence, strand, prime, seq_from, seq_to):
+    start, end = flank_range(strand, prime, seq_from, seq_to)
+    return sequence[start:end]
+
+
+def extract_regions(fasta_index, read_id, hit):
+    """
+    Get the LTR and the flanking sequence of a hit straight from the FASTA
+    file, without reading the rest of the read.
+
+    :param fasta_index: FastaIndex of the FASTA file the hit was found in.
+    :param read_id: The read id of the hit, without the prime.
+    :param hit: The hit, as stored in the JSON files.
+    :return: (LTR, flanking sequence) tuple of the views FastaIndex.view
+             returns, or None if the read is not in the FASTA file.
+    """
+    ltr_from, ltr_to = int(hit['LTR_from']), int(hit['LTR_to'])
+    start, end = flank_range(hit['strand'], hit['prime'], int(hit['seq_from']), int(hit['seq_to']))
+    ltr = fasta_index.view(read_id, ltr_from - 1, ltr_to)
+    if ltr is None:
+        return None
+    return ltr, fasta_index.view(read_id, start, end)
+
+
+def add_sequences(fasta_index, hit_id, hit):
+    """
+    :param hit_id: The id of the hit, <read id>.<prime>.
+    :return: A copy of *hit* with its LTR_sequence and extracted_sequence
+             added, or *hit* itself if the read is not in the FASTA file.
+             The sequences are the views extract_regions returns, so they
+             can only be read while *fasta_index* is open.
+    """
+    regions = extract_regions(fasta_index, hit_id.split('.')[0], hit)
+    if not regions:
+        return hit
+    ltr, extracted_sequence = regions
+    hit = dict(hit)
+    hit['extracted_sequence'] = extracted_sequence
+    hit['LTR_sequence'] = ltr
+    return hit
 
 
 def main():
-    import re
     import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-fasta',
@@ -60,7 +122,14 @@ def main():
                         type=str,
                         required=False,
                         help='Input directory. This is the directory where the JSON'
-                             ' files are located. Defaults to the current working directory.')
+                             ' files, or the hit stores, are located. Defaults to the current'
+                             ' working directory.')
+    parser.add_argument('-m',
+                        '--manifest',
+                        type=str,
+                        required=False,
+                        help='Run manifest of pipeline.py. If specified the FASTA files and the JSON'
+                             ' files it records are used instead of those in the input directories.')
 
     args = parser.parse_args()
     fasta_dir, json_dir = args.fasta_input_dir, args.json_input_dir
@@ -73,49 +142,49 @@ def main():
         json_dir = '.'
 
     fasta_dir = herv_lib.Directory(fasta_dir)
-    json_dir = herv_lib.Directory(json_dir)
-    fasta_files = fasta_dir.get_files_with_suffix('FASTA')
-    json_files = json_dir.get_files_with_suffix('json')
-    if not len(fasta_files) or not len(json_files):
+    if args.manifest:
+        manifest = herv_lib.RunManifest(args.manifest)
+        fasta_files, json_paths = manifest.inputs, manifest.files('hits') or []
+    else:
+        json_dir = herv_lib.Directory(json_dir)
+        fasta_files = fasta_dir.find_files(herv_lib.READ_FILE_PATTERNS)
+        json_paths = ((json_dir.get_files_with_suffix('json') or []) +
+                      (json_dir.get_files_with_suffix(hit_store.SUFFIX) or []))
+    if not fasta_files or not json_paths:
         from sys import exit
         exit('Looks like the directory does not contain any fasta/json files. Aborting.')
 
-    json_files = load_json(json_files)
+    # The FASTA files can be gzipped or FASTQ files, so they are looked up by name.
+    try:
+        fasta_paths = fasta_paths_by_name(fasta_files)
+    except ValueError as error:
+        from sys import exit
+        exit(str(error) + ' Aborting.')
+
+    json_files = load_json(json_paths)
 
-    for json_file in json_files:
+    for json_path, json_file in zip(json_paths, json_files):
         copied_dict = copy.copy(json_file)
         fasta_file = json_file.keys()[0]
-        path_to_fasta_file = fasta_dir.path + '/' + fasta_file + '.FASTA'
+        path_to_fasta_file = fasta_paths.get(fasta_file, fasta_dir.path + '/' + fasta_file + '.FASTA')
         read_ids = json_file[fasta_file].keys()
-        sorted_read_ids = sort_read_ids(read_ids)
-        with open(path_to_fasta_file) as in_file:
-            for read_id in sorted_read_ids:
-                seq_from = int(json_file[fasta_file][read_id]['seq_from'])
-                seq_to = int(json_file[fasta_file][read_id]['seq_to'])
-                ltr_from = int(json_file[fasta_file][read_id]['LTR_from'])
-                ltr_to = int(json_file[fasta_file][read_id]['LTR_to'])
-                prime = json_file[fasta_file][read_id]['prime']
-                strand = json_file[fasta_file][read_id]['strand']
-                read_id_without_prime = read_id.split('.')[0]
-
-                sequence = None
-                read_id_re = re.compile(r'_(\d+)$')
-                for line in in_file:
-                    read_id_match = read_id_re.search(line)
-                    if read_id_match:
-                        read_id_extracted = read_id_match.group(1)
-                        if read_id_extracted == read_id_without_prime:
-                            sequence = next(in_file)
-                            break
-
-                if sequence:
-                    ltr = sequence[ltr_from - 1:ltr_to]
-                    extracted_sequence = extract_sequence(sequence, strand, prime, seq_from, seq_to)
-                    copied_dict[fasta_file][read_id]['extracted_sequence'] = extracted_sequence.rstrip()
-                    copied_dict[fasta_file][read_id]['LTR_sequence'] = ltr
-
-        with open(fasta_file + '.json', 'w') as out_file:
-            json.dump(copied_dict, out_file, indent=2, separators=(',', ':'))
+
+        # The index is built the first time a FASTA file is seen and reused
+        # after that. Reads are looked up directly so their order does not
+        # matter and sequences may span multiple lines.
+        fasta_index = herv_lib.FastaIndex(path_to_fasta_file)
+        for read_id in read_ids:
+            copied_dict[fasta_file][read_id] = add_sequences(fasta_index, read_id, json_file[fasta_file][read_id])
+
+        # Write the results back in the same format they were read in. The
+        # sequences are copied out of the views of the FASTA file as they are
+        # written, so it is only closed afterwards.
+        if hit_store.is_store(json_path):
+            hit_store.write_store(fasta_file + '.' + hit_store.SUFFIX, copied_dict)
+        else:
+            with open(fasta_file + '.json', 'w') as out_file:
+                json.dump(copied_dict, out_file, indent=2, separators=(',', ':'), default=str)
+        fasta_index.close()
 
 if __name__ == '__main__':
     main()
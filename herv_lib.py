@@ -8,8 +8,41 @@ script as well.
 """
 
 import os
+import mmap
+import zlib
+import struct
+import bisect
+import fnmatch
 import subprocess
 
+try:
+    from os import scandir  # py3k
+except ImportError:
+    try:
+        # The backport, pip install scandir.
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+# The HERV-K113 consensus LTR sequences in the order they are scanned for,
+# along with the LTR each one of them identifies.
+LTR_PATTERNS = [
+    ('TGTGGGGAAAAGCAAGAGAG', '5_prime'),
+    ('AGGGGCAACCCACCCCTACA', '3_prime'),
+]
+
+GZIP_MAGIC = '\x1f\x8b'
+# How much of a FASTQ file is read and parsed at a time.
+FASTQ_BLOCK_SIZE = 4 << 20
+# Threads of the decompressor of a gzipped FASTA file, on top of the process reading it.
+DECOMPRESSION_THREADS = 4
+# The read files the pipeline picks up in its input directory.
+READ_FILE_PATTERNS = ['*.FASTA', '*.FASTA.gz', '*.FASTQ', '*.FASTQ.gz', '*.fastq', '*.fastq.gz']
+# Not a .json file, so that the scripts which look for the JSON files of the hits leave it out.
+RUN_MANIFEST = 'run.manifest'
+# Files up to this size are always hashed for their fingerprint, it is cheap.
+SIGNATURE_HASH_LIMIT = 1 << 20
+
 
 class Directory(object):
     """
@@ -69,7 +102,56 @@ class Directory(object):
             if _file.suffix == suffix:
                 return True
 
-    def get_files_with_suffix(self, suffix, ignore_case=False):
+    @staticmethod
+    def compare_name_suffix(name, suffix, ignore_case):
+        # Same as compare_file_suffices, without making a File of every name.
+        name_suffix = os.path.splitext(name)[1][1:]
+        if ignore_case:
+            return name_suffix.lower() == suffix.lower()
+        return name_suffix == suffix
+
+    def iter_files(self, recursive=False):
+        """
+        Go through the files of the directory, and of its subdirectories if
+        *recursive*, without following the links to directories. With scandir
+        whether an entry is a directory is known from the listing itself on
+        most file systems, rather than from a stat of every entry.
+
+        :return: Yields (name, absolute path) tuples of everything which is not
+                 a directory.
+        """
+        directories = [self.path]
+        while directories:
+            directory = directories.pop()
+            if scandir:
+                for entry in scandir(directory):
+                    if entry.is_dir():
+                        if recursive and not entry.is_symlink():
+                            directories.append(entry.path)
+                    else:
+                        yield entry.name, entry.path
+            else:
+                for name in os.listdir(directory):
+                    path = os.path.join(directory, name)
+                    if os.path.isdir(path):
+                        if recursive and not os.path.islink(path):
+                            directories.append(path)
+                    else:
+                        yield name, path
+
+    def find_files(self, patterns, recursive=False):
+        """
+        :param patterns: Glob patterns of the file names to look for, eg:
+                         *.FASTA. The case of the names matters.
+        :type patterns: list
+        :param recursive: Should the subdirectories be looked in as well?
+        :return: The sorted list of the absolute paths of the files whose
+                 name matches any of *patterns*.
+        """
+        return sorted(path for name, path in self.iter_files(recursive)
+                      if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns))
+
+    def get_files_with_suffix(self, suffix, ignore_case=False, compressed=False):
         """
         This function returns a list of the contents of the directory whose
         instance we are in.
@@ -81,20 +163,72 @@ class Directory(object):
                     of '.py'.
             ignore_case: Should case be ignored during the lookup? Default
                          is no. Change at your own peril.
+            compressed: Should the gzipped files with this ending, eg:
+                        x.FASTA.gz, be included as well? Default is no.
         """
         files_with_suffix = []
-        # ALWAYS send the ABSOLUTE paths to the File class.
-        # Also filter out the directories.
-        for file_path in self.get_contents_with_full_path():
-            if not os.path.isdir(file_path):
-                _file = File(file_path)
-                if self.compare_file_suffices(_file, suffix, ignore_case):
-                    files_with_suffix.append(_file.path)
+        # The directories are filtered out.
+        for name, file_path in self.iter_files():
+            if self.compare_name_suffix(name, suffix, ignore_case):
+                files_with_suffix.append(file_path)
+            elif (compressed and name.endswith('.gz') and
+                  self.compare_name_suffix(name[:-len('.gz')], suffix, ignore_case)):
+                files_with_suffix.append(file_path)
 
         if len(files_with_suffix):
             return files_with_suffix
 
 
+class RunManifest(object):
+    """
+    Models the record of the files a run of the pipeline read and the files
+    every one of its stages wrote, so that the later stages, or the scripts
+    of the separate steps, can find them without listing directories.
+    Those properties are:
+        path: string, Where the manifest is stored.
+        inputs: list, Absolute paths of the input files of the run.
+        stages: dict, Absolute paths of the files every stage wrote, by stage.
+    """
+
+    def __init__(self, path=RUN_MANIFEST):
+        """
+        Returns the RunManifest stored in *path*, or an empty one if there is
+        not one there yet.
+        """
+        import json
+        self.path = path
+        self.inputs = []
+        self.stages = {}
+        if os.path.isfile(path):
+            with open(path) as in_file:
+                manifest = json.load(in_file)
+            self.inputs = [str(input_file) for input_file in manifest.get('inputs', [])]
+            self.stages = dict((str(stage), [str(path) for path in files])
+                               for stage, files in manifest.get('stages', {}).items())
+
+    def set_inputs(self, input_files):
+        self.inputs = [os.path.abspath(input_file) for input_file in input_files]
+        self.write()
+
+    def record(self, stage, files):
+        self.stages[stage] = [os.path.abspath(path) for path in files]
+        self.write()
+
+    def files(self, stage):
+        """
+        :return: The files *stage* wrote, or None if it has not been recorded.
+        """
+        return self.stages.get(stage)
+
+    def write(self):
+        import json
+        # Written to a temporary file and renamed, so that an interrupted run
+        # never leaves a half written manifest behind.
+        with open(self.path + '.tmp', 'w') as out_file:
+            json.dump({'inputs': self.inputs, 'stages': self.stages}, out_file, indent=2, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+
 class File(object):
     """
     Models a file along with a few of its properties.
@@ -152,3 +286,729 @@ class Executable(File):
             return abs_path.rstrip()
         else:
             return None
+
+
+def is_gzipped(path):
+    with open(path, 'rb') as in_file:
+        return in_file.read(2) == GZIP_MAGIC
+
+
+def is_bgzf(path):
+    """
+    :return: Whether *path* is compressed with bgzip, in blocks whose
+             compressed size is stored in the BC field of their gzip header.
+    """
+    with open(path, 'rb') as in_file:
+        header = in_file.read(18)
+    return len(header) == 18 and header[:4] == GZIP_MAGIC + '\x08\x04' and header[12:14] == 'BC'
+
+
+def find_program(name):
+    # Unlike Executable this does not complain when the program is missing.
+    from distutils.spawn import find_executable
+    return find_executable(name)
+
+
+def decompressor_command(path, threads=DECOMPRESSION_THREADS):
+    """
+    :return: The command which writes the decompressed contents of the
+             gzipped file *path* to its standard output, with *threads*
+             threads if the decompressor can use them, or None if neither
+             bgzip, pigz nor gzip are installed.
+    """
+    if is_bgzf(path) and find_program('bgzip'):
+        # bgzip decompresses the blocks of a BGZF file in parallel.
+        return ['bgzip', '-dc', '-@', str(threads), path]
+    if find_program('pigz'):
+        return ['pigz', '-dc', '-p', str(threads), path]
+    if find_program('gzip'):
+        return ['gzip', '-dc', path]
+    return None
+
+
+def stop_process(process, early):
+    """
+    Close the standard output of *process* and wait for it to exit.
+
+    :param process: A program whose standard output is being read through a pipe.
+    :type process: Popen
+    :param early: Whether the reader stopped before the end of the output. Only
+                  then is the program terminated, since one which has written
+                  all of it may not have exited yet.
+    :type early: bool
+    :return: The exit code of the program.
+    """
+    process.stdout.close()
+    if early and process.poll() is None:
+        process.terminate()
+    return process.wait()
+
+
+class DecompressedFile(object):
+    """
+    Models the contents of a gzipped file, read from a decompressor running in
+    its own process, so that the decompression and the reading of the lines
+    happen at the same time.
+    Those properties are:
+        path: string, The path of the gzipped file.
+        process: Popen, The decompressor.
+        exhausted: bool, Whether all of the contents have been read.
+    """
+
+    def __init__(self, path, command):
+        self.path = path
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=1 << 20)
+        self.exhausted = False
+
+    def __iter__(self):
+        for line in self.process.stdout:
+            yield line
+        self.exhausted = True
+
+    def readline(self):
+        line = self.process.stdout.readline()
+        if not line:
+            self.exhausted = True
+        return line
+
+    def read(self, size=-1):
+        data = self.process.stdout.read(size)
+        if size < 0 or not data:
+            self.exhausted = True
+        return data
+
+    def close(self):
+        return_code = stop_process(self.process, not self.exhausted)
+        if self.exhausted and return_code != 0:
+            raise RuntimeError('Could not decompress ' + self.path + '. The decompressor exited with ' +
+                               str(return_code) + '.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_fasta(path, threads=DECOMPRESSION_THREADS):
+    """
+    Open a FASTA file for reading. A gzipped file, eg: x.FASTA.gz, is
+    decompressed as it is read by bgzip, pigz or gzip running alongside, or
+    by the gzip module if none of them is installed.
+
+    :return: A file object, which can not be seeked in if the file is gzipped.
+    """
+    if not is_gzipped(path):
+        return open(path, 'rb')
+    command = decompressor_command(path, threads)
+    if command:
+        return DecompressedFile(path, command)
+    import gzip
+    return gzip.open(path, 'rb')
+
+
+class BgzfReader(object):
+    """
+    Models random access to the decompressed contents of a BGZF file, the
+    format of bgzip, one block at a time. The offsets at which the blocks
+    start are stored in the .gzi format of bgzip -i, next to the file.
+    Those properties are:
+        path: string, The path of the BGZF file.
+        index_path: string, The path of the block index, the BGZF path plus .gzi.
+        compressed_offsets: list, Offset of every block in the BGZF file.
+        offsets: list, Offset of every block in the decompressed contents.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + '.gzi'
+        self.handle = open(path, 'rb')
+        self.cached = (None, '')
+
+        if os.path.isfile(self.index_path) and os.path.getmtime(self.index_path) >= os.path.getmtime(path):
+            blocks = self.read_index()
+        else:
+            blocks = self.build_index()
+            try:
+                self.write_index(blocks)
+            except IOError as e:
+                print 'Could not store the block index of', self.path, 'Error was:', e
+        self.compressed_offsets = [block[0] for block in blocks]
+        self.offsets = [block[1] for block in blocks]
+
+    def read_block_header(self, compressed_offset):
+        """
+        :return: (size of the block, size of its header) tuple, or None at
+                 the end of the file.
+        """
+        self.handle.seek(compressed_offset)
+        header = self.handle.read(12)
+        if not header:
+            return None
+        if len(header) < 12 or header[:4] != GZIP_MAGIC + '\x08\x04':
+            raise ValueError('Not a BGZF block at offset ' + str(compressed_offset) + ' of ' + self.path)
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        extra = self.handle.read(extra_length)
+        position = 0
+        while position + 4 <= len(extra):
+            field_id = extra[position:position + 2]
+            field_length = struct.unpack('<H', extra[position + 2:position + 4])[0]
+            if field_id == 'BC':
+                block_size = struct.unpack('<H', extra[position + 4:position + 6])[0] + 1
+                return block_size, 12 + extra_length
+            position += 4 + field_length
+        raise ValueError('Not a BGZF block at offset ' + str(compressed_offset) + ' of ' + self.path)
+
+    def build_index(self):
+        """
+        Go through the block headers, without decompressing anything. The
+        decompressed size of every block is stored at its end.
+        """
+        blocks = []
+        compressed_offset, offset = 0, 0
+        while True:
+            header = self.read_block_header(compressed_offset)
+            if not header:
+                break
+            block_size = header[0]
+            self.handle.seek(compressed_offset + block_size - 4)
+            decompressed_size = struct.unpack('<I', self.handle.read(4))[0]
+            if decompressed_size:
+                # The last block of a BGZF file is an empty end of file marker.
+                blocks.append((compressed_offset, offset))
+            compressed_offset += block_size
+            offset += decompressed_size
+        return blocks
+
+    def read_index(self):
+        # The first block, at offset 0 of both, is not stored.
+        blocks = [(0, 0)]
+        with open(self.index_path, 'rb') as in_file:
+            nof_blocks = struct.unpack('<Q', in_file.read(8))[0]
+            for _ in xrange(nof_blocks):
+                blocks.append(struct.unpack('<QQ', in_file.read(16)))
+        return blocks
+
+    def write_index(self, blocks):
+        with open(self.index_path, 'wb') as out_file:
+            out_file.write(struct.pack('<Q', len(blocks[1:])))
+            for block in blocks[1:]:
+                out_file.write(struct.pack('<QQ', *block))
+
+    def block(self, index):
+        if self.cached[0] != index:
+            compressed_offset = self.compressed_offsets[index]
+            block_size, header_size = self.read_block_header(compressed_offset)
+            self.handle.seek(compressed_offset + header_size)
+            compressed = self.handle.read(block_size - header_size - 8)
+            self.cached = (index, zlib.decompress(compressed, -zlib.MAX_WBITS))
+        return self.cached[1]
+
+    def read(self, start, end):
+        """
+        :return: The decompressed bytes *start* to *end*, only decompressing
+                 the blocks they lie in.
+        """
+        if start >= end or not self.offsets:
+            return ''
+        index = bisect.bisect_right(self.offsets, start) - 1
+        parts = []
+        while index < len(self.offsets) and self.offsets[index] < end:
+            block = self.block(index)
+            block_start = self.offsets[index]
+            parts.append(block[max(start - block_start, 0):end - block_start])
+            index += 1
+        return ''.join(parts)
+
+    def close(self):
+        self.handle.close()
+
+
+class FastaIndex(object):
+    """
+    Models the index of a FASTA file, in the .fai format of samtools faidx,
+    which allows for random access to its records. FASTQ files are indexed
+    the same way, pointing at the sequence line of every record.
+    Those properties are:
+        path: string, The path of the FASTA file.
+        index_path: string, The path of the index, the FASTA path plus .fai.
+        mapping: mmap, Read-only memory map of the FASTA file, once view has
+                 been called.
+        bgzf: BgzfReader, The blocks of the FASTA file if it is compressed
+              with bgzip, in which case the offsets of the index are those of
+              the decompressed file, as with samtools faidx.
+        fastq: bool, Whether the file is a FASTQ file.
+        entries: dict, (name, length, offset, line bases, line width) tuples
+                 keyed by read id. The read id is the part of the name after
+                 the last underscore, the same one the JSON files use, or the
+                 number of the record in a FASTQ file, as iter_fastq gives it.
+    """
+
+    def __init__(self, path):
+        """
+        Returns a FastaIndex for the FASTA file *path*. The index is read from
+        *path*.fai if that is newer than the FASTA file. Otherwise it is built
+        and stored there, so that later runs can reuse it.
+
+        A gzipped FASTA file has to be compressed with bgzip, so that its reads
+        can be read without decompressing all of it.
+        """
+        if not os.path.isfile(path):
+            raise RuntimeError('Path either does not point to a file or does not exist.'
+                               ' Path specified was', path)
+
+        self.path = path
+        self.index_path = path + '.fai'
+        self.handle = None
+        self.mapping = None
+        self.bgzf = None
+        if is_gzipped(path):
+            if not is_bgzf(path):
+                raise RuntimeError(path + ' is compressed with gzip, its reads can not be looked up without '
+                                   'decompressing all of it. Compress it with bgzip instead.')
+            self.bgzf = BgzfReader(path)
+        self.fastq = is_fastq(path)
+
+        if self.index_is_current():
+            records = self.read_index()
+        else:
+            records = self.build_index()
+            try:
+                self.write_index(records)
+            except IOError as e:
+                print 'Could not store the index of', self.path, 'Error was:', e
+
+        if self.fastq:
+            self.entries = dict((str(number), record) for number, record in enumerate(records))
+        else:
+            self.entries = dict((record[0].split('_')[-1], record) for record in records)
+
+    def index_is_current(self):
+        return (os.path.isfile(self.index_path) and
+                os.path.getmtime(self.index_path) >= os.path.getmtime(self.path))
+
+    def read_index(self):
+        records = []
+        with open(self.index_path) as in_file:
+            for line in in_file:
+                name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                records.append((name, int(length), int(offset), int(line_bases), int(line_width)))
+        return records
+
+    def write_index(self, records):
+        with open(self.index_path, 'w') as out_file:
+            for record in records:
+                out_file.write('\t'.join(str(field) for field in record) + '\n')
+
+    def build_index(self):
+        """
+        Go through the FASTA file once and record where every sequence starts
+        and how its lines are laid out.
+        """
+        if self.fastq:
+            return self.build_fastq_index()
+
+        records = []
+        record = None
+        offset = 0
+        with open_fasta(self.path) as in_file:
+            for line in in_file:
+                offset += len(line)
+                if line.startswith('>'):
+                    if record:
+                        records.append(tuple(record[:5]))
+                    words = line[1:].split()
+                    # name, length, offset, line bases, line width, last line length
+                    record = [words[0] if words else '', 0, offset, 0, 0, None]
+                elif record:
+                    bases = len(line.rstrip('\r\n'))
+                    if record[5] is None:
+                        record[3], record[4] = bases, len(line)
+                    elif record[5] < record[3] or bases > record[3]:
+                        # Only the last line of a sequence can be shorter.
+                        raise ValueError('Lines of different length in the sequence of ' +
+                                         record[0] + ' in ' + self.path)
+                    record[1] += bases
+                    record[5] = bases
+        if record:
+            records.append(tuple(record[:5]))
+        return records
+
+    def build_fastq_index(self):
+        """
+        Same as build_index for a FASTQ file, whose records take four lines,
+        the sequence on a single one.
+        """
+        records = []
+        offset = 0
+        name = None
+        with open_fasta(self.path) as in_file:
+            for line_number, line in enumerate(in_file):
+                if line_number % 4 == 0:
+                    if not line.startswith('@'):
+                        if not line.strip():
+                            break
+                        raise ValueError('Expected a FASTQ header on line ' + str(line_number + 1) +
+                                         ' of ' + self.path)
+                    words = line[1:].split()
+                    name = words[0] if words else ''
+                elif line_number % 4 == 1:
+                    bases = len(line.rstrip('\r\n'))
+                    records.append((name, bases, offset, bases, len(line)))
+                offset += len(line)
+        return records
+
+    def get_entry(self, read_id):
+        return self.entries.get(str(read_id))
+
+    def byte_range(self, read_id, start=0, end=None):
+        """
+        :return: The (start, end) byte offsets in the FASTA file between which
+                 the bases *start* to *end* (0-indexed, end excluded) of the
+                 read lie, or None if the read is not in the index.
+        """
+        entry = self.get_entry(read_id)
+        if not entry:
+            return None
+
+        name, length, offset, line_bases, line_width = entry
+        end = length if end is None else min(end, length)
+        start = max(start, 0)
+        if start >= end:
+            return offset, offset
+
+        byte_start = offset + (start // line_bases) * line_width + start % line_bases
+        byte_end = offset + ((end - 1) // line_bases) * line_width + (end - 1) % line_bases + 1
+        return byte_start, byte_end
+
+    def fetch(self, read_id, start=0, end=None):
+        """
+        :return: The bases *start* to *end* (0-indexed, end excluded) of the
+                 read with id *read_id*, by default all of them, or None if the
+                 read is not in the FASTA file.
+        """
+        byte_range = self.byte_range(read_id, start, end)
+        if not byte_range:
+            return None
+
+        if self.bgzf:
+            sequence = self.bgzf.read(*byte_range)
+        else:
+            if not self.handle:
+                self.handle = open(self.path, 'rb')
+            self.handle.seek(byte_range[0])
+            sequence = self.handle.read(byte_range[1] - byte_range[0])
+        return sequence.replace('\n', '').replace('\r', '')
+
+    def view(self, read_id, start=0, end=None):
+        """
+        Same as fetch, but backed by a memory map of the FASTA file. If the
+        bases lie on a single line, as they do in files with one line per
+        sequence, a read-only buffer over the map is returned and nothing is
+        copied until the buffer is written out or turned into a string.
+        A compressed FASTA file can not be mapped, so this is fetch for those.
+        """
+        if self.bgzf:
+            return self.fetch(read_id, start, end)
+
+        byte_range = self.byte_range(read_id, start, end)
+        if not byte_range:
+            return None
+
+        if not self.mapping:
+            if not self.handle:
+                self.handle = open(self.path, 'rb')
+            if not os.path.getsize(self.path):
+                return ''
+            self.mapping = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ)
+
+        byte_start, byte_end = byte_range
+        if self.mapping.find('\n', byte_start, byte_end) == -1:
+            return buffer(self.mapping, byte_start, byte_end - byte_start)
+        return self.mapping[byte_start:byte_end].replace('\n', '').replace('\r', '')
+
+    def close(self):
+        if self.mapping:
+            self.mapping.close()
+            self.mapping = None
+        if self.handle:
+            self.handle.close()
+            self.handle = None
+        if self.bgzf:
+            self.bgzf.close()
+            self.bgzf = None
+
+
+def is_fastq(path):
+    """
+    :return: Whether *path*, which can be gzipped, is a FASTQ file rather than
+             a FASTA one.
+    """
+    import gzip
+    opener = gzip.open if is_gzipped(path) else open
+    with opener(path, 'rb') as in_file:
+        return in_file.read(1) == '@'
+
+
+def parse_fastq_blocks(in_file, block_size=FASTQ_BLOCK_SIZE):
+    """
+    Read a FASTQ file in blocks of *block_size* bytes and split every one of
+    them in its records at once, rather than line by line. The records have
+    to take four lines, as the sequencers and fastq-dump write them.
+
+    :param in_file: File object to read the FASTQ file from.
+    :return: Yields a list of the sequences of the whole records of every block.
+    """
+    remainder = ''
+    while True:
+        block = in_file.read(block_size)
+        if not block:
+            break
+        lines = (remainder + block).split('\n')
+        # The lines after the last whole record, including the one the block
+        # ended in the middle of, are put in front of the next block.
+        nof_lines = (len(lines) - 1) // 4 * 4
+        remainder = '\n'.join(lines[nof_lines:])
+        if nof_lines:
+            if not lines[0].startswith('@'):
+                raise ValueError('Expected a FASTQ header, found ' + lines[0][:50])
+            yield [sequence.rstrip('\r') for sequence in lines[1:nof_lines:4]]
+
+    lines = remainder.split('\n')
+    if len(lines) == 4 and lines[0].startswith('@'):
+        yield [lines[1].rstrip('\r')]
+    elif remainder.strip():
+        raise ValueError('Incomplete FASTQ record at the end of the file: ' + remainder[:50])
+
+
+def iter_fastq(path, block_size=FASTQ_BLOCK_SIZE, queue_size=4):
+    """
+    Generator over the records of a FASTQ file, which can be gzipped. The
+    file is read and split in records in blocks on a background thread, up
+    to *queue_size* blocks ahead of the reader.
+
+    :return: Yields (read id, sequence) tuples. The read id is the number of
+             the record in the file, counting from 0, which stands for the
+             name of the read in the hit ids, the same way the number after
+             the last underscore of the FASTA names does. FastaIndex looks the
+             reads up by the same numbers.
+    """
+    import Queue
+    import threading
+
+    blocks = Queue.Queue(queue_size)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up if the reader has stopped and the queue stays full.
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def read_blocks():
+        try:
+            with open_fasta(path) as in_file:
+                for sequences in parse_fastq_blocks(in_file, block_size):
+                    put(sequences)
+                    if stop.is_set():
+                        return
+        except Exception as error:
+            put(error)
+        else:
+            put(None)
+
+    reader = threading.Thread(target=read_blocks)
+    reader.daemon = True
+    reader.start()
+    number = 0
+    try:
+        while True:
+            sequences = blocks.get()
+            if sequences is None:
+                break
+            if isinstance(sequences, Exception):
+                raise sequences
+            for sequence in sequences:
+                yield str(number), sequence
+                number += 1
+    finally:
+        stop.set()
+        reader.join()
+
+
+def iter_reads(path, start=0, end=None):
+    """
+    Generator over the records of a FASTA or a FASTQ file, as iter_fasta and
+    iter_fastq give them. FASTQ files are always read whole.
+    """
+    if is_fastq(path):
+        return iter_fastq(path)
+    return iter_fasta(path, start, end)
+
+
+def iter_fasta(path, start=0, end=None):
+    """
+    Generator over the records of a FASTA file.
+
+    :param path: Path to the FASTA file, which can be gzipped.
+    :type path: str or unicode
+    :param start: Byte offset of the first record to read, as given by shard_file.
+                  Has to be 0 for a gzipped file.
+    :type start: int
+    :param end: Byte offset at which to stop. The record starting at or after
+                it is not read. Default is the end of the file.
+    :type end: int
+    :return: Yields (name, sequence) tuples. The name is the first word of the
+             header line, the same one fuzznuc reports as the sequence name.
+             Sequences spanning multiple lines are joined.
+    """
+    name = None
+    lines = []
+    with open_fasta(path) as in_file:
+        if start:
+            in_file.seek(start)
+        position = start
+        for line in in_file:
+            if line.startswith('>'):
+                if end is not None and position >= end:
+                    break
+                if name is not None:
+                    yield name, ''.join(lines)
+                words = line[1:].split()
+                name = words[0] if words else ''
+                lines = []
+            else:
+                lines.append(line.rstrip())
+            position += len(line)
+    if name is not None:
+        yield name, ''.join(lines)
+
+
+def shard_file(path, nof_shards, boundary='>'):
+    """
+    Split a file in byte ranges of roughly equal size, every one of which
+    starts at a line beginning with *boundary*. Nothing is copied, the ranges
+    are meant to be read in place by separate workers.
+
+    :param path: Path to the file, eg: a FASTA file.
+    :type path: str or unicode
+    :param nof_shards: Number of ranges to split the file in. Fewer are
+                       returned if the file does not have enough records.
+    :type nof_shards: int
+    :param boundary: What the first line of a range starts with. With an
+                     empty boundary any line start is a valid one.
+    :type boundary: str
+    :return: A list of (start, end) byte offsets covering the whole file.
+             A gzipped file can not be split, it is a single (0, None) range.
+    """
+    if is_gzipped(path):
+        return [(0, None)]
+    file_size = os.path.getsize(path)
+    offsets = [0]
+    with open(path, 'rb') as in_file:
+        for shard in xrange(1, nof_shards):
+            target = max(file_size * shard // nof_shards, offsets[-1])
+            in_file.seek(target)
+            if target:
+                # Move on to the start of the next line.
+                in_file.readline()
+            offset = in_file.tell()
+            line = in_file.readline()
+            while line and not line.startswith(boundary):
+                offset += len(line)
+                line = in_file.readline()
+            if not line:
+                break
+            if offset > offsets[-1]:
+                offsets.append(offset)
+    offsets.append(file_size)
+    return zip(offsets[:-1], offsets[1:])
+
+
+def shard_reads(path, nof_shards):
+    """
+    Same as shard_file for a FASTA or a FASTQ file. The reads of a FASTQ file
+    are numbered from its start, so the file is a single (0, None) range.
+    """
+    if is_fastq(path):
+        return [(0, None)]
+    return shard_file(path, nof_shards)
+
+
+def map_jobs(function, tasks, jobs=1, progress=None):
+    """
+    Apply *function* to every one of *tasks*, over a pool of *jobs* worker
+    processes if more than one is requested.
+
+    :param function: A module level function, so that it can be pickled.
+    :param tasks: List of the arguments *function* is called with.
+    :param jobs: Number of worker processes.
+    :param progress: If given, called with the number of tasks done and the
+                     total number of tasks every time a result comes in.
+    :return: The list of results, in the same order as *tasks* regardless of
+             the order in which the workers finish.
+    """
+    results = []
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            results.append(function(task))
+            if progress:
+                progress(len(results), len(tasks))
+        return results
+
+    from multiprocessing import Pool
+    pool = Pool(min(jobs, len(tasks)))
+    try:
+        for result in pool.imap(function, tasks, chunksize=1):
+            results.append(result)
+            if progress:
+                progress(len(results), len(tasks))
+    finally:
+        pool.close()
+        pool.join()
+    return results
+
+
+def file_signature(path, content=False):
+    """
+    Describe a file for a fingerprint, so that a change to the file changes
+    the fingerprint.
+
+    :param path: Path to the file.
+    :type path: str or unicode
+    :param content: If True the signature is the SHA-1 of the contents of the
+                    file, otherwise its size and modification time, which
+                    is much faster for large files. Files no larger than
+                    SIGNATURE_HASH_LIMIT are hashed either way, since a file
+                    rewritten with the same size can keep the same
+                    modification time on a file system with a coarse clock.
+    :type content: bool
+    :return: A list, or None if the file does not exist.
+    """
+    import hashlib
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    if not content and stat.st_size > SIGNATURE_HASH_LIMIT:
+        # The full modification time, not only its seconds.
+        return [os.path.abspath(path), stat.st_size, stat.st_mtime]
+
+    digest = hashlib.sha1()
+    with open(path, 'rb') as in_file:
+        for block in iter(lambda: in_file.read(1 << 20), ''):
+            digest.update(block)
+    return [os.path.abspath(path), digest.hexdigest()]
+
+
+def fingerprint(*parts):
+    """
+    :param parts: Anything which can be stored as JSON, eg: parameters, file
+                  signatures or other fingerprints.
+    :return: A SHA-1 hex digest which only depends on the values of *parts*.
+    """
+    import json
+    import hashlib
+    return hashlib.sha1(json.dumps(parts, sort_keys=True)).hexdigest()
@@ -0,0 +1,280 @@
+__author__ = 'Panagiotis Koukos'
+
+"""
+hit_store.py - Compact binary storage for the hits of a FASTA file.
+
+This module is an alternative to the JSON files process_results.py and
+extract_sequences.py write. Instead of nested dictionaries of strings the
+hits are stored in columns: the coordinates as arrays of integers, the
+strand and the prime as one byte codes and the read ids and sequences in a
+string heap indexed by offsets. The files are memory mapped when read, so
+opening one takes the same time regardless of its size.
+
+The layout of a .hits file is:
+    header: magic, version, number of hits, number of sections.
+    directory: name, array typecode, offset and size of every section.
+    sections: the columns and heaps, each aligned to 8 bytes.
+The integers are little-endian and of a fixed width whatever the platform:
+32 bits for the columns and 64 bits, typecode Q, for the heap offsets.
+
+:param -i, --input: JSON or .hits files to convert to the other format.
+:type -i, --input: str or unicode
+:return None
+"""
+
+import os
+import sys
+import mmap
+import json
+import struct
+from array import array
+
+MAGIC = 'HERVHITS'
+VERSION = 2
+SUFFIX = 'hits'
+HEADER = struct.Struct('<8sHxxII')
+SECTION = struct.Struct('<32scxxxxxxxQQ')
+# The array typecode of the heap offsets is platform dependent, so they are packed with struct.
+OFFSET_TYPECODE = 'Q'
+
+INTEGER_COLUMNS = ['read_length', 'LTR_from', 'LTR_to', 'seq_from', 'seq_to', 'mismatch']
+STRING_COLUMNS = ['read_id', 'LTR_sequence', 'extracted_sequence']
+STRANDS = ['+', '-']
+PRIMES = ['5_prime', '3_prime']
+
+
+def encode_mismatch(mismatch):
+    # fuzznuc reports exact matches with a dot instead of a zero.
+    return 0 if mismatch == '.' else int(mismatch)
+
+
+def decode_mismatch(mismatch):
+    return str(mismatch) if mismatch else '.'
+
+
+def string_heap(strings):
+    """
+    :return: (offsets, heap) tuple. String i is heap[offsets[i]:offsets[i + 1]].
+             The offsets are packed as 64 bit little-endian integers.
+    """
+    offsets = [0]
+    for string in strings:
+        offsets.append(offsets[-1] + len(string))
+    return struct.pack('<%d%s' % (len(offsets), OFFSET_TYPECODE), *offsets), ''.join(strings)
+
+
+def write_store(path, results_dict):
+    """
+    Write the hits of *results_dict*, in the format parse_report returns or
+    extract_sequences writes, to the .hits file *path*.
+    """
+    fasta_name = results_dict.keys()[0]
+    hits = results_dict[fasta_name]
+    hit_ids = sorted(hits)
+
+    # The JSON module returns unicode strings, which are all ASCII here.
+    sections = [('fasta_name', 'c', str(fasta_name))]
+    for column in INTEGER_COLUMNS:
+        if column == 'mismatch':
+            values = [encode_mismatch(hits[hit_id]['mismatch']) for hit_id in hit_ids]
+        else:
+            values = [int(hits[hit_id][column]) for hit_id in hit_ids]
+        sections.append((column, 'i', array('i', values)))
+
+    sections.append(('strand', 'B', array('B', [STRANDS.index(hits[hit_id]['strand'])
+                                                 for hit_id in hit_ids])))
+    sections.append(('prime', 'B', array('B', [PRIMES.index(hits[hit_id]['prime'])
+                                                for hit_id in hit_ids])))
+    # Not every hit has had its sequences extracted.
+    sections.append(('has_sequence', 'B', array('B', [int('LTR_sequence' in hits[hit_id])
+                                                       for hit_id in hit_ids])))
+
+    for column in STRING_COLUMNS:
+        if column == 'read_id':
+            strings = [str(hit_id.split('.')[0]) for hit_id in hit_ids]
+        else:
+            strings = [str(hits[hit_id].get(column, '')) for hit_id in hit_ids]
+        offsets, heap = string_heap(strings)
+        sections.append((column + '_offsets', OFFSET_TYPECODE, offsets))
+        sections.append((column, 'c', heap))
+
+    with open(path, 'wb') as out_file:
+        out_file.write(HEADER.pack(MAGIC, VERSION, len(hit_ids), len(sections)))
+        offset = HEADER.size + SECTION.size * len(sections)
+        blobs = []
+        for name, typecode, data in sections:
+            blob = data.tostring() if isinstance(data, array) else data
+            if isinstance(data, array) and sys.byteorder == 'big':
+                swapped = array(data.typecode, data)
+                swapped.byteswap()
+                blob = swapped.tostring()
+            offset += -offset % 8
+            out_file.write(SECTION.pack(name, typecode, offset, len(blob)))
+            blobs.append((offset, blob))
+            offset += len(blob)
+        for offset, blob in blobs:
+            out_file.write('\0' * (offset - out_file.tell()))
+            out_file.write(blob)
+
+
+class HitStore(object):
+    """
+    Read-only, memory mapped view of a .hits file.
+    Those properties are:
+        path: string, The path of the file.
+        fasta_name: string, The top level key of the equivalent JSON file.
+        sections: dict, (typecode, offset, size) of every section by name.
+    """
+
+    def __init__(self, path):
+        """
+        Returns a HitStore for the .hits file *path*.
+        """
+        self.path = path
+        with open(path, 'rb') as in_file:
+            self.mapping = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.nof_hits, nof_sections = HEADER.unpack_from(self.mapping, 0)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError('Not a hit store, or a hit store of an unsupported version.'
+                               ' Path specified was', path)
+
+        self.sections = {}
+        for index in xrange(nof_sections):
+            name, typecode, offset, size = SECTION.unpack_from(self.mapping,
+                                                               HEADER.size + index * SECTION.size)
+            self.sections[name.rstrip('\0')] = (typecode, offset, size)
+
+        self.fasta_name = self.bytes('fasta_name')
+        self.offsets = {}
+
+    def __len__(self):
+        return self.nof_hits
+
+    def bytes(self, name):
+        typecode, offset, size = self.sections[name]
+        return self.mapping[offset:offset + size]
+
+    def column(self, name):
+        """
+        :return: The column *name* as an array, or as a tuple for the heap
+                 offsets. Columns are copied out of the map in one go, which
+                 is fast enough to not be worth caching.
+        """
+        typecode, offset, size = self.sections[name]
+        if typecode == OFFSET_TYPECODE:
+            item_size = struct.calcsize('<' + OFFSET_TYPECODE)
+            return struct.unpack_from('<%d%s' % (size // item_size, OFFSET_TYPECODE), self.mapping, offset)
+        values = array(typecode)
+        values.fromstring(self.mapping[offset:offset + size])
+        if sys.byteorder == 'big':
+            values.byteswap()
+        return values
+
+    def string(self, name, index):
+        if name not in self.offsets:
+            self.offsets[name] = self.column(name + '_offsets')
+        offsets = self.offsets[name]
+        typecode, offset, size = self.sections[name]
+        return self.mapping[offset + offsets[index]:offset + offsets[index + 1]]
+
+    def iter_hits(self):
+        """
+        Generator over the hits of the store.
+
+        :return: Yields (hit id, hit) tuples, with the hit the same dictionary
+                 of strings the JSON files contain.
+        """
+        columns = dict((column, self.column(column)) for column in INTEGER_COLUMNS)
+        strands, primes = self.column('strand'), self.column('prime')
+        has_sequence = self.column('has_sequence')
+        for index in xrange(self.nof_hits):
+            prime = PRIMES[primes[index]]
+            hit = {
+                'read_length': str(columns['read_length'][index]),
+                'LTR_from': str(columns['LTR_from'][index]),
+                'LTR_to': str(columns['LTR_to'][index]),
+                'seq_from': str(columns['seq_from'][index]),
+                'seq_to': str(columns['seq_to'][index]),
+                'mismatch': decode_mismatch(columns['mismatch'][index]),
+                'strand': STRANDS[strands[index]],
+                'prime': prime
+            }
+            if has_sequence[index]:
+                hit['LTR_sequence'] = self.string('LTR_sequence', index)
+                hit['extracted_sequence'] = self.string('extracted_sequence', index)
+            yield self.string('read_id', index) + '.' + prime, hit
+
+    def to_results_dict(self):
+        return {self.fasta_name: dict(self.iter_hits())}
+
+    def close(self):
+        self.mapping.close()
+
+
+def is_store(path):
+    return os.path.splitext(path)[1][1:] == SUFFIX
+
+
+def load_store(path):
+    """
+    :return: The results dictionary stored in the .hits file *path*, the same
+             one its JSON equivalent would contain.
+    """
+    store = HitStore(path)
+    results_dict = store.to_results_dict()
+    store.close()
+    return results_dict
+
+
+def compact_segments(fasta_name, segment_paths, remove=True):
+    """
+    Same as process_results.compact_segments, for hit stores. The store is
+    written once, with the hits of all the segments. If there already is a
+    store for the same FASTA file, as in the JSON files the hits already
+    there take precedence.
+    """
+    from process_results import iter_segments
+    path = fasta_name + '.' + SUFFIX
+    if os.path.isfile(path):
+        results_dict = load_store(path)
+    else:
+        results_dict = {fasta_name: {}}
+
+    hits = results_dict[fasta_name]
+    for hit_id, hit in iter_segments(segment_paths):
+        hits.setdefault(hit_id, hit)
+    write_store(path, results_dict)
+
+    if remove:
+        for segment_path in segment_paths:
+            os.remove(segment_path)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i',
+                        '--input',
+                        nargs='+',
+                        type=str,
+                        required=True,
+                        help='Input files. JSON files are converted to hit stores and hit stores '
+                             'to JSON files.')
+
+    args = parser.parse_args()
+    for path in args.input:
+        if is_store(path):
+            results_dict = load_store(path)
+            fasta_name = results_dict.keys()[0]
+            with open(fasta_name + '.json', 'w') as out_file:
+                json.dump(results_dict, out_file, indent=2, separators=(',', ':'), sort_keys=True)
+        else:
+            with open(path) as in_file:
+                results_dict = json.load(in_file)
+            write_store(results_dict.keys()[0] + '.' + SUFFIX, results_dict)
+
+
+if __name__ == '__main__':
+    main()
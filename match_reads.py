@@ -5,11 +5,183 @@ This module goes through the BLAST results file and tries to
 match a 5_prime read with a 3_prime one. The BLAST file should
 have been pre-processed at this stage to remove the hits in
 repeating regions of the genome.
+
+Every hit is reduced to the point of the genome where its flanking sequence
+meets the LTR, the junction, and to the strand the provirus lies on, which
+follows from the strand of the query and the direction of the alignment. The
+hits are sorted by chromosome, strand and junction on the disk by the sort
+program, and swept once, pairing every 5_prime hit with the 3_prime hits on
+the same strand whose junction is within the window of its own. A novel insertion shows up as two junctions a
+few bases apart, the target site duplication, one already in the reference
+genome as two junctions the length of the provirus apart.
+
+:param -i, --input: The filtered BLAST output, eg: blast_no_repeats.out.
+:type -i, --input: str or unicode
+:param -o, --output: Where the candidate pairs are written. Default is candidate_pairs.out.
+:type -o, --output: str or unicode
+:param -w, --window: Largest distance in bases between the junctions of a pair.
+:type -w, --window: int
+:return None
 """
 
+import os
 import csv
+import subprocess
+from collections import deque
+
+import herv_lib
 import process_blast_output as pb
 
+DEFAULT_WINDOW = 100
+OTHER_PRIME = {
+    '5_prime': '3_prime',
+    '3_prime': '5_prime'
+}
+OTHER_STRAND = {
+    '+': '-',
+    '-': '+'
+}
+PAIRS_HEADER = ['#chromosome', 'strand', '5_prime_query', '5_prime_junction', '3_prime_query',
+                '3_prime_junction', 'gap', '5_prime_evalue', '3_prime_evalue']
+
+
+def flank_hit(row):
+    """
+    :param row: The columns of a line of BLAST output, in outfmt 6.
+    :type row: list
+    :return: (chromosome, strand of the provirus, junction, prime, query id,
+             e-value) tuple. The e-value is kept as BLAST wrote it.
+    """
+    query_id = row[0]
+    prime, strand = query_id.split('.')[2:]
+    subject_start, subject_end = int(row[8]), int(row[9])
+
+    # The queries are in the orientation of the reads, and the reads with
+    # the LTR on the reverse strand are the reverse complement of the provirus.
+    aligned = '+' if subject_start <= subject_end else '-'
+    provirus = aligned if strand == 'forward' else OTHER_STRAND[aligned]
+
+    # Along the provirus the 5_prime flank ends at the junction and the
+    # 3_prime one starts there.
+    if (prime == '5_prime') == (provirus == '+'):
+        junction = max(subject_start, subject_end)
+    else:
+        junction = min(subject_start, subject_end)
+    return pb.normalise_chromosome(row[1]), provirus, junction, prime, query_id, row[10]
+
+
+def read_flank_hits(blast_file):
+    """
+    :return: Yields the flank_hit of every line of *blast_file*, one line at a time.
+    """
+    with open(blast_file) as in_file:
+        for row in csv.reader(in_file, delimiter='\t'):
+            if len(row) < 12:
+                continue
+            if tuple(row[0].split('.')[2:]) not in pb.FULL_FLANK_MATCH:
+                print ' ', 'Unexpected combination of strand and prime.', 'Query id is', row[0]
+                continue
+            yield flank_hit(row)
+
+
+def sort_hits(hits, by_strand=False):
+    """
+    Sort the flank *hits* by chromosome, by strand if *by_strand*, and by
+    junction with the sort program, which spills to temporary files rather
+    than holding all of them in memory. If sort is not installed they are
+    sorted in memory.
+
+    :return: Yields the flank_hit tuples in order.
+    """
+    sort = herv_lib.find_program('sort')
+    if not sort:
+        key = None if by_strand else (lambda hit: (hit[0], hit[2]))
+        for hit in sorted(hits, key=key):
+            yield hit
+        return
+
+    # Byte order for the chromosomes, the same as that of sorted. The ties
+    # are broken by comparing the whole lines, as sorted compares the tuples.
+    keys = ['-k1,1', '-k2,2', '-k3,3n'] if by_strand else ['-k1,1', '-k3,3n']
+    environment = dict(os.environ, LC_ALL='C')
+    process = subprocess.Popen([sort, '-t', '\t'] + keys, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, env=environment)
+    exhausted = False
+    try:
+        # sort only starts writing once all of its input has been read.
+        for hit in hits:
+            process.stdin.write('\t'.join([hit[0], hit[1], str(hit[2]), hit[3], hit[4], hit[5]]) + '\n')
+        process.stdin.close()
+        for line in process.stdout:
+            chromosome, strand, junction, prime, query_id, evalue = line.rstrip('\n').split('\t')
+            yield chromosome, strand, int(junction), prime, query_id, evalue
+        exhausted = True
+    finally:
+        if not process.stdin.closed:
+            process.stdin.close()
+        return_code = herv_lib.stop_process(process, not exhausted)
+    if return_code != 0:
+        raise RuntimeError('Sorting the hits failed. sort exited with ' + str(return_code) + '.')
+
+
+def pair_hits(hits, window=DEFAULT_WINDOW):
+    """
+    Pair the 5_prime and 3_prime flank *hits* whose junctions are on the same
+    chromosome and strand and at most *window* bases apart. The hits are
+    sorted by sort_hits, on the disk, and then swept keeping only those
+    within the window of the current one, so only the hits of the window are
+    held in memory.
+
+    :param hits: The flank_hit tuples of the hits, in any order.
+    :type hits: iterable
+    :return: Yields (5_prime hit, 3_prime hit) tuples.
+    """
+    in_window = {'5_prime': deque(), '3_prime': deque()}
+    position = None
+    for hit in sort_hits(hits, by_strand=True):
+        chromosome, strand, junction, prime = hit[:4]
+        if (chromosome, strand) != position:
+            position = (chromosome, strand)
+            in_window['5_prime'].clear()
+            in_window['3_prime'].clear()
+
+        for window_hits in in_window.values():
+            while window_hits and window_hits[0][2] < junction - window:
+                window_hits.popleft()
+        for partner in in_window[OTHER_PRIME[prime]]:
+            yield (hit, partner) if prime == '5_prime' else (partner, hit)
+        in_window[prime].append(hit)
+
+
+def pair_gap(five_prime, three_prime):
+    """
+    :return: The distance from the 5_prime junction to the 3_prime one along
+             the provirus, negative if the flanks overlap, as they do by the
+             length of the target site duplication.
+    """
+    if five_prime[1] == '+':
+        return three_prime[2] - five_prime[2]
+    return five_prime[2] - three_prime[2]
+
+
+def write_pairs(pairs, out_file_name='candidate_pairs.out'):
+    """
+    Write the *pairs* of pair_hits in tsv format, one per line.
+
+    :return: The number of pairs written.
+    """
+    nof_pairs = 0
+    with open(out_file_name, 'w') as out_file:
+        out_file.write('\t'.join(PAIRS_HEADER) + '\n')
+        for five_prime, three_prime in pairs:
+            out_file.write('\t'.join([five_prime[0], five_prime[1],
+                                      five_prime[4], str(five_prime[2]),
+                                      three_prime[4], str(three_prime[2]),
+                                      str(pair_gap(five_prime, three_prime)),
+                                      five_prime[5], three_prime[5]]) + '\n')
+            nof_pairs += 1
+    return nof_pairs
+
 
 def main():
     import argparse
@@ -19,8 +191,25 @@ def main():
                         type=str,
                         required=True,
                         help='Input file. Must be in tsv format.')
+    parser.add_argument('-o',
+                        '--output',
+                        default='candidate_pairs.out',
+                        type=str,
+                        required=False,
+                        help='Where the candidate pairs are written. Default is candidate_pairs.out.')
+    parser.add_argument('-w',
+                        '--window',
+                        default=DEFAULT_WINDOW,
+                        type=int,
+                        required=False,
+                        help='Largest distance in bases between the junctions of the 5 and the 3 prime '
+                             'flanks of a pair. Raise it to the length of the provirus, about 9500, to also '
+                             'pair the flanks of insertions in the reference genome. Default is %d.'
+                             % DEFAULT_WINDOW)
 
-    pass
+    args = parser.parse_args()
+    nof_pairs = write_pairs(pair_hits(read_flank_hits(args.input), args.window), args.output)
+    print nof_pairs, 'candidate pairs written to', args.output
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,224 @@
+__author__ = 'Panagiotis Koukos'
+
+"""
+metrics.py - Time and resource usage of the stages of the pipeline.
+
+This module keeps track of the wall and CPU time, the peak memory, the
+number of records and bytes every stage of the pipeline reads and writes,
+and writes them to a JSON run report. Long stages print a progress line
+with an estimate of the time left every so often.
+
+The CPU time includes the one of the processes a stage starts, eg: fuzznuc,
+blastn or the worker processes, once they have exited. The peak memory is
+the largest resident set size of the pipeline, or of any of those processes,
+up to the end of the stage.
+"""
+
+import sys
+import time
+import json
+import resource
+
+PROGRESS_INTERVAL = 60
+# Not a .json file, so that the scripts which look for the JSON files of the hits leave it out.
+RUN_REPORT = 'run.report'
+
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_kb():
+    # Linux reports the maximum resident set size in KB, OS X in bytes.
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return '%d:%02d:%02d' % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+class StageMetrics(object):
+    """
+    Models the measurements of a stage.
+    Those properties are:
+        name: string, The name of the stage.
+        wall_seconds: float, Time the stage took.
+        cpu_seconds: float, CPU time the stage took.
+        peak_rss_kb: int, Peak resident set size up to the end of the stage.
+        records_in: int, Number of records the stage read, eg: reads or lines.
+        records_out: int, Number of records the stage produced, eg: hits.
+        bytes_read: int, Number of bytes the stage read.
+        bytes_written: int, Number of bytes the stage wrote.
+        skipped: bool, Whether the stage was skipped because it had not changed.
+        upstream: StageMetrics, The stage this one pulls its records from, if
+                  the two run interleaved. Its time is not counted in this one's.
+    """
+
+    def __init__(self, name, upstream=None, progress_interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.upstream = upstream
+        self.progress_interval = progress_interval
+        self.wall_seconds = 0.0
+        self.cpu_seconds = 0.0
+        self.peak_rss_kb = 0
+        self.records_in = 0
+        self.records_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.skipped = False
+        self.started = None
+        self.last_progress = None
+        self.running = None
+
+    def resume(self):
+        if self.started is None:
+            self.started = self.last_progress = time.time()
+        self.running = (time.time(), cpu_seconds())
+
+    def pause(self):
+        wall, cpu = self.running
+        self.wall_seconds += time.time() - wall
+        self.cpu_seconds += cpu_seconds() - cpu
+        self.peak_rss_kb = max(self.peak_rss_kb, peak_rss_kb())
+        self.running = None
+
+    def __enter__(self):
+        self.resume()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.pause()
+
+    def read_file(self, path):
+        import os
+        self.bytes_read += os.path.getsize(path)
+
+    def wrote_file(self, path):
+        import os
+        self.bytes_written += os.path.getsize(path)
+
+    def own_seconds(self):
+        """
+        :return: (wall, CPU) seconds of the stage without those of its upstream stage.
+        """
+        if self.upstream is None:
+            return self.wall_seconds, self.cpu_seconds
+        return (max(self.wall_seconds - self.upstream.wall_seconds, 0.0),
+                max(self.cpu_seconds - self.upstream.cpu_seconds, 0.0))
+
+    def records_per_second(self):
+        wall_seconds = self.own_seconds()[0]
+        if not wall_seconds:
+            return 0.0
+        return max(self.records_in, self.records_out) / wall_seconds
+
+    def progress(self, done, total):
+        """
+        Print a progress line, with the time left estimated from the rate so
+        far, if the last one was printed more than progress_interval seconds ago.
+
+        :param done: How much of the stage is done, in any unit, eg: bytes or shards.
+        :param total: How much there is to do in total, in the same unit.
+        """
+        now = time.time()
+        if self.started is None or now - self.last_progress < self.progress_interval or not total:
+            return
+        self.last_progress = now
+        elapsed = now - self.started
+        line = '  %s: %.1f%% done after %s' % (self.name, 100.0 * done / total, format_seconds(elapsed))
+        if done:
+            line += ', ETA ' + format_seconds(elapsed * (total - done) / done)
+        print line
+        sys.stdout.flush()
+
+    def as_dict(self):
+        wall_seconds, cpu_seconds = self.own_seconds()
+        return {
+            'name': self.name,
+            'skipped': self.skipped,
+            'wall_seconds': round(wall_seconds, 3),
+            'cpu_seconds': round(cpu_seconds, 3),
+            'peak_rss_kb': self.peak_rss_kb,
+            'records_in': self.records_in,
+            'records_out': self.records_out,
+            'bytes_read': self.bytes_read,
+            'bytes_written': self.bytes_written,
+            'records_per_second': round(self.records_per_second(), 3)
+        }
+
+
+def meter(records, stage):
+    """
+    Pass *records* on, counting them as the output of *stage* and adding the
+    time it takes to produce every one of them to it.
+    """
+    iterator = iter(records)
+    while True:
+        stage.resume()
+        try:
+            record = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            stage.pause()
+        stage.records_out += 1
+        yield record
+
+
+class RunReport(object):
+    """
+    Models the report of a run of the pipeline.
+    Those properties are:
+        path: string, Where the report is written.
+        stages: list, StageMetrics of the stages in the order they were started.
+    """
+
+    def __init__(self, path=RUN_REPORT, progress_interval=PROGRESS_INTERVAL):
+        self.path = path
+        self.progress_interval = progress_interval
+        self.stages = []
+        self.started = time.time()
+
+    def stage(self, name, upstream=None):
+        stage = StageMetrics(name, upstream, self.progress_interval)
+        self.stages.append(stage)
+        return stage
+
+    def skipped(self, name):
+        stage = self.stage(name)
+        stage.skipped = True
+        return stage
+
+    def as_dict(self):
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': round(time.time() - self.started, 3),
+            'peak_rss_kb': peak_rss_kb(),
+            'stages': [stage.as_dict() for stage in self.stages]
+        }
+
+    def write(self):
+        with open(self.path, 'w') as out_file:
+            json.dump(self.as_dict(), out_file, indent=2, sort_keys=True)
+
+    def summary(self):
+        """
+        :return: One line per stage, for printing at the end of a run.
+        """
+        lines = []
+        for stage in self.stages:
+            if stage.skipped:
+                lines.append('%-8s skipped' % stage.name)
+                continue
+            wall_seconds, cpu_seconds = stage.own_seconds()
+            lines.append('%-8s %s wall, %s CPU, %d in, %d out, %.0f records/s, peak RSS %d KB' % (
+                stage.name, format_seconds(wall_seconds), format_seconds(cpu_seconds), stage.records_in,
+                stage.records_out, stage.records_per_second(), stage.peak_rss_kb))
+        return lines
@@ -2,27 +2,562 @@ __author__ = 'Panagiotis Koukos'
 
 """
 This script automates the procedure by putting all of the necessary steps
-for the analysis in one place. It imports/launches the other scripts of the
-pipeline and executing them with their default options.
+for the analysis in one place. It imports the other scripts of the pipeline
+and runs them with their default options, all in the same interpreter.
 
+The steps pass the hits on to each other as they go, as (FASTA name, hit id,
+hit) records, and they are only written to the disk at the checkpoints which
+are asked for:
+    hits: The JSON files with the hits of every FASTA file and their
+          sequences, as extract_sequences.py writes them.
+    duplicates: The ids of the duplicate BLAST queries, as
+                create_fasta_from_json.py writes them.
+The BLAST queries, the BLAST output and the final results are always written.
+
+Every stage records a fingerprint of its inputs and parameters in
+pipeline.fingerprints once it is done, and when the pipeline is run again the
+stages with the same fingerprint and their output still on the disk are
+skipped. The fingerprint of a stage includes the one of the stage before it,
+so a change only reruns the stages it affects. The hits and the BLAST queries
+can only be skipped if their checkpoints are written.
+
+The input files of the run and the files every stage wrote are recorded in
+the run manifest, run.manifest, which the scripts of the separate steps
+can read instead of looking for their input files in a directory.
 """
+import os
 import sys
+import json
 import herv_lib
 import run_fuzznuc
-import subprocess
+import scan_ltr
+import run_blast
 import process_results
 import create_fasta_from_json
 import extract_sequences
 import process_blast_output
+import cluster_loci
+import metrics
 
+DEFAULT_BLAST_DATABASE = '/scratch/pk3414/Homo_sapiens.GRCh38.dna.toplevel.fa'
+CHECKPOINTS = ['hits', 'duplicates']
+STAGES = ['hits', 'queries', 'blast', 'filter', 'loci']
+FINGERPRINTS_FILE = 'pipeline.fingerprints'
+NOF_MISMATCHES = 2
 
-def main():
-    import argparse
 
-    fuzznuc = herv_lib.Executable('fuzznuc')
+def fuzznuc_task(task):
+    fuzznuc_path, fasta_file, ltr_seq = task
+    run_fuzznuc.call_fuzznuc(fuzznuc_path,  # Path to the executable
+                             fasta_file,    # Input file
+                             '',            # Output file-name
+                             ltr_seq,       # 3 or 5 prime
+                             str(NOF_MISMATCHES))  # Number of mismatches
+    return report_hits_task(run_fuzznuc.report_name(fasta_file, ltr_seq))
+
+
+def fuzznuc_stream_task(task):
+    """
+    Parse the report of fuzznuc as it is produced. The report is only
+    written to a file if *keep_report* is set.
+
+    :return: (FASTA name, segment path, parsing stats) tuple.
+    """
+    fuzznuc_path, fasta_file, ltr_seq, keep_report = task
+    report = run_fuzznuc.report_name(fasta_file, ltr_seq)
+    lines = run_fuzznuc.stream_fuzznuc(fuzznuc_path, fasta_file, ltr_seq, str(NOF_MISMATCHES),
+                                       keep_report=report if keep_report else None)
+    stats = {}
+    fasta_name, segment_path = process_results.report_to_segment(report, lines, stats)
+    return fasta_name, segment_path, stats
+
+
+def report_hits_task(report):
+    """
+    Stream the hits of *report* to a segment, which the pipeline reads back
+    one hit at a time, rather than passing them back from the worker.
+
+    :return: (FASTA name, segment path, parsing stats) tuple.
+    """
+    stats = {}
+    fasta_name, segment_path = process_results.report_to_segment(report, stats=stats)
+    return fasta_name, segment_path, stats
+
+
+def scan_task(task):
+    """
+    Scan a shard of a FASTA file and stream the checked hits of every prime
+    to a segment, sorted by their id, rather than passing them back from
+    the worker.
+
+    :return: (list of (prime, segment path) tuples, scanning stats) tuple.
+    """
+    fasta_file, patterns, start, end, shard = task
+    stats = {}
+    prime_hits = scan_ltr.scan_hits(fasta_file, patterns, NOF_MISMATCHES, stats=stats, start=start, end=end)
+    fasta_name = scan_ltr.get_fasta_name(fasta_file)
+    prime_segments = []
+    for prime, hits in prime_hits:
+        hits = process_results.check_results(hits, prime)
+        segment_path = '%s.shard_%d.%s.jsonl' % (fasta_name, shard, prime)
+        process_results.write_segment(((hit_id, hits[hit_id]) for hit_id in sorted(hits)), segment_path)
+        prime_segments.append((prime, segment_path))
+    return prime_segments, stats
+
+
+class Pipeline(object):
+    """
+    Models a run of the analysis over a number of FASTA files.
+    Those properties are:
+        fasta_files: list, Paths to the FASTA files, in the order they are processed.
+        engine: string, fuzznuc or native, how the LTR sequences are located.
+        patterns: list, (sequence, prime) tuples for the native engine, or None.
+        jobs: int, Number of worker processes.
+        shards: int, Number of parts every FASTA file is scanned in.
+        stream: bool, Whether the fuzznuc reports are parsed without writing them.
+        keep_reports: bool, Whether the streamed reports are also written.
+        blast_database: string, The BLAST database.
+        repeats_file: string, The repeating regions, index or JSON.
+        checkpoints: set, Which of CHECKPOINTS are written to the disk.
+        force: bool, Whether all of the stages are run, even if they are unchanged.
+        tolerance: int, Largest distance between the junctions of the hits of a locus.
+        report: RunReport, The time and resources every stage takes.
+        manifest: RunManifest, The input files and the files every stage wrote.
+        written: dict, The files every stage has written in this run, by stage.
+    """
+
+    def __init__(self, fasta_files, engine='fuzznuc', patterns=None, jobs=1, shards=1, stream=False,
+                 keep_reports=False, blast_database=DEFAULT_BLAST_DATABASE, repeats_file=None,
+                 checkpoints=(), force=False, report_file=metrics.RUN_REPORT,
+                 manifest_file=herv_lib.RUN_MANIFEST, tolerance=cluster_loci.DEFAULT_TOLERANCE):
+        for checkpoint in checkpoints:
+            if checkpoint not in CHECKPOINTS:
+                raise ValueError('Unknown checkpoint ' + checkpoint + '.')
+        if patterns and engine != 'native':
+            raise ValueError('Patterns other than the HERV-K113 consensus sequences require the native engine.')
+        if shards > 1 and engine != 'native':
+            raise ValueError('Splitting the FASTA files in shards requires the native engine.')
+        if engine != 'native' and any(herv_lib.is_fastq(fasta_file) for fasta_file in fasta_files):
+            # The reads of a FASTQ file are known by their number, which fuzznuc does not report.
+            raise ValueError('FASTQ files can only be scanned by the native engine.')
+
+        self.fasta_files = fasta_files
+        self.engine = engine
+        self.patterns = patterns
+        self.jobs = jobs
+        self.shards = shards
+        self.stream = stream
+        self.keep_reports = keep_reports
+        self.blast_database = blast_database
+        self.repeats_file = repeats_file
+        if not self.repeats_file:
+            # The index extract_repeating_regions.py compiles, or the JSON
+            # file older versions of it wrote.
+            if os.path.isfile('repeating_regions.idx'):
+                self.repeats_file = 'repeating_regions.idx'
+            else:
+                self.repeats_file = 'repeating_regions.out'
+        self.checkpoints = set(checkpoints)
+        self.force = force
+        self.tolerance = tolerance
+        self.report = metrics.RunReport(report_file)
+        self.manifest = herv_lib.RunManifest(manifest_file)
+        self.written = {}
+        self.fasta_paths = dict((scan_ltr.get_fasta_name(fasta_file), fasta_file) for fasta_file in fasta_files)
+        if len(self.fasta_paths) != len(fasta_files):
+            # Their hits would end up in the same JSON file.
+            raise ValueError('Some of the input files have the same name, eg: in different directories.')
+
+    def locate_hits(self, stage=None):
+        """
+        Locate the LTR sequences in the FASTA files.
+
+        :param stage: StageMetrics to which the reads or the report lines
+                      read are added, and which shows the progress.
+        :return: Yields (FASTA name, hit id, hit) records, one FASTA file
+                 after the other.
+        """
+        stage = stage or metrics.StageMetrics('locate')
+        for fasta_file in self.fasta_files:
+            stage.read_file(fasta_file)
+        if self.engine == 'native':
+            return self.scan_hits(stage)
+        return self.fuzznuc_hits(stage)
+
+    def scan_hits(self, stage):
+        # Scan every file for all of the LTR sequences in a single pass. Large
+        # files are split in shards at record boundaries, and the segments of
+        # the hits of the shards are merged back under the name of the file
+        # one hit at a time. The ids of the reads of a file are unique, so
+        # the shards never share one.
+        import heapq
+        stats = {'reads': 0, 'candidates': 0}
+        tasks = []
+        for fasta_file in self.fasta_files:
+            for shard, (start, end) in enumerate(herv_lib.shard_reads(fasta_file, self.shards)):
+                tasks.append((fasta_file, self.patterns, start, end, shard))
+
+        shard_segments = {}
+        for task, (prime_segments, task_stats) in zip(tasks, herv_lib.map_jobs(scan_task, tasks, self.jobs,
+                                                                               stage.progress)):
+            shard_segments.setdefault(task[0], []).append(prime_segments)
+            stats['reads'] += task_stats['reads']
+            stats['candidates'] += task_stats['candidates']
+        stage.records_in = stats['reads']
+        print 'Seed prefilter discarded', '%.2f%%' % (100 * scan_ltr.discarded_fraction(stats)), \
+            'of', stats['reads'], 'reads.'
+
+        try:
+            for fasta_file in self.fasta_files:
+                fasta_name = scan_ltr.get_fasta_name(fasta_file)
+                shards = shard_segments[fasta_file]
+                for prime_index in xrange(len(shards[0])):
+                    segments = [process_results.iter_segment(shard[prime_index][1]) for shard in shards]
+                    for hit_id, hit in heapq.merge(*segments):
+                        yield fasta_name, hit_id, hit
+        finally:
+            for shards in shard_segments.values():
+                for prime_segments in shards:
+                    for prime, segment_path in prime_segments:
+                        os.remove(segment_path)
+
+    def fuzznuc_hits(self, stage):
+        fuzznuc = herv_lib.Executable('fuzznuc')
+        if not fuzznuc.path:
+            raise RuntimeError('Failed to locate fuzznuc binary in the system path.')
+
+        # First parse the file with fuzznuc looking for the 5prime sequence and
+        # then for the 3prime. Keep the loop structure like this because of disk
+        # buffering.
+        tasks = []
+        for fasta_file in self.fasta_files:
+            for ltr_seq, prime in herv_lib.LTR_PATTERNS:
+                tasks.append((fuzznuc.path, fasta_file, ltr_seq))
+
+        if self.stream:
+            # Parse every report while fuzznuc writes it to a pipe.
+            results = herv_lib.map_jobs(fuzznuc_stream_task, [task + (self.keep_reports,) for task in tasks],
+                                        self.jobs, stage.progress)
+        else:
+            results = herv_lib.map_jobs(fuzznuc_task, tasks, self.jobs, stage.progress)
+        stage.records_in = sum(stats['lines'] for fasta_name, segment_path, stats in results)
+
+        # The hits of the same FASTA file are consecutive. Their ids end in
+        # the prime of the report and fuzznuc reports every read once, so
+        # the segments of a file never share an id.
+        try:
+            for fasta_name, segment_path, stats in results:
+                for hit_id, hit in process_results.iter_segment(segment_path):
+                    yield fasta_name, hit_id, hit
+        finally:
+            for fasta_name, segment_path, stats in results:
+                os.remove(segment_path)
+
+    def add_sequences(self, records, fasta_indexes, stage=None):
+        """
+        Add the LTR and the flanking sequence to every hit of *records*. The
+        sequences are views of the FASTA files, which are only copied when
+        they are written, so the FASTA indexes are not closed here.
+
+        :param fasta_indexes: The FASTA index of every file, by FASTA name,
+                              to which the ones opened are added. They have
+                              to be closed once the hits have been written.
+        :type fasta_indexes: dict
+        :param stage: StageMetrics to which the hits and the bases read are added.
+        """
+        stage = stage or metrics.StageMetrics('extract')
+        for fasta_name, hit_id, hit in records:
+            if fasta_name not in fasta_indexes:
+                fasta_indexes[fasta_name] = herv_lib.FastaIndex(self.fasta_paths[fasta_name])
+            hit = extract_sequences.add_sequences(fasta_indexes[fasta_name], hit_id, hit)
+            stage.records_in += 1
+            stage.bytes_read += len(hit.get('LTR_sequence', '')) + len(hit.get('extracted_sequence', ''))
+            yield fasta_name, hit_id, hit
+
+    def checkpoint_hits(self, records):
+        """
+        Pass *records* on and, if the hits checkpoint is set, write the hits
+        of every FASTA file to its JSON file once all of them have gone past.
+        The FASTA files without any hits get a JSON file without any as well.
+        """
+        if 'hits' not in self.checkpoints:
+            for record in records:
+                yield record
+            return
+
+        fasta_name, hits = None, {}
+        written = set()
+        for record in records:
+            if record[0] != fasta_name:
+                if fasta_name is not None:
+                    self.wrote('hits', write_hits(fasta_name, hits))
+                    written.add(fasta_name)
+                fasta_name, hits = record[0], {}
+            hits[record[1]] = record[2]
+            yield record
+        if fasta_name is not None:
+            self.wrote('hits', write_hits(fasta_name, hits))
+            written.add(fasta_name)
+
+        for fasta_file in self.fasta_files:
+            fasta_name = scan_ltr.get_fasta_name(fasta_file)
+            if fasta_name not in written:
+                self.wrote('hits', write_hits(fasta_name, {}))
+
+    def write_queries(self, records, query_file='extracted_sequences.fa', stage=None):
+        """
+        Write the BLAST queries of the hits of *records* to *query_file*,
+        leaving out the duplicate ones, one hit at a time.
+
+        :param stage: StageMetrics to which the hits read and the queries written are added.
+        :return: The duplicates, as create_fasta_from_json.deduplicate_queries
+                 returns them.
+        """
+        stage = stage or metrics.StageMetrics('queries')
+
+        def queries():
+            for fasta_name, hit_id, hit in records:
+                stage.records_in += 1
+                query = create_fasta_from_json.query_from_hit(fasta_name, hit_id, hit)
+                if query:
+                    yield query
+
+        duplicates = {}
+        nof_unique_queries = create_fasta_from_json.write_to_file(
+            create_fasta_from_json.iter_unique_queries(queries(), duplicates), query_file)
+        nof_queries = create_fasta_from_json.count_queries(nof_unique_queries, duplicates)
+        stage.records_out += nof_unique_queries
+        stage.wrote_file(query_file)
+        self.wrote('queries', query_file)
+        if 'duplicates' in self.checkpoints:
+            create_fasta_from_json.write_duplicates(duplicates)
+            stage.wrote_file(create_fasta_from_json.DUPLICATES_FILE)
+            self.wrote('queries', create_fasta_from_json.DUPLICATES_FILE)
+        print nof_queries, 'BLAST queries,', nof_unique_queries, 'unique.', 'Deduplication ratio %.2f.' % \
+            create_fasta_from_json.dedup_ratio(nof_queries, nof_unique_queries)
+        return duplicates
+
+    def run_blast(self, query_file='extracted_sequences.fa', output_file='blast.out', stage=None):
+        # blastn is run with as many processes as there are CPUs.
+        stage = stage or metrics.StageMetrics('blast')
+        run_blast.run_blast(self.blast_database, query_file, output_file, progress=stage.progress)
+        stage.read_file(query_file)
+        stage.wrote_file(output_file)
+        self.wrote('blast', output_file)
+        with open(query_file) as in_file:
+            stage.records_in = sum(1 for line in in_file if line.startswith('>'))
+        with open(output_file) as in_file:
+            stage.records_out = sum(1 for line in in_file)
+
+    def filter_blast_output(self, duplicates, blast_file='blast.out', out_file='blast_no_repeats.out',
+                            stage=None):
+        # Filter out the blast hits in the repetitive regions.
+        stage = stage or metrics.StageMetrics('filter')
+        repeats = process_blast_output.load_repeating_regions(self.repeats_file)
+        stats = {}
+        process_blast_output.process_blast_output(blast_file, repeats, out_file, jobs=self.jobs,
+                                                  duplicates=duplicates, stats=stats, progress=stage.progress)
+        stage.records_in, stage.records_out = stats['lines'], stats['hits']
+        stage.read_file(blast_file)
+        stage.wrote_file(out_file)
+        self.wrote('filter', out_file)
 
-    if not fuzznuc:
-        sys.exit('Failed to locate fuzznuc binary in the system path. Aborting.')
+    def cluster_hits(self, blast_file='blast_no_repeats.out', out_file='loci.out', stage=None):
+        # Collapse the hits which passed the filter in insertion loci.
+        stage = stage or metrics.StageMetrics('loci')
+        stats = {}
+        cluster_loci.cluster_file(blast_file, out_file, self.tolerance, stats)
+        stage.records_in, stage.records_out = stats['hits'], stats['loci']
+        stage.read_file(blast_file)
+        stage.wrote_file(out_file)
+        self.wrote('loci', out_file)
+
+    def wrote(self, stage, path):
+        self.written.setdefault(stage, []).append(path)
+
+    def load_hits(self):
+        """
+        Same as locate_hits followed by add_sequences, from the JSON files of
+        the hits checkpoint.
+        """
+        for fasta_file in self.fasta_files:
+            fasta_name = scan_ltr.get_fasta_name(fasta_file)
+            with open(fasta_name + '.json') as in_file:
+                hits = json.load(in_file)[fasta_name]
+            for hit_id in sorted(hits):
+                yield fasta_name, str(hit_id), dict((str(key), str(value)) for key, value in hits[hit_id].items())
+
+    def stage_files(self, stage):
+        """
+        :return: The files a stage writes, with the checkpoints of the run.
+        """
+        if stage == 'hits':
+            if 'hits' not in self.checkpoints:
+                return []
+            return [scan_ltr.get_fasta_name(fasta_file) + '.json' for fasta_file in self.fasta_files]
+        elif stage == 'queries':
+            if 'duplicates' not in self.checkpoints:
+                return ['extracted_sequences.fa']
+            return ['extracted_sequences.fa', create_fasta_from_json.DUPLICATES_FILE]
+        elif stage == 'blast':
+            return ['blast.out']
+        elif stage == 'filter':
+            return ['blast_no_repeats.out']
+        return ['loci.out']
+
+    def stage_outputs(self, stage):
+        """
+        :return: The files a stage leaves on the disk, or None if it does
+                 not leave enough of them behind to be skipped.
+        """
+        if stage == 'hits' and 'hits' not in self.checkpoints:
+            return None
+        if stage == 'queries' and 'duplicates' not in self.checkpoints:
+            return None
+        return self.stage_files(stage)
+
+    def stage_fingerprints(self):
+        """
+        :return: The fingerprint of every one of STAGES. The FASTA files and
+                 the BLAST database are too large to hash, their size and
+                 modification time are used instead.
+        """
+        import glob
+        fingerprints = {}
+        fingerprints['hits'] = herv_lib.fingerprint(
+            'hits', self.engine, self.patterns or herv_lib.LTR_PATTERNS, NOF_MISMATCHES,
+            process_results.FLANK_LENGTH, process_results.MIN_FLANK_LENGTH,
+            [herv_lib.file_signature(fasta_file) for fasta_file in self.fasta_files])
+        fingerprints['queries'] = herv_lib.fingerprint(
+            'queries', fingerprints['hits'], process_results.FLANK_LENGTH)
+        fingerprints['blast'] = herv_lib.fingerprint(
+            'blast', fingerprints['queries'], self.blast_database,
+            [herv_lib.file_signature(path) for path in sorted(glob.glob(self.blast_database + '*'))])
+        fingerprints['filter'] = herv_lib.fingerprint(
+            'filter', fingerprints['blast'], herv_lib.file_signature(self.repeats_file, content=True),
+            sorted(process_blast_output.FULL_FLANK_MATCH.items()))
+        fingerprints['loci'] = herv_lib.fingerprint('loci', fingerprints['filter'], self.tolerance)
+        return fingerprints
+
+    def run(self):
+        """
+        Run the stages which have changed, and write the run report, even if
+        one of them fails.
+        """
+        try:
+            self.run_stages()
+        finally:
+            self.report.write()
+            for line in self.report.summary():
+                print line
+
+    def run_stages(self):
+        fingerprints = self.stage_fingerprints()
+        recorded = load_fingerprints()
+        self.manifest.set_inputs(self.fasta_files)
+
+        def unchanged(stage):
+            outputs = self.stage_outputs(stage)
+            if self.force or outputs is None or recorded.get(stage) != fingerprints[stage]:
+                return False
+            if not all(os.path.isfile(path) for path in outputs):
+                return False
+            print 'Skipping the', stage, 'stage, nothing it depends on has changed.'
+            return True
+
+        def start(stage):
+            # Until it is done, whatever a stage left behind is not valid.
+            if recorded.pop(stage, None):
+                write_fingerprints(recorded)
+
+        def done(stage):
+            # Only the files the stage did write, which are not always all of stage_files.
+            self.manifest.record(stage, self.written.pop(stage, []))
+            if self.stage_outputs(stage) is not None:
+                recorded[stage] = fingerprints[stage]
+                write_fingerprints(recorded)
+
+        if unchanged('queries'):
+            for name in ['locate', 'extract', 'queries']:
+                self.report.skipped(name)
+            duplicates = process_blast_output.load_duplicates(create_fasta_from_json.DUPLICATES_FILE)
+        else:
+            start('queries')
+            if unchanged('hits'):
+                for name in ['locate', 'extract']:
+                    self.report.skipped(name)
+                with self.report.stage('queries') as queries:
+                    duplicates = self.write_queries(self.load_hits(), stage=queries)
+            else:
+                start('hits')
+                # The three stages run interleaved, every one of them
+                # pulling the hits from the one before it.
+                locate = self.report.stage('locate')
+                extract = self.report.stage('extract', upstream=locate)
+                fasta_indexes = {}
+                try:
+                    records = metrics.meter(self.locate_hits(locate), locate)
+                    records = metrics.meter(self.checkpoint_hits(self.add_sequences(records, fasta_indexes,
+                                                                                    extract)), extract)
+                    with self.report.stage('queries', upstream=extract) as queries:
+                        duplicates = self.write_queries(records, stage=queries)
+                finally:
+                    for fasta_index in fasta_indexes.values():
+                        fasta_index.close()
+                done('hits')
+            done('queries')
+
+        if unchanged('blast'):
+            self.report.skipped('blast')
+        else:
+            start('blast')
+            with self.report.stage('blast') as blast:
+                self.run_blast(stage=blast)
+            done('blast')
+
+        if unchanged('filter'):
+            self.report.skipped('filter')
+        else:
+            start('filter')
+            with self.report.stage('filter') as blast_filter:
+                self.filter_blast_output(duplicates, stage=blast_filter)
+            done('filter')
+
+        if unchanged('loci'):
+            self.report.skipped('loci')
+        else:
+            start('loci')
+            with self.report.stage('loci') as loci:
+                self.cluster_hits(stage=loci)
+            done('loci')
+
+
+def load_fingerprints(path=FINGERPRINTS_FILE):
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as in_file:
+        return json.load(in_file)
+
+
+def write_fingerprints(fingerprints, path=FINGERPRINTS_FILE):
+    with open(path + '.tmp', 'w') as out_file:
+        json.dump(fingerprints, out_file, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def write_hits(fasta_name, hits):
+    """
+    :return: The JSON file the *hits* of *fasta_name* were written to.
+    """
+    json_file = fasta_name + '.json'
+    with open(json_file, 'w') as out_file:
+        # The sequences are copied out of the views of the FASTA files as they are written.
+        json.dump({fasta_name: hits}, out_file, indent=2, separators=(',', ':'), sort_keys=True, default=str)
+    return json_file
+
+
+def main():
+    import argparse
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d',
@@ -31,73 +566,152 @@ def main():
                         required=True,
                         help='Input directory. This is the directory where the FASTA'
                              ' files are located.')
+    parser.add_argument('-g',
+                        '--glob',
+                        nargs='+',
+                        required=False,
+                        help='Glob patterns of the names of the input files, eg: "SRR*.fastq.gz". Default '
+                             'is all of the FASTA and FASTQ files, gzipped or not.')
+    parser.add_argument('-rec',
+                        '--recursive',
+                        default='N',
+                        choices=['Y', 'N'],
+                        type=str,
+                        required=False,
+                        help='Y means that the input files are also looked for in the subdirectories of '
+                             'the input directory. Default is N.')
+    parser.add_argument('-e',
+                        '--engine',
+                        default='fuzznuc',
+                        choices=['fuzznuc', 'native'],
+                        type=str,
+                        required=False,
+                        help='How to locate the LTR sequences. fuzznuc runs the EMBOSS binary, '
+                             'native scans the reads in-process. Default is fuzznuc.')
+    parser.add_argument('-p',
+                        '--pattern',
+                        dest='patterns',
+                        action='append',
+                        type=scan_ltr.parse_pattern,
+                        required=False,
+                        help='LTR pattern to look for, as SEQUENCE:PRIME. Can be repeated to scan '
+                             'for a panel of patterns in one pass. Only available with the native '
+                             'engine. Default is the HERV-K113 5 and 3 prime LTR consensus sequences.')
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        default=1,
+                        type=int,
+                        required=False,
+                        help='Number of worker processes for scanning the FASTA files, parsing '
+                             'the reports and filtering the BLAST output. The results are the same '
+                             'as with a single one. Default is 1.')
+    parser.add_argument('-s',
+                        '--shards',
+                        default=1,
+                        type=int,
+                        required=False,
+                        help='Number of parts every FASTA file is split in, so that the parts of a '
+                             'single large file are scanned in parallel. Only available with the '
+                             'native engine. Default is 1.')
+    parser.add_argument('-S',
+                        '--stream',
+                        default='N',
+                        choices=['Y', 'N'],
+                        type=str,
+                        required=False,
+                        help='Y means that the fuzznuc reports are parsed as fuzznuc produces them, '
+                             'without being written to files. Default is N.')
+    parser.add_argument('-k',
+                        '--keep_reports',
+                        default='N',
+                        choices=['Y', 'N'],
+                        type=str,
+                        required=False,
+                        help='Y means that the fuzznuc reports are also written to files when they '
+                             'are streamed. Default is N.')
+    parser.add_argument('-db',
+                        '--blast_database',
+                        default=DEFAULT_BLAST_DATABASE,
+                        type=str,
+                        required=False,
+                        help='The BLAST database to run the extracted sequences against. Default is '
+                             + DEFAULT_BLAST_DATABASE + '.')
+    parser.add_argument('-r',
+                        '--repeats',
+                        type=str,
+                        required=False,
+                        help='The repeating regions, as written by extract_repeating_regions.py. '
+                             'Default is repeating_regions.idx, or repeating_regions.out if there '
+                             'is no index.')
+    parser.add_argument('-c',
+                        '--checkpoints',
+                        nargs='*',
+                        default=[],
+                        choices=CHECKPOINTS,
+                        required=False,
+                        help='Intermediate results to write to the disk. hits writes the JSON file '
+                             'of every FASTA file, duplicates the ids of the duplicate BLAST queries. '
+                             'Stages can only be skipped on a rerun if their results are written. '
+                             'Default is none.')
+    parser.add_argument('-t',
+                        '--tolerance',
+                        default=cluster_loci.DEFAULT_TOLERANCE,
+                        type=int,
+                        required=False,
+                        help='Largest distance in bases between the consecutive junctions of the hits '
+                             'of an insertion locus. Default is %d.' % cluster_loci.DEFAULT_TOLERANCE)
+    parser.add_argument('-R',
+                        '--report',
+                        default=metrics.RUN_REPORT,
+                        type=str,
+                        required=False,
+                        help='Where to write the time, memory, records and bytes of every stage of the '
+                             'run, in JSON format. Default is %s.' % metrics.RUN_REPORT)
+    parser.add_argument('-m',
+                        '--manifest',
+                        default=herv_lib.RUN_MANIFEST,
+                        type=str,
+                        required=False,
+                        help='Where to record the input files and the files every stage wrote. Default '
+                             'is %s.' % herv_lib.RUN_MANIFEST)
+    parser.add_argument('-f',
+                        '--force',
+                        default='N',
+                        choices=['Y', 'N'],
+                        type=str,
+                        required=False,
+                        help='Y means that all of the stages are run, even the ones which have not '
+                             'changed since the last run. Default is N.')
 
     args = parser.parse_args()
+
     in_dir = args.input_dir
     in_dir = herv_lib.Directory(in_dir)
-    curr_dir = herv_lib.Directory()  # Default is the current directory.
 
-    list_of_fasta_files = in_dir.get_files_with_suffix('FASTA')
+    list_of_fasta_files = in_dir.find_files(args.glob or herv_lib.READ_FILE_PATTERNS, args.recursive == 'Y')
     if not list_of_fasta_files:
-        sys.exit('No *.FASTA files found in the specified folder. Aborting.')
-
-    # First parse the file with fuzznuc looking for the 5prime sequence and
-    # then for the 3prime. Keep the loop structure like this because of disk
-    # buffering.
-    for fasta_file in list_of_fasta_files:
-        for ltr_seq in ['TGTGGGGAAAAGCAAGAGAG', 'AGGGGCAACCCACCCCTACA']:
-            run_fuzznuc.call_fuzznuc(fuzznuc.path,  # Path to the executable
-                                     fasta_file,    # Input file
-                                     '',            # Output file-name
-                                     ltr_seq,       # 3 or 5 prime
-                                     '2',)          # Number of mismatches
-
-    # Update the contents of the directory after fuzznuc is done so that the
-    # fuzznuc files are added to the contents attribute.
-    curr_dir.set_dir_contents()
-
-    list_of_fuzznuc_files = curr_dir.get_files_with_suffix('fuzznuc')
-    if not list_of_fuzznuc_files:
-        sys.exit('No *.fuzznuc files found in the specified folder. Aborting.')
-
-    for fuzznuc_file in list_of_fuzznuc_files:
-        results = process_results.parse_report(fuzznuc_file)
-        process_results.write_json(results)
-
-    subprocess.call(['python',
-                     'extract_sequences.py',
-                     '-fasta',
-                     in_dir.path])
-
-    # Create the extract_sequences.fa file.
-    curr_dir.set_dir_contents()
-    list_of_json_files = curr_dir.get_files_with_suffix('json')
-    if not list_of_json_files:
-        sys.exit('No json files found in the specified directory. Aborting.')
-
-    json_files = extract_sequences.load_json(list_of_json_files)
-    processed_json = create_fasta_from_json.extract_from_json(json_files)
-    create_fasta_from_json.write_to_file(processed_json)
-
-    # Run blast.
-    subprocess.call([
-        'python', 'run_blast.py',
-        '-db', '/scratch/pk3414/Homo_sapiens.GRCh38.dna.toplevel.fa',
-        '-seq', 'extracted_sequences.fa'
-    ])
-
-    # Process the repetitive regions file and store it in JSON. Requires the
-    # file with the RepeatMasker regions in TSV format. Only run this the first
-    # time you obtain the repeat regions file from UCSC.
-    # subprocess.call([
-    #     'python', 'extract_repeating_regions.py',
-    #     '-i', 'repeating_regions'
-    # ])
-
-    # Filter out the blast hits in the repetitive regions. Requires the file
-    # from the previous step in JSON format.
-    repeats = process_blast_output.load_repeating_regions('repeating_regions.out')
-    process_blast_output.process_blast_output('blast.out', repeats)
+        sys.exit('No ' + ' or '.join(args.glob or herv_lib.READ_FILE_PATTERNS) +
+                 ' files found in the specified folder. Aborting.')
+
+    try:
+        pipeline = Pipeline(list_of_fasta_files,
+                            engine=args.engine,
+                            patterns=args.patterns,
+                            jobs=args.jobs,
+                            shards=args.shards,
+                            stream=args.stream == 'Y',
+                            keep_reports=args.keep_reports == 'Y',
+                            blast_database=args.blast_database,
+                            repeats_file=args.repeats,
+                            checkpoints=args.checkpoints,
+                            force=args.force == 'Y',
+                            report_file=args.report,
+                            manifest_file=args.manifest,
+                            tolerance=args.tolerance)
+        pipeline.run()
+    except (ValueError, RuntimeError) as error:
+        sys.exit(str(error) + ' Aborting.')
 
 
 if __name__ == '__main__':
@@ -5,14 +5,56 @@ This module processes the blast output in order to extract the useful
 information and store it in an easily accessible format.
 """
 
+import os
 import json
-import csv
+import shutil
+import operator
+import itertools
+import herv_lib
+from repeat_index import RepeatIndex, intervals_overlap, is_index_file, load_index
 
 
 def load_repeating_regions(rep_file_name):
+    # Either the binary index or the JSON dump of extract_repeating_regions.
+    if is_index_file(rep_file_name):
+        return load_index(rep_file_name)
     with open(rep_file_name) as in_file:
         repeating_regions = json.load(in_file)
-    return repeating_regions
+    return RepeatIndex(repeating_regions)
+
+
+def load_duplicates(duplicates_file):
+    """
+    :return: The ids of the queries with the same sequence by the id of the
+             one which was run through BLAST, as create_fasta_from_json.py
+             writes them.
+    """
+    with open(duplicates_file) as in_file:
+        duplicates = json.load(in_file)
+    return dict((str(query_id), [str(duplicate) for duplicate in duplicate_ids])
+                for query_id, duplicate_ids in duplicates.items())
+
+
+def expand_duplicates(lines, duplicates):
+    """
+    Give the hits of every deduplicated query to all of the queries with the
+    same sequence. The lines of a query are replaced by one copy of them per
+    query, in the order the queries were in before they were deduplicated.
+
+    :param lines: Lines of BLAST output, as filter_blast_chunk returns them.
+    :param duplicates: Dictionary returned by load_duplicates.
+    :return: The lines with the duplicates added.
+    """
+    if not duplicates:
+        return lines
+    expanded = []
+    for line in lines:
+        query_id, rest = line.split('\t', 1)
+        if query_id in duplicates:
+            expanded.extend(duplicate + '\t' + rest for duplicate in duplicates[query_id])
+        else:
+            expanded.append(line)
+    return expanded
 
 
 def format_blast_output_in_dict(blast_output):
@@ -93,49 +135,205 @@ def filter_by_query_length(prime, strand, start, end):
         raise RuntimeError('Unexpected combination of strand and prime.')
 
 
-def process_blast_output(file_name, repeats):
-    # Decrease the writing frequency.
-    with open(file_name) as in_file, open('blast_no_repeats.out', 'w') as out_file:
-        lines = csv.reader(in_file, delimiter='\t')
-        processed_blast_output = []
-        for line in lines:
-            formatted_output = format_blast_output_in_dict(line)
-            chromosome = formatted_output['chromosome']
-
-            # Parse the query id in order to extract strand and prime
-            query_id = formatted_output['query_id']
-            query_id = query_id.split('.')
-            prime, strand = query_id[2:]
-
-            # Get only the hits that have fully matched the flanking sequence
-            q_start = int(formatted_output['query_start'])
-            q_end = int(formatted_output['query_end'])
-
-            try:
-                if filter_by_query_length(prime, strand, q_start, q_end):
-                    if chromosome in repeats:
-                        repeats_for_chromosome = repeats[chromosome]
-                        if not non_recursive_binary_search_of_repeats(repeats_for_chromosome, formatted_output):
-                            processed_blast_output.append('\t'.join(line))
-                    else:
-                        processed_blast_output.append('\t'.join(line))
-            except RuntimeError as e:
-                print ' ', e, 'Query id is', '.'.join(query_id)
-
-            if len(processed_blast_output) == 1000:
-                write_valid_hits(processed_blast_output, out_file)
-                processed_blast_output = []
-        if len(processed_blast_output):
-            write_valid_hits(processed_blast_output, out_file)
+# The query coordinates a hit must span to have fully matched the flanking
+# sequence, by (prime, strand). The same rule as filter_by_query_length.
+FULL_FLANK_MATCH = {
+    ('5_prime', 'forward'): (1, 50),
+    ('3_prime', 'reverse'): (1, 50),
+    ('5_prime', 'reverse'): (21, 70),
+    ('3_prime', 'forward'): (21, 70),
+}
+
+CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def normalise_chromosome(chromosome):
+    # Same as format_blast_output_in_dict.
+    return 'chr' + chromosome if len(chromosome) <= 2 else chromosome
+
+
+def filter_blast_chunk(chunk, repeats, query_rules=None, chromosomes=None):
+    """
+    Filter a chunk of BLAST output. The chunk is split in columns and every
+    rule is applied to whole columns at a time: the query length rule, the
+    chromosome normalisation and, in one batch, the repeat overlap test.
+
+    :param chunk: A string of whole lines of BLAST output, in outfmt 6.
+    :param repeats: RepeatIndex of the repeating regions.
+    :param query_rules: Cache of the FULL_FLANK_MATCH rule of every query id,
+                        shared between the chunks of a file.
+    :param chromosomes: Cache of the normalised chromosome names.
+    :return: The lines which pass all of the filters, in order.
+    """
+    if query_rules is None:
+        query_rules = {}
+    if chromosomes is None:
+        chromosomes = {}
+
+    lines = chunk.replace('\r', '').rstrip('\n').split('\n')
+    if not lines[0]:
+        return []
+    # The columns can only be sliced out of the fields of the whole chunk if
+    # every line has as many of them.
+    nof_tabs = set(map(operator.methodcaller('count', '\t'), lines))
+    if len(nof_tabs) != 1 or min(nof_tabs) < 11:
+        # Lines with a different number of columns, fall back to splitting
+        # them one by one and dropping the incomplete ones.
+        rows = [row for row in (line.split('\t') for line in lines) if len(row) >= 12]
+        lines = ['\t'.join(row) for row in rows]
+        columns = zip(*rows) if rows else [()] * 12
+    else:
+        # Every nth field is a column.
+        nof_columns = nof_tabs.pop() + 1
+        fields = '\t'.join(lines).split('\t')
+        columns = [fields[column::nof_columns] for column in xrange(12)]
+
+    query_ids, query_starts, query_ends = columns[0], columns[6], columns[7]
+    for query_id in set(query_ids):
+        if query_id not in query_rules:
+            prime, strand = query_id.split('.')[2:]
+            rule = FULL_FLANK_MATCH.get((prime, strand))
+            if rule is None:
+                print ' ', 'Unexpected combination of strand and prime.', 'Query id is', query_id
+            else:
+                rule = (str(rule[0]), str(rule[1]))
+            query_rules[query_id] = rule
+
+    for chromosome in set(columns[1]):
+        if chromosome not in chromosomes:
+            chromosomes[chromosome] = normalise_chromosome(chromosome)
+
+    # The coordinates are only converted to integers for the hits which
+    # passed the query length rule.
+    matches = map(operator.eq, map(query_rules.__getitem__, query_ids), zip(query_starts, query_ends))
+    full_matches = list(itertools.compress(xrange(len(matches)), matches))
+
+    if not full_matches:
+        return []
+    subject_starts = map(int, map(columns[8].__getitem__, full_matches))
+    subject_ends = map(int, map(columns[9].__getitem__, full_matches))
+    subject_chromosomes = map(chromosomes.__getitem__, map(columns[1].__getitem__, full_matches))
+    in_repeats = repeats.overlaps_columns(subject_chromosomes, map(min, subject_starts, subject_ends),
+                                          map(max, subject_starts, subject_ends))
+    return [lines[position] + '\n'
+            for position in itertools.compress(full_matches, map(operator.not_, in_repeats))]
+
+
+def iter_chunks(in_file, chunk_size=CHUNK_SIZE, end=None):
+    """
+    Generator over chunks of about *chunk_size* bytes of *in_file*, each one
+    made up of whole lines, from the current position up to the byte offset
+    *end*, which has to be at the start of a line. Default is the end of the file.
+    """
+    position = in_file.tell()
+    while end is None or position < end:
+        size = chunk_size if end is None else min(chunk_size, end - position)
+        chunk = in_file.read(size)
+        if not chunk:
+            break
+        if not chunk.endswith('\n'):
+            chunk += in_file.readline()
+        position += len(chunk)
+        yield chunk
+
+
+# The repeats the worker processes check the hits against and the duplicate
+# queries. They are set before the workers are started, so that the workers
+# inherit them instead of every task receiving a pickled copy.
+worker_repeats = None
+worker_duplicates = None
+
+
+def filter_blast_range(task):
+    """
+    Filter the lines of a BLAST output file between two byte offsets and
+    write the ones which pass to a file of their own.
+
+    :param task: (BLAST output file, start, end, output file) tuple.
+    :return: (output file, number of lines read, number of lines written) tuple.
+    """
+    file_name, start, end, out_file_name = task
+    query_rules, chromosomes = {}, {}
+    nof_lines, nof_hits = 0, 0
+    with open(file_name) as in_file, open(out_file_name, 'w') as out_file:
+        in_file.seek(start)
+        for chunk in iter_chunks(in_file, CHUNK_SIZE, end):
+            lines = expand_duplicates(filter_blast_chunk(chunk, worker_repeats, query_rules, chromosomes),
+                                      worker_duplicates)
+            out_file.writelines(lines)
+            nof_lines += chunk.count('\n')
+            nof_hits += len(lines)
+    return out_file_name, nof_lines, nof_hits
+
+
+def process_blast_output(file_name, repeats, out_file_name='blast_no_repeats.out', chunk_size=CHUNK_SIZE,
+                         jobs=1, duplicates=None, stats=None, progress=None):
+    """
+    Write the hits of *file_name* which fully match the flanking sequence and
+    do not overlap any of the *repeats*, a RepeatIndex or the dictionary of
+    regions it is built from, to *out_file_name* in their original order.
+    The input is read and filtered in chunks of about *chunk_size* bytes.
+
+    With more than one of *jobs* the file is split in ranges of whole lines,
+    which are filtered by a pool of worker processes, and their results are
+    joined in the original order.
+
+    If *duplicates*, as returned by load_duplicates, are given the hits of
+    every deduplicated query are written once for each of its duplicates.
+
+    If *stats* is given the number of lines read and written are added to
+    its 'lines' and 'hits' keys. If *progress* is given it is called with the
+    number of bytes filtered and the size of the file every so often.
+    """
+    global worker_repeats, worker_duplicates
+    if not isinstance(repeats, RepeatIndex):
+        repeats = RepeatIndex(repeats)
+    if stats is None:
+        stats = {}
+    stats.setdefault('lines', 0)
+    stats.setdefault('hits', 0)
+    file_size = os.path.getsize(file_name)
+
+    if jobs > 1:
+        # A few ranges per worker, so that a slow range does not hold
+        # everything up.
+        ranges = herv_lib.shard_file(file_name, jobs * 4, boundary='')
+        tasks = [(file_name, start, end, '%s.part%d' % (out_file_name, index))
+                 for index, (start, end) in enumerate(ranges)]
+        worker_repeats, worker_duplicates = repeats, duplicates
+        try:
+            range_progress = None
+            if progress:
+                # Report the bytes of the ranges done rather than their number.
+                range_progress = lambda done, total: progress(ranges[done - 1][1] if done else 0, file_size)
+            parts = herv_lib.map_jobs(filter_blast_range, tasks, jobs, range_progress)
+        finally:
+            worker_repeats, worker_duplicates = None, None
+
+        with open(out_file_name, 'wb') as out_file:
+            for part_file, nof_lines, nof_hits in parts:
+                with open(part_file, 'rb') as in_file:
+                    shutil.copyfileobj(in_file, out_file)
+                os.remove(part_file)
+                stats['lines'] += nof_lines
+                stats['hits'] += nof_hits
+        return
+
+    query_rules, chromosomes = {}, {}
+    with open(file_name) as in_file, open(out_file_name, 'w') as out_file:
+        for chunk in iter_chunks(in_file, chunk_size):
+            lines = expand_duplicates(filter_blast_chunk(chunk, repeats, query_rules, chromosomes), duplicates)
+            out_file.writelines(lines)
+            stats['lines'] += chunk.count('\n')
+            stats['hits'] += len(lines)
+            if progress:
+                progress(in_file.tell(), file_size)
 
 
 def hit_in_repeating_region(hit_start, hit_end, repeat_start, repeat_end):
-    if repeat_start < hit_start < repeat_end:
-        return True
-    elif repeat_start > hit_end > repeat_end:
-        return True
-    else:
-        return False
+    # Any overlap between the hit and the region, including a hit which
+    # contains the region. See repeat_index for the coordinate conventions.
+    return intervals_overlap(hit_start, hit_end, repeat_start, repeat_end)
 
 
 def write_valid_hits(hits, out_file):
@@ -155,18 +353,34 @@ def main():
                         '--repeats_input_file',
                         type=str,
                         required=True,
-                        help='Input file. Must be in JSON format.')
+                        help='Input file. Either the binary index or the JSON file written '
+                             'by extract_repeating_regions.py.')
     parser.add_argument('-o',
                         '--output_file',
                         type=str,
                         required=False,
                         help='The name of the file where the results will be printed.')
+    parser.add_argument('-j',
+                        '--jobs',
+                        default=1,
+                        type=int,
+                        required=False,
+                        help='Number of worker processes to filter the BLAST output with. '
+                             'Default is 1.')
+    parser.add_argument('-d',
+                        '--duplicates',
+                        type=str,
+                        required=False,
+                        help='The duplicate queries, as written by create_fasta_from_json.py. Their '
+                             'hits are written once for every one of them.')
 
     args = parser.parse_args()
     input_file, output_file, repeats_file = args.blast_input_file, args.output_file, args.repeats_input_file
 
     repeats = load_repeating_regions(repeats_file)
-    process_blast_output(input_file, repeats)
+    duplicates = load_duplicates(args.duplicates) if args.duplicates else None
+    process_blast_output(input_file, repeats, output_file or 'blast_no_repeats.out', jobs=args.jobs,
+                         duplicates=duplicates)
 
 if __name__ == '__main__':
     main()
@@ -10,57 +10,112 @@ files.
 
 """
 import re
-import copy
 import json
+import herv_lib
 
+# How much of the sequence next to the LTR is extracted, and how much there
+# has to be at least for a hit to be valid.
+FLANK_LENGTH = 50
+MIN_FLANK_LENGTH = 20
 
-def parse_report(path_to_file):
-    hits = {}
-    which_prime = ''
 
-    try:
-        which_prime = determine_prime(path_to_file)
-    except UserWarning:
-        print ('The provided file does not seem to contain the 3 or the 5 prime'
-               ' LTR sequence. Aborting.')
+def iter_report(report, stats=None):
+    """
+    Generator over the hits of a fuzznuc report, in the simple format. Each
+    line is dispatched on its prefix and only the sequence headers go
+    through a regular expression, so that the memory used does not depend on
+    the size of the report.
 
-    # Define the regular expressions to be used in the parsing of the document.
+    :param report: Path to the report, or an open file object to read it from.
+    :type report: str or unicode or file
+    :param stats: If given, the number of lines read, the number of valid hits
+                  and the seconds spent are added to its 'lines', 'hits' and
+                  'seconds' keys.
+    :type stats: dict
+    :return: Yields (hit id, hit) tuples for the hits which pass
+             check_hit, one sequence at a time. As before, only the last
+             feature of a sequence is considered.
+    """
+    import time
     seq_re = re.compile(r'# Sequence:\s*(\S+)\s*from: (\S+)\s*to: (\S+)')
-    start_re = re.compile(r'^Start: (\S+)')
-    end_re = re.compile(r'^End: (\S+)')
-    strand_re = re.compile(r'^Strand: (\S+)')
-    mismatch_re = re.compile(r'^Mismatch: (\S+)')
+    pattern_re = re.compile(r'#\s*-pattern\s*(\S+)')
+    fields = {
+        'Start:': 'LTR_from',
+        'End:': 'LTR_to',
+        'Strand:': 'strand',
+        'Mismatch:': 'mismatch',
+    }
 
-    with open(path_to_file) as in_file:
-        current_id = False
+    start_time = time.time()
+    nof_lines, nof_hits = 0, 0
+    which_prime = None
+    current_id, current_hit = None, None
+
+    in_file = open(report) if isinstance(report, basestring) else report
+    try:
         for line in in_file:
-            line = line.rstrip()
+            nof_lines += 1
+            if line.startswith('#'):
+                if line.startswith('# Sequence:'):
+                    if current_id:
+                        valid_hit = check_hit(current_hit, which_prime)
+                        if valid_hit:
+                            nof_hits += 1
+                            yield current_id, valid_hit
+
+                    seq_match = seq_re.match(line)
+                    if which_prime is None:
+                        which_prime = ''
+                        print ('The provided file does not seem to contain the 3 or the 5 prime'
+                               ' LTR sequence. Aborting.')
+                    current_id = seq_match.group(1).split('_')[-1] + '.' + which_prime
+                    current_hit = {'read_length': seq_match.group(3), 'prime': which_prime}
+                elif which_prime is None and '-pattern' in line:
+                    pattern_match = pattern_re.search(line)
+                    if pattern_match:
+                        try:
+                            which_prime = prime_of_pattern(pattern_match.group(1))
+                        except UserWarning:
+                            which_prime = ''
+                            print ('The provided file does not seem to contain the 3 or the 5 prime'
+                                   ' LTR sequence. Aborting.')
+            elif current_id:
+                prefix = line[:line.find(':') + 1]
+                if prefix in fields:
+                    words = line[len(prefix):].split()
+                    if words:
+                        current_hit[fields[prefix]] = words[0]
+
+        if current_id:
+            valid_hit = check_hit(current_hit, which_prime)
+            if valid_hit:
+                nof_hits += 1
+                yield current_id, valid_hit
+    finally:
+        if in_file is not report:
+            in_file.close()
+        if stats is not None:
+            stats['lines'] = stats.get('lines', 0) + nof_lines
+            stats['hits'] = stats.get('hits', 0) + nof_hits
+            stats['seconds'] = stats.get('seconds', 0.0) + time.time() - start_time
 
-            # TODO: SORT OUT THE UGLY STRING CONCATENATIONS
-            seq_match = seq_re.search(line)
-            if seq_match:
-                current_id = seq_match.group(1).split('_')[-1] + '.' + which_prime
-                hits[current_id] = {}
-                hits[current_id]['read_length'] = seq_match.group(3)
-                hits[current_id]['prime'] = which_prime
 
-            start_match = start_re.search(line)
-            if current_id and start_match:
-                hits[current_id]['LTR_from'] = start_match.group(1)
+def lines_per_second(stats):
+    if not stats.get('seconds'):
+        return 0.0
+    return stats['lines'] / stats['seconds']
 
-            end_match = end_re.search(line)
-            if current_id and end_match:
-                hits[current_id]['LTR_to'] = end_match.group(1)
 
-            strand_match = strand_re.search(line)
-            if current_id and strand_match:
-                hits[current_id]['strand'] = strand_match.group(1)
+def report_fasta_name(path_to_file):
+    fasta_name = path_to_file.split('.')[0]
+    return fasta_name.split('/')[-1]
+
 
-            mismatch_match = mismatch_re.search(line)
-            if current_id and mismatch_match:
-                hits[current_id]['mismatch'] = mismatch_match.group(1)
+def parse_report(path_to_file, stats=None):
+    valid_hits = {}
+    for hit_id, hit in iter_report(path_to_file, stats):
+        valid_hits[hit_id] = hit
 
-    valid_hits = check_results(hits, which_prime)
     # Add another level to the json object so that the original FASTA file
     # is included as the top level header.
     # The hierarchy of the object is like this:
@@ -71,88 +126,173 @@ def parse_report(path_to_file):
     #   }
     # }
     #
-    fasta_name = path_to_file.split('.')[0]
-    fasta_name = fasta_name.split('/')[-1]
-
     results_dict = {
-        fasta_name: valid_hits
+        report_fasta_name(path_to_file): valid_hits
     }
 
     return results_dict
 
 
-def write_json(results_dict):
-    from os import listdir
-    # Check if there is a json file which contains the top level key.
-    # If there is extend that one instead of creating a new one.
-    fasta_name = results_dict.keys()[0]
-    if fasta_name + '.json' in listdir('.'):
-        with open(fasta_name + '.json', 'r+') as in_out_file:
-            previous_results_dict = json.load(in_out_file)
-            results_dict[fasta_name].update(previous_results_dict[fasta_name])
-            in_out_file.seek(0)
-            json.dump(results_dict, in_out_file, indent=2, separators=(',', ':'))
-            in_out_file.truncate()
-    else:
-        with open(fasta_name + '.json', 'w') as in_out_file:
-            json.dump(results_dict, in_out_file, indent=2, separators=(',', ':'))
+def write_segment(hits, segment_path):
+    """
+    Write *hits*, an iterable of (hit id, hit) tuples such as the one
+    iter_report returns, to a segment of the results log of a FASTA file.
+    Segments are JSON Lines files, with one [hit id, hit] pair per line, and
+    are written once. compact_segments merges them in the JSON file.
+
+    :return: The number of hits written.
+    """
+    nof_hits = 0
+    with open(segment_path, 'w') as out_file:
+        for hit_id, hit in hits:
+            out_file.write(json.dumps([hit_id, hit], separators=(',', ':'), sort_keys=True) + '\n')
+            nof_hits += 1
+    return nof_hits
+
+
+def report_to_segment(path_to_file, report=None, stats=None):
+    """
+    Stream the hits of a fuzznuc report to a segment named after the report.
+
+    :param report: The lines of the report, if they are not to be read from
+                   *path_to_file*, eg: as run_fuzznuc.stream_fuzznuc yields them.
+    :type report: iterable
+    :param stats: Passed on to iter_report.
+    :type stats: dict
+    :return: (FASTA name, segment path) tuple.
+    """
+    from os.path import basename
+    segment_path = basename(path_to_file) + '.jsonl'
+    write_segment(iter_report(path_to_file if report is None else report, stats), segment_path)
+    return report_fasta_name(path_to_file), segment_path
+
+
+def iter_segment(segment_path):
+    """
+    :return: Yields the (hit id, hit) tuples of a segment, in the order they
+             were written, with the ids and the values of the hits as str.
+    """
+    with open(segment_path) as in_file:
+        for line in in_file:
+            hit_id, hit = json.loads(line)
+            yield str(hit_id), dict((str(key), str(value)) for key, value in hit.items())
+
+
+def iter_segments(segment_paths):
+    """
+    Lazily merged view of the segments of a FASTA file. When a hit id occurs
+    more than once the first occurrence is kept, the same way compact_segments
+    keeps the hits already in the JSON file.
+
+    :return: Yields (hit id, hit) tuples.
+    """
+    seen = set()
+    for segment_path in segment_paths:
+        for hit_id, hit in iter_segment(segment_path):
+            if hit_id not in seen:
+                seen.add(hit_id)
+                yield hit_id, hit
+
+
+def compact_segments(fasta_name, segment_paths, remove=True):
+    """
+    Merge the segments of a FASTA file, in order, in <fasta name>.json. The
+    JSON file is written once, however many parts the FASTA file was split
+    in. The hits of a JSON file which is already there come first.
+    """
+    import os
+    json_path = fasta_name + '.json'
+    results_dict = {fasta_name: {}}
+    if os.path.isfile(json_path):
+        with open(json_path) as in_file:
+            results_dict[fasta_name] = json.load(in_file)[fasta_name]
+
+    hits = results_dict[fasta_name]
+    for hit_id, hit in iter_segments(segment_paths):
+        hits.setdefault(hit_id, hit)
+
+    with open(json_path, 'w') as out_file:
+        json.dump(results_dict, out_file, indent=2, separators=(',', ':'), sort_keys=True)
+
+    if remove:
+        for segment_path in segment_paths:
+            os.remove(segment_path)
 
 
 def check_results(hits, prime):
     valid_hits = {}
     for hit in hits:
-        length = int(hits[hit]['read_length'])
-        ltr_from = int(hits[hit]['LTR_from'])
-        ltr_to = int(hits[hit]['LTR_to'])
-        strand = hits[hit]['strand']
-
-        # If the results contain hits of the 5-prime LTR then the
-        # sequence that has to be extracted is to the left of the
-        # input, whereas 3-prime sequence has to be extracted from
-        # the right. These numbers are 1-indexed.
-
-        # Use the copy module to avoid the valid_hits referencing the original.
-        if strand == '+':
-            if prime == '5_prime' and (ltr_from - 1) >= 20:
-                valid_hits[hit] = copy.copy(hits[hit])
-                valid_hits[hit]['seq_to'] = str(ltr_from)
-                if (ltr_from - 1) >= 50:
-                    # Get 50bp to the left of the LTR point of origin
-                    seq_from = ltr_from - 50
-                    valid_hits[hit]['seq_from'] = str(seq_from)
-                else:
-                    valid_hits[hit]['seq_from'] = str(1)
-            elif prime == '3_prime' and (length - ltr_to) >= 20:
-                valid_hits[hit] = copy.copy(hits[hit])
-                valid_hits[hit]['seq_from'] = str(ltr_to)
-                if (length - ltr_to) >= 50:
-                    # get 50bp to the right of the LTR
-                    seq_to = ltr_to + 50
-                    valid_hits[hit]['seq_to'] = str(seq_to)
-                else:
-                    valid_hits[hit]['seq_to'] = str(length)
-        else:
-            if prime == '5_prime' and (length - ltr_to) >= 20:
-                valid_hits[hit] = copy.copy(hits[hit])
-                valid_hits[hit]['seq_from'] = str(ltr_to)
-                if (length - ltr_to) >= 50:
-                    # Get 50bp to the right of the LTR end
-                    seq_to = ltr_to + 50
-                    valid_hits[hit]['seq_to'] = str(seq_to)
-                else:
-                    valid_hits[hit]['seq_to'] = str(length)
-            elif prime == '3_prime' and (ltr_from - 1) >= 20:
-                valid_hits[hit] = copy.copy(hits[hit])
-                valid_hits[hit]['seq_to'] = str(ltr_from)
-                if (ltr_from - 1) >= 50:
-                    # get 50bp to the left of the LTR
-                    seq_from = ltr_from - 50
-                    valid_hits[hit]['seq_from'] = str(seq_from)
-                else:
-                    valid_hits[hit]['seq_from'] = str(1)
+        valid_hit = check_hit(hits[hit], prime)
+        if valid_hit:
+            valid_hits[hit] = valid_hit
     return valid_hits
 
 
+def check_hit(hit, prime):
+    """
+    Check that there is enough sequence next to the LTR of a hit and work
+    out which part of the read to extract.
+
+    :return: A copy of *hit* with seq_from and seq_to added, or None if the
+             hit is not valid.
+    """
+    if 'LTR_from' not in hit:
+        # fuzznuc did not report any features for this sequence.
+        return None
+
+    length = int(hit['read_length'])
+    ltr_from = int(hit['LTR_from'])
+    ltr_to = int(hit['LTR_to'])
+    strand = hit['strand']
+
+    # If the results contain hits of the 5-prime LTR then the
+    # sequence that has to be extracted is to the left of the
+    # input, whereas 3-prime sequence has to be extracted from
+    # the right. These numbers are 1-indexed.
+
+    # Copy the hit to avoid the valid hit referencing the original.
+    valid_hit = None
+    if strand == '+':
+        if prime == '5_prime' and (ltr_from - 1) >= MIN_FLANK_LENGTH:
+            valid_hit = dict(hit)
+            valid_hit['seq_to'] = str(ltr_from)
+            if (ltr_from - 1) >= FLANK_LENGTH:
+                # Get 50bp to the left of the LTR point of origin
+                seq_from = ltr_from - FLANK_LENGTH
+                valid_hit['seq_from'] = str(seq_from)
+            else:
+                valid_hit['seq_from'] = str(1)
+        elif prime == '3_prime' and (length - ltr_to) >= MIN_FLANK_LENGTH:
+            valid_hit = dict(hit)
+            valid_hit['seq_from'] = str(ltr_to)
+            if (length - ltr_to) >= FLANK_LENGTH:
+                # get 50bp to the right of the LTR
+                seq_to = ltr_to + FLANK_LENGTH
+                valid_hit['seq_to'] = str(seq_to)
+            else:
+                valid_hit['seq_to'] = str(length)
+    else:
+        if prime == '5_prime' and (length - ltr_to) >= MIN_FLANK_LENGTH:
+            valid_hit = dict(hit)
+            valid_hit['seq_from'] = str(ltr_to)
+            if (length - ltr_to) >= FLANK_LENGTH:
+                # Get 50bp to the right of the LTR end
+                seq_to = ltr_to + FLANK_LENGTH
+                valid_hit['seq_to'] = str(seq_to)
+            else:
+                valid_hit['seq_to'] = str(length)
+        elif prime == '3_prime' and (ltr_from - 1) >= MIN_FLANK_LENGTH:
+            valid_hit = dict(hit)
+            valid_hit['seq_to'] = str(ltr_from)
+            if (ltr_from - 1) >= FLANK_LENGTH:
+                # get 50bp to the left of the LTR
+                seq_from = ltr_from - FLANK_LENGTH
+                valid_hit['seq_from'] = str(seq_from)
+            else:
+                valid_hit['seq_from'] = str(1)
+    return valid_hit
+
+
 def determine_prime(path_to_file, pattern=''):
     pattern_re = re.compile(r'#\s*-pattern\s*(\S+)')
     with open(path_to_file) as in_file:
@@ -162,12 +302,14 @@ def determine_prime(path_to_file, pattern=''):
             if pattern_match:
                 pattern = pattern_match.group(1)
                 break
-    if pattern == 'AGGGGCAACCCACCCCTACA':
-        return '3_prime'
-    elif pattern == 'TGTGGGGAAAAGCAAGAGAG':
-        return '5_prime'
-    else:
-        raise UserWarning('The pattern is not the 5 or the 3 prime LTR.')
+    return prime_of_pattern(pattern)
+
+
+def prime_of_pattern(pattern):
+    for ltr_pattern, prime in herv_lib.LTR_PATTERNS:
+        if pattern == ltr_pattern:
+            return prime
+    raise UserWarning('The pattern is not the 5 or the 3 prime LTR.')
 
 
 def main():
@@ -175,15 +317,38 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('-i',
                         '--input',
+                        nargs='+',
                         type=str,
                         required=True,
-                        help='Input file. Must be in fuzznuc simple format.')
+                        help='Input files. Must be in fuzznuc simple format. The reports of the same '
+                             'FASTA file are merged in a single output file.')
+    parser.add_argument('-f',
+                        '--format',
+                        default='json',
+                        choices=['json', 'hits'],
+                        type=str,
+                        required=False,
+                        help='Format of the output file. hits is the compact binary format of '
+                             'hit_store.py. Default is json.')
 
     args = parser.parse_args()
-    input_file = args.input
 
-    results = parse_report(input_file)
-    write_json(results)
+    # Every report is streamed to a segment, and the output file of every
+    # FASTA file is written once, with the hits of all of its reports.
+    stats = {}
+    segments = {}
+    for input_file in args.input:
+        fasta_name, segment_path = report_to_segment(input_file, stats=stats)
+        segments.setdefault(fasta_name, []).append(segment_path)
+    for fasta_name in sorted(segments):
+        if args.format == 'hits':
+            import hit_store
+            hit_store.compact_segments(fasta_name, segments[fasta_name])
+        else:
+            compact_segments(fasta_name, segments[fasta_name])
+    print 'Parsed', stats['lines'], 'lines at', '%.0f' % lines_per_second(stats), 'lines/second,', \
+        stats['hits'], 'valid hits.'
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,284 @@
+__author__ = 'Panagiotis Koukos'
+
+"""
+repeat_index.py - Overlap queries against the repeating regions.
+
+This module indexes the repeating regions of every chromosome so that BLAST
+hits can be checked against them correctly and in batches. The regions are
+kept sorted by their start along with the running maximum of their ends,
+which is what allows long or nested regions to be found by a binary search.
+
+The regions follow the UCSC convention (0-based start, end excluded) and the
+hits the BLAST one (1-based, both ends included).
+
+An index can be stored in a compact binary file, whose columns are read
+straight into arrays when it is loaded, without being parsed. The layout of
+the file is:
+    header: magic, version, number of chromosomes.
+    directory: name, offset and number of regions of every chromosome.
+    regions: the starts and then the ends of every chromosome, as 32 bit integers.
+Regions which overlap or touch are merged before being stored, so that the
+stored regions do not overlap each other.
+
+:param -r, --repeats: The repeating regions, as written by extract_repeating_regions.py.
+:type -r, --repeats: str or unicode
+:param -b, --blast: BLAST output to time the old and the new overlap queries on.
+:type -b, --blast: str or unicode
+:return None
+"""
+
+import sys
+import struct
+import itertools
+from array import array
+from bisect import bisect_left
+
+MAGIC = 'HERVREPS'
+VERSION = 1
+HEADER = struct.Struct('<8sHxxI')
+CHROMOSOME = struct.Struct('<32sQQ')
+
+
+def intervals_overlap(hit_start, hit_end, repeat_start, repeat_end):
+    return repeat_start < hit_end and hit_start <= repeat_end
+
+
+class RepeatIndex(object):
+    """
+    Models the repeating regions of the genome as an interval index.
+    Those properties are:
+        starts: dict, Array of the region starts of every chromosome, sorted.
+        ends: dict, Array of the region ends, in the same order as the starts.
+        max_ends: dict, Array of the largest end up to and including every
+                  region, in the same order as the starts.
+    """
+
+    def __init__(self, regions=None):
+        """
+        Returns a RepeatIndex of *regions*, a dictionary of [start, end]
+        lists by chromosome as extract_repeating_regions.py writes it. The
+        coordinates can be either strings or integers, in any order.
+        """
+        self.starts = {}
+        self.ends = {}
+        self.max_ends = {}
+        for chromosome in regions or {}:
+            intervals = sorted((int(start), int(end)) for start, end in regions[chromosome])
+            self.add_chromosome(chromosome,
+                                array('l', [start for start, end in intervals]),
+                                array('l', [end for start, end in intervals]))
+
+    def add_chromosome(self, chromosome, starts, ends, disjoint=False):
+        """
+        Add the regions of a chromosome, as arrays of starts and ends sorted
+        by start. If the regions are known to be *disjoint*, eg: after
+        merge_intervals, their ends are already sorted and are used as is.
+        """
+        if disjoint:
+            max_ends = ends
+        else:
+            max_ends = array(ends.typecode, ends)
+            for index in xrange(1, len(max_ends)):
+                if max_ends[index] < max_ends[index - 1]:
+                    max_ends[index] = max_ends[index - 1]
+        self.starts[chromosome] = starts
+        self.ends[chromosome] = ends
+        self.max_ends[chromosome] = max_ends
+
+    def __contains__(self, chromosome):
+        return chromosome in self.starts
+
+    def overlaps(self, chromosome, hit_start, hit_end):
+        """
+        :return: True if the hit overlaps any of the regions of *chromosome*.
+        """
+        if chromosome not in self.starts:
+            return False
+        # The last region which starts before the end of the hit. The hit
+        # overlaps a region if any of the regions up to that one ends after
+        # the start of the hit.
+        index = bisect_left(self.starts[chromosome], hit_end) - 1
+        return index >= 0 and self.max_ends[chromosome][index] >= hit_start
+
+    def overlaps_batch(self, chromosome, hit_starts, hit_ends):
+        """
+        Same as overlaps, for a whole batch of hits on the same chromosome.
+        The regions of the chromosome are looked up once for the batch and
+        every hit is bisected into them, so a batch takes time logarithmic
+        in the number of regions per hit however far apart its hits are.
+
+        :return: A list with True for every hit which overlaps a region.
+        """
+        if chromosome not in self.starts:
+            return [False] * len(hit_starts)
+
+        starts = self.starts[chromosome]
+        max_ends = self.max_ends[chromosome]
+        # The bisections are mapped in C, only the comparison is done per hit.
+        indexes = map(bisect_left, itertools.repeat(starts, len(hit_ends)), hit_ends)
+        return [index > 0 and max_ends[index - 1] >= hit_start for index, hit_start in zip(indexes, hit_starts)]
+
+    def overlaps_hits(self, hits):
+        """
+        Same as overlaps_batch, for hits on any chromosome.
+
+        :param hits: List of (chromosome, hit start, hit end) tuples.
+        :return: A list with True for every hit which overlaps a region.
+        """
+        if not hits:
+            return []
+        return self.overlaps_columns(*zip(*hits))
+
+    def overlaps_columns(self, chromosomes, hit_starts, hit_ends):
+        """
+        Same as overlaps_hits, for hits given as three columns. The regions of
+        every hit are looked up and bisected in C, by mapping over the
+        columns, so only the final comparison is done one hit at a time.
+
+        :return: A list with True for every hit which overlaps a region.
+        """
+        no_regions = array('l')
+        starts = map(self.starts.get, chromosomes, itertools.repeat(no_regions, len(chromosomes)))
+        max_ends = map(self.max_ends.get, chromosomes, itertools.repeat(no_regions, len(chromosomes)))
+        indexes = map(bisect_left, starts, hit_ends)
+        return [index > 0 and ends[index - 1] >= hit_start
+                for index, ends, hit_start in zip(indexes, max_ends, hit_starts)]
+
+
+def merge_intervals(intervals):
+    """
+    Merge the regions which overlap or touch each other.
+
+    :param intervals: List of (start, end) tuples of integers, in any order.
+    :return: The merged list of (start, end) tuples, sorted.
+    """
+    merged = []
+    for start, end in sorted(intervals):
+        if merged and start <= merged[-1][1]:
+            if end > merged[-1][1]:
+                merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def write_index(path, regions):
+    """
+    Merge and store *regions*, a dictionary of (start, end) lists by
+    chromosome, in the binary index file *path*.
+    """
+    chromosomes = sorted(regions)
+    directory, blobs = [], []
+    offset = HEADER.size + CHROMOSOME.size * len(chromosomes)
+    for chromosome in chromosomes:
+        if len(chromosome) > CHROMOSOME.size - 16:
+            raise ValueError('Chromosome name too long for the index: ' + chromosome)
+        intervals = merge_intervals(regions[chromosome])
+        columns = array('i', [start for start, end in intervals] + [end for start, end in intervals])
+        if sys.byteorder == 'big':
+            columns.byteswap()
+        directory.append(CHROMOSOME.pack(chromosome, offset, len(intervals)))
+        blobs.append(columns.tostring())
+        offset += len(blobs[-1])
+
+    with open(path, 'wb') as out_file:
+        out_file.write(HEADER.pack(MAGIC, VERSION, len(chromosomes)))
+        out_file.write(''.join(directory))
+        for blob in blobs:
+            out_file.write(blob)
+
+
+def is_index_file(path):
+    with open(path, 'rb') as in_file:
+        return in_file.read(len(MAGIC)) == MAGIC
+
+
+def load_index(path):
+    """
+    :return: The RepeatIndex stored in the binary index file *path*.
+    """
+    index = RepeatIndex()
+    with open(path, 'rb') as in_file:
+        magic, version, nof_chromosomes = HEADER.unpack(in_file.read(HEADER.size))
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError('Not a repeat index, or a repeat index of an unsupported version.'
+                               ' Path specified was', path)
+
+        directory = [CHROMOSOME.unpack(in_file.read(CHROMOSOME.size)) for _ in xrange(nof_chromosomes)]
+        for chromosome, offset, nof_regions in directory:
+            in_file.seek(offset)
+            starts, ends = array('i'), array('i')
+            starts.fromfile(in_file, nof_regions)
+            ends.fromfile(in_file, nof_regions)
+            if sys.byteorder == 'big':
+                starts.byteswap()
+                ends.byteswap()
+            index.add_chromosome(chromosome.rstrip('\0'), starts, ends, disjoint=True)
+    return index
+
+
+def benchmark(repeats_file, blast_file):
+    """
+    Time the bisection of process_blast_output against the index on the hits
+    of *blast_file*.
+
+    :return: (seconds with the bisection, seconds with the index, number of
+             hits, number of hits on which the two disagree) tuple.
+    """
+    import csv
+    import json
+    import time
+    import process_blast_output
+
+    with open(repeats_file) as in_file:
+        regions = json.load(in_file)
+
+    hits = []
+    with open(blast_file) as in_file:
+        for line in csv.reader(in_file, delimiter='\t'):
+            hits.append(process_blast_output.format_blast_output_in_dict(line))
+
+    start_time = time.time()
+    bisection = []
+    for hit in hits:
+        regions_list = regions.get(hit['chromosome'], [])
+        bisection.append(process_blast_output.non_recursive_binary_search_of_repeats(regions_list, hit))
+    bisection_time = time.time() - start_time
+
+    start_time = time.time()
+    index = RepeatIndex(regions)
+    queries = []
+    for hit in hits:
+        hit_start, hit_end = sorted([int(hit['subject_start']), int(hit['subject_end'])])
+        queries.append((hit['chromosome'], hit_start, hit_end))
+    indexed = index.overlaps_hits(queries)
+    index_time = time.time() - start_time
+
+    differences = sum(1 for old, new in zip(bisection, indexed) if old != new)
+    return bisection_time, index_time, len(hits), differences
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-r',
+                        '--repeats',
+                        type=str,
+                        required=True,
+                        help='Input file. The repeating regions in JSON format.')
+    parser.add_argument('-b',
+                        '--blast',
+                        type=str,
+                        required=True,
+                        help='Input file. BLAST output in tsv format.')
+
+    args = parser.parse_args()
+    bisection_time, index_time, nof_hits, differences = benchmark(args.repeats, args.blast)
+    print 'Bisection: %.3fs, index (including building it): %.3fs for %d hits.' % (
+        bisection_time, index_time, nof_hits)
+    print differences, 'hits were found in a repeating region by one method but not the other.'
+
+
+if __name__ == '__main__':
+    main()
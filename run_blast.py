@@ -1,9 +1,211 @@
 __author__ = 'Panagiotis Koukos'
 
-import subprocess
+"""
+run_blast.py - Run the extracted sequences through BLASTN.
+
+The query FASTA file is split in shards at record boundaries and every shard
+is run through its own blastn process, several of them at the same time. The
+shards which are done are recorded in a manifest, so that if the run is
+interrupted running it again only does the shards which are missing. When all
+of them are done their output is merged in the output file, in the same order
+as the queries.
+
+:param -db, --blast_database_dir: The BLAST database.
+:type -db, --blast_database_dir: str or unicode
+:param -seq, --fasta_input_file: The query sequences.
+:type -seq, --fasta_input_file: str or unicode
+:param -o, --output_file: Where the hits are written. Default is blast.out.
+:type -o, --output_file: str or unicode
+:param -j, --jobs: Number of blastn processes to run at the same time.
+:type -j, --jobs: int
+:param -s, --shards: Number of shards to split the queries in.
+:type -s, --shards: int
+:param -t, --threads: Number of threads of every blastn process.
+:type -t, --threads: int
+:return None
+"""
+
+import os
 import sys
+import json
+import shutil
+import subprocess
 from multiprocessing import cpu_count
 
+import herv_lib
+
+MANIFEST = 'manifest.json'
+
+
+def find_blastn():
+    try:
+        return subprocess.check_output(['which', 'blastn']).rstrip()
+    except subprocess.CalledProcessError:
+        raise RuntimeError('No blastn binary in the system path.')
+
+
+def shard_dir(output_file):
+    return output_file + '.shards'
+
+
+def split_query(query_file, nof_shards, work_dir):
+    """
+    Copy the records of *query_file* in *nof_shards* shard files in
+    *work_dir*. The shards are contiguous, so the queries keep their order.
+
+    :return: The list of the shard files.
+    """
+    shard_files = []
+    with open(query_file, 'rb') as in_file:
+        for index, (start, end) in enumerate(herv_lib.shard_file(query_file, nof_shards)):
+            shard_file = os.path.join(work_dir, 'shard_%d.fa' % index)
+            in_file.seek(start)
+            with open(shard_file, 'wb') as out_file:
+                remaining = end - start
+                while remaining:
+                    block = in_file.read(min(remaining, 1 << 20))
+                    out_file.write(block)
+                    remaining -= len(block)
+            shard_files.append(shard_file)
+    return shard_files
+
+
+def query_fingerprint(query_file, database):
+    """
+    :return: What a manifest has to have been written for, for its shards to
+             be reused. The number of shards is left out, so that a run can
+             be resumed with another number of jobs or on another machine.
+    """
+    query_stat = os.stat(query_file)
+    return {
+        'query': os.path.abspath(query_file),
+        'query_size': query_stat.st_size,
+        'query_mtime': int(query_stat.st_mtime),
+        'database': database
+    }
+
+
+def write_manifest(path, manifest):
+    # Written to a temporary file and renamed so that an interrupted run never
+    # leaves a half written manifest behind.
+    with open(path + '.tmp', 'w') as out_file:
+        json.dump(manifest, out_file, indent=2, sort_keys=True)
+    os.rename(path + '.tmp', path)
+
+
+def load_manifest(work_dir, fingerprint, nof_shards=None):
+    """
+    :param nof_shards: If given, the number of shards the manifest has to
+                       have been written for.
+    :return: The manifest of *work_dir*, or None if there is not one or it
+             was written for other queries, another database or number of shards.
+    """
+    path = os.path.join(work_dir, MANIFEST)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as in_file:
+        manifest = json.load(in_file)
+    if manifest.get('fingerprint') != fingerprint:
+        return None
+    if nof_shards and manifest.get('requested_shards') != nof_shards:
+        return None
+    return manifest
+
+
+def blast_shard(task):
+    """
+    Run a shard through blastn. The output is written next to its final
+    path and only moved there once blastn has exited successfully.
+
+    :param task: (blastn, database, shard file, output file, threads) tuple.
+    :return: (output file, exit code of blastn) tuple.
+    """
+    blast, database, shard_file, shard_output, threads = task
+    return_code = subprocess.call([blast,
+                                   '-db', database,
+                                   '-query', shard_file,
+                                   '-out', shard_output + '.tmp',
+                                   '-outfmt', '6',  # TSV output for easier parsing.
+                                   '-num_threads', str(threads)])
+    if return_code == 0:
+        os.rename(shard_output + '.tmp', shard_output)
+    return shard_output, return_code
+
+
+def run_blast(database, query_file, output_file='blast.out', jobs=None, nof_shards=None, threads=1, progress=None):
+    """
+    Run *query_file* through blastn against *database* in shards and merge
+    their output in *output_file*. The shards which are done are kept track
+    of in a manifest, and running this again for the same queries only runs
+    the shards which are not done.
+
+    :param jobs: Number of blastn processes to run at the same time. Default
+                 is the number of CPUs.
+    :param nof_shards: Number of shards to split the queries in. Default is
+                       four times the number of jobs, or as many as the run
+                       being resumed was split in.
+    :param threads: Number of threads of every blastn process.
+    :param progress: If given, called with the number of shards done and the
+                     total number of shards every time a shard is done.
+    :return: The number of shards which were run this time.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    blast = find_blastn()
+    jobs = jobs or cpu_count()
+
+    work_dir = shard_dir(output_file)
+    fingerprint = query_fingerprint(query_file, database)
+    # The shards of an earlier run are reused whatever their number, unless
+    # another one is asked for.
+    manifest = load_manifest(work_dir, fingerprint, nof_shards)
+    if manifest is None:
+        nof_shards = nof_shards or jobs * 4
+        if os.path.isdir(work_dir):
+            shutil.rmtree(work_dir)
+        os.mkdir(work_dir)
+        shard_files = split_query(query_file, nof_shards, work_dir)
+        manifest = {'fingerprint': fingerprint, 'requested_shards': nof_shards, 'completed': [],
+                    'shards': [os.path.basename(shard_file) for shard_file in shard_files]}
+        write_manifest(os.path.join(work_dir, MANIFEST), manifest)
+
+    shard_files = [os.path.join(work_dir, shard_file) for shard_file in manifest['shards']]
+    shard_outputs = [os.path.splitext(shard_file)[0] + '.out' for shard_file in shard_files]
+    pending = [index for index in xrange(len(shard_outputs)) if index not in manifest['completed']]
+    # The shards are recorded in the manifest in the order they are done in.
+    tasks = [(blast, database, shard_files[index], shard_outputs[index], threads) for index in pending]
+
+    # The work is done by the blastn processes, threads are enough to keep
+    # them running and to record every shard as soon as it is done.
+    failed = []
+    if tasks:
+        pool = ThreadPool(min(jobs, len(tasks)))
+        try:
+            for shard_output, return_code in pool.imap_unordered(blast_shard, tasks):
+                index = shard_outputs.index(shard_output)
+                if return_code != 0:
+                    failed.append(shard_files[index])
+                    continue
+                manifest['completed'].append(index)
+                manifest['completed'].sort()
+                write_manifest(os.path.join(work_dir, MANIFEST), manifest)
+                if progress:
+                    progress(len(manifest['completed']), len(shard_files))
+        finally:
+            pool.close()
+            pool.join()
+
+    if failed:
+        raise RuntimeError('Call to blastn failed for ' + ', '.join(failed) +
+                           '. Run again to retry only the shards which failed.')
+
+    with open(output_file, 'wb') as out_file:
+        for shard_output in shard_outputs:
+            with open(shard_output, 'rb') as in_file:
+                shutil.copyfileobj(in_file, out_file)
+    shutil.rmtree(work_dir)
+    return len(pending)
+
 
 def main():
     import argparse
@@ -24,31 +226,36 @@ def main():
                         type=str,
                         required=False,
                         help='The name of the file where the results will be printed.')
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        required=False,
+                        help='Number of blastn processes to run at the same time. Default is the '
+                             'number of CPUs.')
+    parser.add_argument('-s',
+                        '--shards',
+                        type=int,
+                        required=False,
+                        help='Number of shards to split the sequences in. Default is four times '
+                             'the number of jobs, or as many as the interrupted run being resumed '
+                             'was split in.')
+    parser.add_argument('-t',
+                        '--threads',
+                        default=1,
+                        type=int,
+                        required=False,
+                        help='Number of threads of every blastn process. Default is 1.')
 
     args = parser.parse_args()
     database, input_file, output_file = args.blast_database_dir, args.fasta_input_file, args.output_file
 
-    try:
-        blast = subprocess.check_output(['which', 'blastn']).rstrip()
-    except subprocess.CalledProcessError:
-        sys.exit('No blastn binary in the system path. Aborting.')
-
     if not output_file:
         output_file = 'blast.out'
 
-    n_cpu = cpu_count()
-    if n_cpu > 4:
-        n_cpu = 4
-
     try:
-        subprocess.check_call([blast,
-                               '-db', database,
-                               '-query', input_file,
-                               '-out', output_file,
-                               '-outfmt', '6',  # TSV output for easier parsing.
-                               '-num_threads', str(n_cpu)])  # parallelise it if possible.
-    except subprocess.CalledProcessError:
-        sys.exit('Call to blastn failed. Please investigate.')
+        run_blast(database, input_file, output_file, args.jobs, args.shards, args.threads)
+    except RuntimeError as error:
+        sys.exit(str(error) + ' Aborting.')
 
 if __name__ == '__main__':
     main()
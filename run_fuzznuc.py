@@ -15,16 +15,17 @@ nucleotide sequence and stores the results in an aptly named text file.
 :return None
 """
 
+import os
 import subprocess
 import sys
 import atexit
 
+import herv_lib
+
 # From http://stackoverflow.com/a/11270665
 try:
     from subprocess import DEVNULL  # py3k
 except ImportError:
-    import os
-
     DEVNULL = open(os.devnull, 'wb')
 
 
@@ -34,6 +35,38 @@ def custom_exit():
     DEVNULL.close()
 
 
+def check_pattern(pattern):
+    if pattern != 'TGTGGGGAAAAGCAAGAGAG' and pattern != 'AGGGGCAACCCACCCCTACA':
+        raise RuntimeWarning('Sequence other than the 3prime or 5prime LTR consensus of the'
+                             'HERV-K113 pro-virus detected. Proceeding at your own risk.')
+
+
+def report_name(input_file, pattern):
+    """
+    :return: The name of the report of *input_file* for *pattern*, eg:
+             <name>.5_prime.fuzznuc
+    """
+    if pattern == 'TGTGGGGAAAAGCAAGAGAG':
+        return os.path.basename(input_file).split('.')[0] + '.5_prime' + '.fuzznuc'
+    else:
+        return os.path.basename(input_file).split('.')[0] + '.3_prime' + '.fuzznuc'
+
+
+def fuzznuc_arguments(fuzznuc, input_file, output_file, pattern, nof_mismatches, complement=True):
+    fuzznuc_arguments = [
+        fuzznuc,
+        '-sequence', input_file,
+        '-pattern', pattern,
+        '-pmismatch', nof_mismatches,
+        '-outfile', output_file,
+        '-rformat', 'simple'
+    ]
+
+    if complement:
+        fuzznuc_arguments.append('-complement')
+    return fuzznuc_arguments
+
+
 def call_fuzznuc(fuzznuc, input_file, output_file, pattern, nof_mismatches, complement=True):
     """
     Call fuzznuc with the specified arguments.
@@ -49,30 +82,14 @@ def call_fuzznuc(fuzznuc, input_file, output_file, pattern, nof_mismatches, comp
     :return: None
     """
 
-    if pattern != 'TGTGGGGAAAAGCAAGAGAG' and pattern != 'AGGGGCAACCCACCCCTACA':
-        raise RuntimeWarning('Sequence other than the 3prime or 5prime LTR consensus of the'
-                             'HERV-K113 pro-virus detected. Proceeding at your own risk.')
+    check_pattern(pattern)
 
     if not output_file:
-        if pattern == 'TGTGGGGAAAAGCAAGAGAG':
-            output_file = os.path.basename(input_file).split('.')[0] + '.5_prime' + '.fuzznuc'
-        else:
-            output_file = os.path.basename(input_file).split('.')[0] + '.3_prime' + '.fuzznuc'
+        output_file = report_name(input_file, pattern)
 
     try:
-        fuzznuc_arguments = [
-            fuzznuc,
-            '-sequence', input_file,
-            '-pattern', pattern,
-            '-pmismatch', nof_mismatches,
-            '-outfile', output_file,
-            '-rformat', 'simple'
-        ]
-
-        if complement:
-            fuzznuc_arguments.append('-complement')
-
-        subprocess.check_call(fuzznuc_arguments,
+        subprocess.check_call(fuzznuc_arguments(fuzznuc, input_file, output_file, pattern,
+                                                nof_mismatches, complement),
                               stdout=DEVNULL,
                               stderr=subprocess.STDOUT)
     except subprocess.CalledProcessError as e:
@@ -80,9 +97,43 @@ def call_fuzznuc(fuzznuc, input_file, output_file, pattern, nof_mismatches, comp
         custom_exit()
 
 
+def stream_fuzznuc(fuzznuc, input_file, pattern, nof_mismatches, complement=True, keep_report=None):
+    """
+    Same as call_fuzznuc, except that the report is not written to a file.
+    fuzznuc writes it to its standard output instead, and it is passed on
+    line by line while fuzznuc is still running, so that it can be parsed at
+    the same time, eg: by process_results.iter_report.
+
+    :param keep_report: If given, the report is also written to this file.
+    :type keep_report: str or unicode
+    :return: Yields the lines of the report.
+    """
+    check_pattern(pattern)
+
+    report_file = open(keep_report, 'w') if keep_report else None
+    process = subprocess.Popen(fuzznuc_arguments(fuzznuc, input_file, 'stdout', pattern,
+                                                 nof_mismatches, complement),
+                               stdout=subprocess.PIPE,
+                               stderr=DEVNULL,
+                               bufsize=1 << 20)
+    exhausted = False
+    try:
+        for line in process.stdout:
+            if report_file:
+                report_file.write(line)
+            yield line
+        exhausted = True
+    finally:
+        if report_file:
+            report_file.close()
+        return_code = herv_lib.stop_process(process, not exhausted)
+
+    if return_code != 0:
+        raise RuntimeError('Error during the execution of fuzznuc. Exit code was', return_code)
+
+
 def main():
     import argparse
-    import herv_lib
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-i',
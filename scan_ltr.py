@@ -0,0 +1,445 @@
+__author__ = 'Panagiotis Koukos'
+
+"""
+scan_ltr.py - Scan input files for the LTR sequences without fuzznuc.
+
+This module is an in-process replacement for run_fuzznuc.py followed by
+process_results.parse_report. It scans the reads of a FASTA file for all
+of the LTR patterns at once with a bit-parallel (shift-and) matcher which
+allows up to N mismatches, on both strands, and produces the same results
+dictionary parse_report produces from the fuzznuc reports.
+
+Before being matched every read goes through a seed prefilter. Each pattern
+is split in N + 1 seeds, at least one of which has to occur unchanged in any
+hit with N mismatches or less, and a single Aho-Corasick automaton over the
+seeds of all the patterns discards the reads without any of them in one
+pass. Adding patterns therefore barely changes the cost of a scan.
+
+:param -i, --input: Path to the FASTA file to scan.
+:type -i, --input: str or unicode
+:param -n, --number_of_mismatches: Number of mismatches allowed.
+:type -n, --number_of_mismatches: int
+:param -c, --complement: Also scan the reverse strand, Y or N.
+:type -c, --complement: str or unicode
+:param -p, --pattern: Pattern to look for as SEQUENCE:PRIME. Repeatable.
+:type -p, --pattern: str or unicode
+:return None
+"""
+
+import os
+import itertools
+import herv_lib
+import process_results
+
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+
+
+def reverse_complement(sequence):
+    return ''.join(COMPLEMENT[base] for base in reversed(sequence.upper()))
+
+
+class PatternMatcher(object):
+    """
+    Bit-parallel approximate matcher for a set of patterns.
+
+    All of the patterns are packed next to each other in a single bit vector
+    so that every base of the scanned sequence updates all of them at once.
+    Only substitutions are allowed, the same as fuzznuc -pmismatch.
+    Those properties are:
+        patterns: list, (pattern, label, strand) tuples in the order packed.
+        nof_mismatches: int, Maximum number of mismatches for a hit.
+    """
+
+    def __init__(self, patterns, nof_mismatches):
+        """
+        Returns a PatternMatcher for *patterns*, a list of (pattern, label,
+        strand) tuples. The pattern is an A, C, G, T sequence in which N
+        matches any base.
+        """
+        if nof_mismatches < 0:
+            raise ValueError('The number of mismatches can not be negative.')
+
+        self.patterns = patterns
+        self.nof_mismatches = nof_mismatches
+        self.base_masks = dict((base, 0) for base in 'ACGT')
+        self.start_mask = 0
+        self.end_mask = 0
+        # (end bit, pattern length, pattern index) for every pattern.
+        self.ends = []
+
+        offset = 0
+        for index, (pattern, label, strand) in enumerate(patterns):
+            pattern = pattern.upper()
+            if not pattern or set(pattern) - set('ACGTN'):
+                raise ValueError('Patterns can only contain A, C, G, T or N. '
+                                 'Pattern specified was ' + pattern)
+            for position, base in enumerate(pattern):
+                for masked_base in self.base_masks:
+                    if base == 'N' or base == masked_base:
+                        self.base_masks[masked_base] |= 1 << (offset + position)
+            end_bit = 1 << (offset + len(pattern) - 1)
+            self.start_mask |= 1 << offset
+            self.end_mask |= end_bit
+            self.ends.append((end_bit, len(pattern), index))
+            offset += len(pattern)
+
+        self.full_mask = (1 << offset) - 1
+
+    def search(self, sequence):
+        """
+        Scan *sequence* for all of the patterns.
+
+        :param sequence: The sequence to scan.
+        :type sequence: str
+        :return: A list of (start, end, mismatches, pattern index) tuples, in
+                 the order the hits end in the sequence. Coordinates are
+                 1-indexed and inclusive.
+        """
+        masks = self.base_masks
+        start_mask = self.start_mask
+        end_mask = self.end_mask
+        full_mask = self.full_mask
+        nof_mismatches = self.nof_mismatches
+        # states[j] has a bit set for every pattern prefix which matches the
+        # end of the sequence read so far with at most j mismatches.
+        states = [0] * (nof_mismatches + 1)
+        hits = []
+
+        for position, base in enumerate(sequence.upper()):
+            base_mask = masks.get(base, 0)
+            previous = states[0]
+            states[0] = ((previous << 1) | start_mask) & base_mask
+            for j in xrange(1, nof_mismatches + 1):
+                current = states[j]
+                states[j] = ((((current << 1) | start_mask) & base_mask) |
+                             (((previous << 1) | start_mask) & full_mask))
+                previous = current
+
+            if states[nof_mismatches] & end_mask:
+                for end_bit, length, index in self.ends:
+                    if states[nof_mismatches] & end_bit:
+                        mismatches = 0
+                        while not states[mismatches] & end_bit:
+                            mismatches += 1
+                        hits.append((position - length + 2, position + 1, mismatches, index))
+        return hits
+
+
+class SeedAutomaton(object):
+    """
+    Aho-Corasick automaton over the exact seeds of a set of patterns.
+
+    Reads which contain none of the seeds can not contain any of the patterns
+    with the allowed number of mismatches (pigeonhole principle) and can be
+    skipped without running the matcher on them.
+    Those properties are:
+        transitions: list, One {base: state} dictionary per state. Bases
+                     without an entry lead back to the root state.
+        outputs: list, Bit mask of the patterns with a seed ending in each state.
+    """
+
+    def __init__(self, patterns, nof_mismatches):
+        """
+        Returns a SeedAutomaton for *patterns*, a list of (pattern, label,
+        strand) tuples as given to PatternMatcher.
+        """
+        self.transitions = [{}]
+        self.outputs = [0]
+
+        for index, (pattern, label, strand) in enumerate(patterns):
+            for seed in split_in_seeds(pattern.upper(), nof_mismatches + 1):
+                for expanded_seed in expand_wildcards(seed):
+                    self.add_seed(expanded_seed, 1 << index)
+
+        self.add_failure_transitions()
+
+    def add_seed(self, seed, pattern_bit):
+        state = 0
+        for base in seed:
+            if base not in self.transitions[state]:
+                self.transitions.append({})
+                self.outputs.append(0)
+                self.transitions[state][base] = len(self.transitions) - 1
+            state = self.transitions[state][base]
+        self.outputs[state] |= pattern_bit
+
+    def add_failure_transitions(self):
+        # Breadth first, so that the failure state of every state has been
+        # completed by the time the state itself is visited. Transitions
+        # missing from the trie are copied from the failure state, which
+        # turns the automaton in a DFA with a single lookup per base.
+        failures = [0] * len(self.transitions)
+        queue = list(self.transitions[0].values())
+        for state in queue:
+            for base, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                failure = failures[state]
+                failures[next_state] = self.transitions[failure].get(base, 0)
+                self.outputs[next_state] |= self.outputs[failures[next_state]]
+            for base, next_state in self.transitions[failures[state]].items():
+                self.transitions[state].setdefault(base, next_state)
+
+    def scan(self, sequence):
+        """
+        :return: Bit mask of the patterns which have a seed in *sequence*.
+        """
+        transitions = self.transitions
+        outputs = self.outputs
+        state = 0
+        found = 0
+        for base in sequence.upper():
+            state = transitions[state].get(base, 0)
+            found |= outputs[state]
+        return found
+
+
+def split_in_seeds(pattern, nof_seeds):
+    """
+    Split *pattern* in *nof_seeds* non-overlapping seeds of (almost) equal length.
+    """
+    if nof_seeds > len(pattern):
+        raise ValueError('Too many mismatches for a pattern of length ' + str(len(pattern)) + '.')
+    seeds = []
+    for i in xrange(nof_seeds):
+        seeds.append(pattern[i * len(pattern) // nof_seeds:(i + 1) * len(pattern) // nof_seeds])
+    return seeds
+
+
+def expand_wildcards(seed):
+    choices = ['ACGT' if base == 'N' else base for base in seed]
+    return [''.join(bases) for bases in itertools.product(*choices)]
+
+
+def build_matcher(patterns, nof_mismatches, complement=True):
+    """
+    Build a single matcher for the forward and, if *complement* is set, the
+    reverse complement of every (pattern, prime) pair in *patterns*.
+    """
+    packed = []
+    for pattern, prime in patterns:
+        packed.append((pattern, prime, '+'))
+        if complement:
+            packed.append((reverse_complement(pattern), prime, '-'))
+    return PatternMatcher(packed, nof_mismatches)
+
+
+def format_mismatch(mismatches):
+    # fuzznuc reports exact matches with a dot instead of a zero.
+    return str(mismatches) if mismatches else '.'
+
+
+def find_hits(records, matcher, prefilter=None, stats=None):
+    """
+    Scan *records*, an iterable of (name, sequence) tuples, with *matcher*.
+    Only the reads with a seed hit in the *prefilter* automaton, if there is
+    one, are matched. The number of reads scanned and matched are added to
+    the 'reads' and 'candidates' keys of *stats*, if given.
+
+    :return: Yields (prime, hit id, hit) tuples with the hit in the format
+             parse_report builds before handing it to check_results. As in
+             the fuzznuc reports, forward strand hits come before reverse
+             strand ones and only the last hit of a read is kept.
+    """
+    strand_order = {'+': 0, '-': 1}
+    nof_reads, nof_candidates = 0, 0
+    for name, sequence in records:
+        nof_reads += 1
+        if prefilter and not prefilter.scan(sequence):
+            continue
+        nof_candidates += 1
+
+        last_hits = {}
+        for start, end, mismatches, index in matcher.search(sequence):
+            pattern, prime, strand = matcher.patterns[index]
+            key = (strand_order[strand], start)
+            if prime not in last_hits or key >= last_hits[prime][0]:
+                last_hits[prime] = (key, start, end, strand, mismatches)
+
+        for prime in last_hits:
+            key, start, end, strand, mismatches = last_hits[prime]
+            hit_id = name.split('_')[-1] + '.' + prime
+            yield prime, hit_id, {
+                'read_length': str(len(sequence)),
+                'prime': prime,
+                'LTR_from': str(start),
+                'LTR_to': str(end),
+                'strand': strand,
+                'mismatch': format_mismatch(mismatches)
+            }
+
+    if stats is not None:
+        stats['reads'] = stats.get('reads', 0) + nof_reads
+        stats['candidates'] = stats.get('candidates', 0) + nof_candidates
+
+
+def discarded_fraction(stats):
+    if not stats.get('reads'):
+        return 0.0
+    return 1 - float(stats['candidates']) / stats['reads']
+
+
+def parse_pattern(pattern_spec):
+    """
+    Turn a SEQUENCE:PRIME command line argument in a (pattern, prime) tuple.
+    """
+    import argparse
+    try:
+        pattern, prime = pattern_spec.split(':')
+    except ValueError:
+        raise argparse.ArgumentTypeError('Patterns should be given as SEQUENCE:PRIME, eg: '
+                                         'TGTGGGGAAAAGCAAGAGAG:5_prime. Got ' + pattern_spec)
+    if prime not in ('5_prime', '3_prime'):
+        raise argparse.ArgumentTypeError('The prime of a pattern should be 5_prime or 3_prime.'
+                                         ' Got ' + prime)
+    return pattern.upper(), prime
+
+
+def get_fasta_name(path_to_file):
+    return os.path.basename(path_to_file).split('.')[0]
+
+
+def scan_hits(fasta_file, patterns=None, nof_mismatches=2, complement=True, prefilter=True,
+              stats=None, start=0, end=None):
+    """
+    Scan the records of *fasta_file* between the byte offsets *start* and
+    *end* for the LTR *patterns*, defaulting to the HERV-K113 consensus
+    sequences. Patterns sharing a prime are treated as variants of the same
+    LTR. *stats* is passed on to find_hits.
+
+    :return: A list of (prime, hits) tuples, in the order of *patterns*, with
+             the hits not yet checked by check_results.
+    """
+    if patterns is None:
+        patterns = herv_lib.LTR_PATTERNS
+
+    primes = []
+    for pattern, prime in patterns:
+        if prime not in primes:
+            primes.append(prime)
+
+    hits = dict((prime, {}) for prime in primes)
+    matcher = build_matcher(patterns, nof_mismatches, complement)
+    seed_automaton = SeedAutomaton(matcher.patterns, nof_mismatches) if prefilter else None
+    records = herv_lib.iter_reads(fasta_file, start, end)
+    for prime, hit_id, hit in find_hits(records, matcher, seed_automaton, stats):
+        hits[prime][hit_id] = hit
+
+    return [(prime, hits[prime]) for prime in primes]
+
+
+def check_hits(fasta_file, prime_hits):
+    """
+    :return: A list with one results dictionary per prime in *prime_hits*,
+             each one equivalent to what parse_report returns for the
+             matching fuzznuc report.
+    """
+    fasta_name = get_fasta_name(fasta_file)
+    return [{fasta_name: process_results.check_results(hits, prime)} for prime, hits in prime_hits]
+
+
+def scan_fasta(fasta_file, patterns=None, nof_mismatches=2, complement=True, prefilter=True,
+               stats=None):
+    """
+    Scan the whole of *fasta_file*. See scan_hits for the arguments.
+
+    :return: A list with one results dictionary per prime, in the order of
+             *patterns*, as returned by check_hits.
+    """
+    prime_hits = scan_hits(fasta_file, patterns, nof_mismatches, complement, prefilter, stats)
+    return check_hits(fasta_file, prime_hits)
+
+
+def compare_with_reports(results, report_files):
+    """
+    Compare the results of scan_fasta with those parse_report produces from
+    the fuzznuc reports of the same file.
+
+    :return: A sorted list of the hit ids whose results differ.
+    """
+    scanned = {}
+    for results_dict in results:
+        for hits in results_dict.values():
+            scanned.update(hits)
+
+    reported = {}
+    for report_file in report_files:
+        for hits in process_results.parse_report(report_file).values():
+            reported.update(hits)
+
+    return sorted(hit_id for hit_id in set(scanned) | set(reported)
+                  if scanned.get(hit_id) != reported.get(hit_id))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i',
+                        '--input',
+                        type=str,
+                        required=True,
+                        help='Input file. Must be in FASTA or FASTQ format, gzipped or not.')
+
+    parser.add_argument('-n',
+                        '--number_of_mismatches',
+                        dest='nmismatch',
+                        default=2,
+                        type=int,
+                        required=False,
+                        help='How many mismatches to allow in a hit. Default is 2.')
+
+    parser.add_argument('-c',
+                        '--complement',
+                        default='Y',
+                        choices=['Y', 'N'],
+                        type=str,
+                        required=False,
+                        help='Y means that the reverse complement of the patterns will also be '
+                             'looked for. Default is Y.')
+
+    parser.add_argument('-r',
+                        '--reports',
+                        nargs='+',
+                        type=str,
+                        required=False,
+                        help='fuzznuc reports of the same input file. If specified the results '
+                             'are compared with the reports instead of being written out.')
+
+    parser.add_argument('-p',
+                        '--pattern',
+                        dest='patterns',
+                        action='append',
+                        type=parse_pattern,
+                        required=False,
+                        help='LTR pattern to look for, as SEQUENCE:PRIME. Can be repeated to scan '
+                             'for a panel of patterns in one pass. Default is the HERV-K113 '
+                             '5 and 3 prime LTR consensus sequences.')
+
+    args = parser.parse_args()
+    complement = True if args.complement == 'Y' else False
+
+    stats = {}
+    results = scan_fasta(args.input, args.patterns, args.nmismatch, complement, stats=stats)
+    print 'Scanned', stats['reads'], 'reads,', '%.2f%%' % (100 * discarded_fraction(stats)), \
+        'of them discarded by the seed prefilter.'
+
+    if args.reports:
+        differences = compare_with_reports(results, args.reports)
+        for hit_id in differences:
+            print 'Results differ for hit', hit_id
+        print len(differences), 'hits differ from the fuzznuc reports.'
+    else:
+        # The results of every prime go to a segment, and the JSON file is
+        # written once with all of them.
+        fasta_name = get_fasta_name(args.input)
+        segment_paths = []
+        for results_dict in results:
+            hits = results_dict[fasta_name]
+            segment_path = '%s.%d.jsonl' % (fasta_name, len(segment_paths))
+            process_results.write_segment(((hit_id, hits[hit_id]) for hit_id in sorted(hits)), segment_path)
+            segment_paths.append(segment_path)
+        process_results.compact_segments(fasta_name, segment_paths)
+
+
+if __name__ == '__main__':
+    main()